@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Backup throughput benchmark for the System Restore Toolkit
+
+Generates reproducible synthetic filesystem trees, runs the toolkit's
+create-backup, verify-backup and restore-backup commands against them for
+every available codec and engine, and writes MB/s, files/s, CPU seconds,
+peak RSS and compression ratio to a JSON results file.
+
+A stored baseline can be compared against a fresh run to catch regressions
+before a release:
+
+    sudo ./benchmarks/backup_benchmark.py --output results.json
+    sudo ./benchmarks/backup_benchmark.py --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+TOOLKIT_CMD = os.path.join(PROJECT_DIR, 'system-restore-toolkit')
+
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'lib'))
+import excludes  # noqa: E402
+
+MIB = 1024 * 1024
+
+# Codec name -> binary that must be installed for the codec to be benchmarked
+CODECS = {
+    'gzip': 'gzip',
+    'zstd': 'zstd',
+    'xz': 'xz',
+    'none': None,
+}
+
+# Engine name -> extra create-backup arguments
+ENGINES = {
+    'tar': [],
+    'rsync': ['--engine', 'rsync'],
+    'sharded': ['--engine', 'sharded'],
+}
+
+# Engines that do not compress run once per profile (as codec "none") and
+# need their tool installed
+UNCOMPRESSED_ENGINES = {
+    'rsync': 'rsync',
+}
+
+# Metric -> direction that counts as "better", used by the baseline comparison
+METRIC_DIRECTIONS = {
+    'mb_per_s': 'higher',
+    'files_per_s': 'higher',
+    'cpu_seconds': 'lower',
+    'peak_rss_kb': 'lower',
+    'compression_ratio': 'higher',
+}
+
+WORDS = (
+    'backup restore snapshot system toolkit volume archive kernel package config '
+    'service network device mount journal module driver process thread memory '
+    'storage partition filesystem timeshift docker container image layer'
+).split()
+
+
+def write_compressible(path, size, rng):
+    """Write text-like data that compresses roughly like logs and source code"""
+    with open(path, 'w') as f:
+        written = 0
+        while written < size:
+            line = ' '.join(rng.choice(WORDS) for _ in range(12)) + '\n'
+            f.write(line)
+            written += len(line)
+
+
+def write_incompressible(path, size, rng):
+    """Write pseudo-random bytes that no codec can shrink"""
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 4 * MIB)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+
+def gen_small_files(root, rng, scale):
+    count = int(20000 * scale)
+    for i in range(count):
+        directory = os.path.join(root, f'd{i // 500:03d}', f's{(i // 50) % 10}')
+        os.makedirs(directory, exist_ok=True)
+        write_compressible(os.path.join(directory, f'f{i:06d}.txt'), rng.randint(512, 8192), rng)
+
+
+def gen_huge_files(root, rng, scale):
+    size = max(MIB, int(256 * MIB * scale))
+    write_compressible(os.path.join(root, 'huge-text.log'), size, rng)
+    write_incompressible(os.path.join(root, 'huge-random.bin'), size, rng)
+
+
+def gen_sparse_files(root, rng, scale):
+    size = max(MIB, int(1024 * MIB * scale))
+    for i in range(4):
+        path = os.path.join(root, f'sparse-{i}.img')
+        with open(path, 'wb') as f:
+            f.truncate(size)
+            # A handful of written extents scattered through the hole
+            for _ in range(8):
+                f.seek(rng.randrange(0, size - 65536))
+                f.write(rng.randbytes(65536))
+
+
+def gen_hardlink_farm(root, rng, scale):
+    originals = os.path.join(root, 'originals')
+    links = os.path.join(root, 'links')
+    os.makedirs(originals)
+    os.makedirs(links)
+    for i in range(int(500 * scale) or 1):
+        source = os.path.join(originals, f'f{i:05d}.dat')
+        write_compressible(source, rng.randint(4096, 65536), rng)
+        for j in range(10):
+            os.link(source, os.path.join(links, f'f{i:05d}-{j}.dat'))
+
+
+def gen_incompressible(root, rng, scale):
+    for i in range(int(64 * scale) or 1):
+        write_incompressible(os.path.join(root, f'media-{i:03d}.jpg'), rng.randint(MIB, 4 * MIB), rng)
+
+
+def gen_compressible(root, rng, scale):
+    for i in range(int(64 * scale) or 1):
+        write_compressible(os.path.join(root, f'app-{i:03d}.log'), rng.randint(MIB, 4 * MIB), rng)
+
+
+PROFILES = {
+    'small_files': gen_small_files,
+    'huge_files': gen_huge_files,
+    'sparse_files': gen_sparse_files,
+    'hardlink_farm': gen_hardlink_farm,
+    'incompressible': gen_incompressible,
+    'compressible': gen_compressible,
+}
+
+
+def tree_stats(root):
+    """Count entries and logical bytes, counting each hardlinked inode once"""
+    files = 0
+    total_bytes = 0
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            files += 1
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total_bytes += st.st_size
+    return {'files': files, 'bytes': total_bytes}
+
+
+def build_tree(workdir, profile, seed, scale):
+    """Generate (or reuse) the synthetic tree for a profile"""
+    root = os.path.join(workdir, 'trees', profile)
+    stamp_path = os.path.join(workdir, 'trees', f'{profile}.json')
+    params = {'profile': profile, 'seed': seed, 'scale': scale}
+
+    if os.path.exists(stamp_path) and os.path.isdir(root):
+        with open(stamp_path) as f:
+            stamp = json.load(f)
+        if stamp.get('params') == params:
+            return root, stamp['stats']
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    print(f"Generating {profile} tree (seed {seed}, scale {scale})...")
+    PROFILES[profile](root, random.Random(f'{seed}:{profile}'), scale)
+
+    stats = tree_stats(root)
+    with open(stamp_path, 'w') as f:
+        json.dump({'params': params, 'stats': stats}, f, indent=2)
+    return root, stats
+
+
+def measure(command, env):
+    """Run a command and return wall time, CPU time and peak RSS of its process tree"""
+    with tempfile.TemporaryFile('w+') as out, tempfile.TemporaryFile('w+') as err:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=out, stderr=err, text=True)
+        # wait4 reports usage for the child and every descendant it reaped, so tar and
+        # the compressor are included; ru_maxrss is the largest process, in KiB on Linux
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        out.seek(0)
+        err.seek(0)
+        return {
+            'returncode': process.returncode,
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 4),
+            'peak_rss_kb': usage.ru_maxrss,
+            'stdout': out.read(),
+            'stderr': err.read(),
+        }
+
+
+def toolkit_env(workdir, source, codec):
+    env = dict(os.environ)
+    env.update({
+        'CONFIG_FILE': os.path.join(workdir, 'no-config'),
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'BACKUP_SOURCE': source,
+        'BACKUP_COMPRESSION': codec,
+    })
+    return env
+
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+
+def phase_result(metrics, stats):
+    wall = metrics['wall_seconds'] or 1e-9
+    return {
+        'wall_seconds': metrics['wall_seconds'],
+        'cpu_seconds': metrics['cpu_seconds'],
+        'peak_rss_kb': metrics['peak_rss_kb'],
+        'mb_per_s': round(stats['bytes'] / MIB / wall, 2),
+        'files_per_s': round(stats['files'] / wall, 1),
+    }
+
+
+def run_case(workdir, profile, source, stats, codec, engine):
+    env = toolkit_env(workdir, source, codec)
+    backup_dir = env['BACKUP_DIR']
+    os.makedirs(backup_dir, exist_ok=True)
+    before = set(os.listdir(backup_dir))
+
+    case = {'profile': profile, 'codec': codec, 'engine': engine, 'source': stats}
+
+    backup = measure([TOOLKIT_CMD, 'create-backup'] + ENGINES[engine] + [f'benchmark {profile}'], env)
+    created = sorted(set(os.listdir(backup_dir)) - before)
+    if backup['returncode'] != 0 or not created:
+        case['error'] = f"create-backup failed: {backup['stderr'].strip()[-500:]}"
+        return case
+
+    backup_name = created[-1]
+    backup_path = os.path.join(backup_dir, backup_name)
+    archive_bytes = disk_usage(backup_path)
+    case['backup'] = phase_result(backup, stats)
+    case['archive_bytes'] = archive_bytes
+    case['compression_ratio'] = round(stats['bytes'] / archive_bytes, 3) if archive_bytes else None
+
+    verify = measure([TOOLKIT_CMD, 'verify-backup', backup_name], env)
+    if verify['returncode'] == 0:
+        case['verify'] = phase_result(verify, stats)
+    else:
+        case['error'] = f"verify-backup failed: {verify['stderr'].strip()[-500:]}"
+
+    restore_dir = os.path.join(workdir, 'restore')
+    shutil.rmtree(restore_dir, ignore_errors=True)
+    restore = measure([TOOLKIT_CMD, 'restore-backup', backup_name, restore_dir], env)
+    if restore['returncode'] == 0:
+        case['restore'] = phase_result(restore, stats)
+        restored = tree_stats(os.path.join(restore_dir, source.lstrip('/')))
+        if restored != stats:
+            case['error'] = f"restored tree differs: {restored} != {stats}"
+    else:
+        case['error'] = f"restore-backup failed: {restore['stderr'].strip()[-500:]}"
+
+    shutil.rmtree(restore_dir, ignore_errors=True)
+    subprocess.run(['rm', '-rf', backup_path])
+    return case
+
+
+def case_key(case):
+    return f"{case['profile']}/{case['codec']}/{case['engine']}"
+
+
+def flatten_metrics(case):
+    """Yield (name, value) pairs for every comparable metric in a case"""
+    for phase in ('backup', 'verify', 'restore'):
+        for metric, value in case.get(phase, {}).items():
+            if metric in METRIC_DIRECTIONS:
+                yield f'{phase}.{metric}', value
+    if case.get('compression_ratio') is not None:
+        yield 'compression_ratio', case['compression_ratio']
+
+
+def compare(results, baseline, threshold):
+    """Return a list of regressions of more than threshold (a fraction) against baseline"""
+    regressions = []
+    baseline_cases = {case_key(c): c for c in baseline.get('cases', [])}
+
+    for case in results['cases']:
+        base = baseline_cases.get(case_key(case))
+        if not base:
+            continue
+        base_metrics = dict(flatten_metrics(base))
+        for name, value in flatten_metrics(case):
+            old = base_metrics.get(name)
+            if not old or value is None:
+                continue
+            direction = METRIC_DIRECTIONS[name.split('.')[-1]]
+            change = (value - old) / old
+            if (direction == 'higher' and change < -threshold) or (direction == 'lower' and change > threshold):
+                regressions.append({
+                    'case': case_key(case),
+                    'metric': name,
+                    'baseline': old,
+                    'current': value,
+                    'change_percent': round(change * 100, 1),
+                })
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=PROJECT_DIR, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_summary(results):
+    print()
+    print(f"{'case':<36} {'backup MB/s':>12} {'files/s':>10} {'cpu s':>8} {'rss MB':>8} {'ratio':>7} {'restore MB/s':>13}")
+    for case in results['cases']:
+        if 'error' in case:
+            print(f"{case_key(case):<36} ERROR: {case['error']}")
+            continue
+        backup = case['backup']
+        print(f"{case_key(case):<36} {backup['mb_per_s']:>12} {backup['files_per_s']:>10} "
+              f"{backup['cpu_seconds']:>8} {backup['peak_rss_kb'] // 1024:>8} "
+              f"{case['compression_ratio'] or '-':>7} {case.get('restore', {}).get('mb_per_s', '-'):>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark toolkit backup, verify and restore throughput')
+    parser.add_argument('--workdir', default=os.path.abspath('benchmark-work'),
+                        help='Directory for synthetic trees, backups and restores (default: ./benchmark-work)')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='Comma-separated tree profiles')
+    parser.add_argument('--codecs', default=','.join(CODECS), help='Comma-separated codecs')
+    parser.add_argument('--engines', default=','.join(ENGINES), help='Comma-separated engines')
+    parser.add_argument('--scale', type=float, default=0.1, help='Tree size multiplier (1.0 = full size)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for tree generation')
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='Compare against a stored results file')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Regression threshold in percent')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    # Trees under an excluded path would archive empty
+    rule = excludes.ExcludePolicy.load(os.environ.get('EXCLUDES_FILE')).path_rule(workdir)
+    if rule:
+        print(f"Error: {workdir} is excluded from toolkit backups ({rule}); choose another --workdir",
+              file=sys.stderr)
+        sys.exit(2)
+
+    profiles = [p for p in args.profiles.split(',') if p]
+    engines = [e for e in args.engines.split(',') if e]
+    codecs = []
+    for codec in (c for c in args.codecs.split(',') if c):
+        binary = CODECS.get(codec, codec)
+        if binary and not shutil.which(binary):
+            print(f"Skipping codec {codec}: {binary} not installed")
+            continue
+        codecs.append(codec)
+
+    for name, known in (('profile', PROFILES), ('engine', ENGINES)):
+        for value in (profiles if name == 'profile' else engines):
+            if value not in known:
+                print(f"Error: unknown {name} {value}", file=sys.stderr)
+                sys.exit(2)
+
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'kernel': platform.release(),
+        'cpus': os.cpu_count(),
+        'revision': git_revision(),
+        'params': {'seed': args.seed, 'scale': args.scale},
+        'cases': [],
+    }
+
+    for engine, binary in UNCOMPRESSED_ENGINES.items():
+        if engine in engines and not shutil.which(binary):
+            print(f"Skipping engine {engine}: {binary} not installed")
+            engines.remove(engine)
+
+    for profile in profiles:
+        source, stats = build_tree(workdir, profile, args.seed, args.scale)
+        for index, codec in enumerate(codecs):
+            for engine in engines:
+                case_codec = codec
+                if engine in UNCOMPRESSED_ENGINES:
+                    if index:
+                        continue
+                    case_codec = 'none'
+                print(f"Running {profile}/{case_codec}/{engine}...")
+                results['cases'].append(run_case(workdir, profile, source, stats, case_codec, engine))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_summary(results)
+    print(f"\nResults written to {args.output}")
+
+    failed = [c for c in results['cases'] if 'error' in c]
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold / 100)
+        results['regressions'] = regressions
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold}% against {args.baseline}:")
+            for r in regressions:
+                print(f"  {r['case']} {r['metric']}: {r['baseline']} -> {r['current']} ({r['change_percent']:+}%)")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.threshold}% against {args.baseline}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
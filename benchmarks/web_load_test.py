@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Load-test and latency benchmark for the web interface
+
+Starts web-interface/app.py in a separate process against a throwaway
+toolkit directory, with timeshift, nvidia-smi, sensors, lvs, sudo and the
+toolkit CLI replaced by fast fakes (optionally with added latency), then
+drives it with N concurrent clients and reports per-endpoint latency
+percentiles, histograms and throughput.
+
+    ./benchmarks/web_load_test.py --concurrency 1,8,32 --duration 20
+    ./benchmarks/web_load_test.py --latency toolkit=0.5,nvidia-smi=0.2
+    ./benchmarks/web_load_test.py --server processes --workers 4
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+WEB_DIR = os.path.join(PROJECT_DIR, 'web-interface')
+
+DEFAULT_ENDPOINTS = ['/', '/backups', '/api/status', '/api/logs/{toolkit_log}']
+
+# Upper bounds (milliseconds) of the latency histogram buckets
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+FAKE_TOOLS = ('toolkit', 'timeshift', 'nvidia-smi', 'sensors', 'lvs', 'lspci', 'sudo')
+
+SERVER_BOOTSTRAP = '''
+import sys
+sys.path.insert(0, {web_dir!r})
+from werkzeug.serving import run_simple
+import app
+run_simple({host!r}, {port}, app.app, threaded={threaded}, processes={processes})
+'''
+
+
+def fake_script(body, latency):
+    sleep = f'sleep {latency}\n' if latency else ''
+    return f'#!/bin/bash\n{sleep}{body}\n'
+
+
+def build_fake_toolkit(root, latencies, backups, snapshots, log_lines):
+    """Create a toolkit directory and a bin directory of stand-in commands"""
+    bin_dir = os.path.join(root, 'bin')
+    toolkit_dir = os.path.join(root, 'toolkit')
+    for directory in (bin_dir, os.path.join(toolkit_dir, 'logs'), os.path.join(toolkit_dir, 'shared-data'),
+                      os.path.join(toolkit_dir, 'web-interface')):
+        os.makedirs(directory, exist_ok=True)
+
+    backup_lines = ''.join(
+        f'   * full-backup-2025{(i % 12) + 1:02d}{(i % 28) + 1:02d}_{i % 24:02d}0000.tar.gz\\n'
+        f'     Size: {(i % 40) + 1}G\\n'
+        for i in range(backups)
+    )
+    toolkit_body = f'''case "$1" in
+    list-backups)
+        printf '[INFO] Full System Backups:\\n====================\\n{backup_lines}'
+        ;;
+    disk-usage)
+        printf 'Overall Disk Usage:\\nFilesystem Size Used Avail Use%% Mounted on\\n/dev/sda1 100G 40G 60G 40%% /\\n'
+        ;;
+    *)
+        echo "fake toolkit: $*"
+        ;;
+esac'''
+    tools = {
+        'toolkit': (os.path.join(toolkit_dir, 'system-restore-toolkit'), toolkit_body),
+        'timeshift': (os.path.join(bin_dir, 'timeshift'), 'echo "Num Name Tags Description"'),
+        'nvidia-smi': (os.path.join(bin_dir, 'nvidia-smi'),
+                       'echo "NVIDIA GeForce RTX 4090, 24564, 1024, 23540, 3, 1, 41, 30.50, 450.00"'),
+        'sensors': (os.path.join(bin_dir, 'sensors'),
+                    'printf "Core 0:        +45.0°C\\nCore 1:        +47.0°C\\n"'),
+        'lvs': (os.path.join(bin_dir, 'lvs'), 'echo "  root ubuntu-vg -wi-ao---- 100.00g"'),
+        'lspci': (os.path.join(bin_dir, 'lspci'), 'echo "00:02.0 VGA compatible controller: Fake Graphics"'),
+        # Real sudo would prompt or fail inside the sandboxed run; the grep it wraps still runs
+        'sudo': (os.path.join(bin_dir, 'sudo'), 'exec "$@"'),
+    }
+    for name, (path, body) in tools.items():
+        with open(path, 'w') as f:
+            f.write(fake_script(body, latencies.get(name, 0)))
+        os.chmod(path, 0o755)
+
+    timeshift_info = {
+        'success': True,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'summary': [f'{snapshots} snapshots available'],
+        'snapshots': [
+            {'num': str(i), 'name': f'2025-01-{(i % 28) + 1:02d}_{i % 24:02d}-00-00', 'tags': 'O',
+             'description': f'Snapshot {i}'}
+            for i in range(snapshots)
+        ],
+    }
+    with open(os.path.join(toolkit_dir, 'shared-data', 'timeshift-info.json'), 'w') as f:
+        json.dump(timeshift_info, f)
+
+    toolkit_log = f'toolkit-{datetime.now().strftime("%Y%m%d")}.log'
+    with open(os.path.join(toolkit_dir, 'logs', toolkit_log), 'w') as f:
+        for i in range(log_lines):
+            f.write(f'[INFO] 2025-01-01 00:00:{i % 60:02d} Creating full system backup: line {i}\n')
+
+    return bin_dir, toolkit_dir, toolkit_log
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, bin_dir, toolkit_dir, port):
+    env = dict(os.environ)
+    env['TOOLKIT_DIR'] = toolkit_dir
+    if bin_dir:
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '--chdir', WEB_DIR, '-b', f'127.0.0.1:{port}', '-w', str(args.workers),
+                   '-k', 'gthread', '--threads', str(args.threads), 'app:app']
+    else:
+        threaded = args.server == 'threaded'
+        processes = args.workers if args.server == 'processes' else 1
+        code = SERVER_BOOTSTRAP.format(web_dir=WEB_DIR, host='127.0.0.1', port=port,
+                                       threaded=threaded, processes=processes)
+        command = [sys.executable, '-c', code]
+
+    log_path = os.path.join(os.path.dirname(toolkit_dir), 'server.log')
+    # The server writes through its own copy of the descriptor
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Web server exited early:\n{log_tail(log_path)}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    process.wait(timeout=10)
+    raise RuntimeError(f'Web server did not start within 30 seconds:\n{log_tail(log_path)}')
+
+
+def log_tail(path, lines=20):
+    """The end of the server's output; the log lives in the work directory, which is removed on exit"""
+    with open(path, errors='replace') as f:
+        return ''.join(f.readlines()[-lines:]).rstrip() or '(no output)'
+
+
+class Client(threading.Thread):
+    """One simulated dashboard user cycling through the endpoints"""
+
+    def __init__(self, port, endpoints, stop_at, offset, timeout):
+        super().__init__(daemon=True)
+        self.port = port
+        self.endpoints = endpoints
+        self.stop_at = stop_at
+        self.offset = offset
+        self.timeout = timeout
+        self.samples = []
+
+    def run(self):
+        connection = None
+        i = self.offset
+        while time.perf_counter() < self.stop_at:
+            path = self.endpoints[i % len(self.endpoints)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+                    connection.close()
+                    connection = None
+            except Exception as e:
+                status = type(e).__name__
+                if connection is not None:
+                    connection.close()
+                connection = None
+            self.samples.append((path, time.perf_counter() - start, status))
+        if connection is not None:
+            connection.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def summarise(samples, elapsed):
+    """Aggregate (path, seconds, status) samples into per-endpoint statistics"""
+    by_endpoint = {}
+    for path, seconds, status in samples:
+        by_endpoint.setdefault(path, []).append((seconds * 1000, status))
+
+    report = {}
+    for path, entries in sorted(by_endpoint.items()):
+        latencies = sorted(ms for ms, status in entries)
+        errors = sum(1 for ms, status in entries if not (isinstance(status, int) and status < 500))
+        histogram = {}
+        for ms in latencies:
+            bucket = next(b for b in HISTOGRAM_BUCKETS_MS if ms <= b)
+            label = 'inf' if bucket == float('inf') else f'{bucket:g}'
+            histogram[label] = histogram.get(label, 0) + 1
+        report[path] = {
+            'requests': len(entries),
+            'errors': errors,
+            'throughput_rps': round(len(entries) / elapsed, 2),
+            'min_ms': round(latencies[0], 2),
+            'mean_ms': round(sum(latencies) / len(latencies), 2),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p90_ms': round(percentile(latencies, 0.90), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'max_ms': round(latencies[-1], 2),
+            'histogram_ms': histogram,
+        }
+    return report
+
+
+def run_level(port, endpoints, concurrency, duration, timeout):
+    stop_at = time.perf_counter() + duration
+    clients = [Client(port, endpoints, stop_at, i, timeout) for i in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    samples = [s for client in clients for s in client.samples]
+    return {
+        'concurrency': concurrency,
+        'duration_seconds': round(elapsed, 2),
+        'total_requests': len(samples),
+        'throughput_rps': round(len(samples) / elapsed, 2),
+        'endpoints': summarise(samples, elapsed),
+    }
+
+
+def print_level(level):
+    print(f"\nConcurrency {level['concurrency']}: {level['total_requests']} requests, "
+          f"{level['throughput_rps']} req/s")
+    print(f"  {'endpoint':<32} {'reqs':>7} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for path, stats in level['endpoints'].items():
+        print(f"  {path:<32} {stats['requests']:>7} {stats['errors']:>5} {stats['throughput_rps']:>8} "
+              f"{stats['p50_ms']:>9} {stats['p90_ms']:>9} {stats['p99_ms']:>9} {stats['max_ms']:>9}")
+
+
+def parse_latencies(value):
+    latencies = {}
+    for item in filter(None, (value or '').split(',')):
+        name, _, seconds = item.partition('=')
+        if name not in FAKE_TOOLS:
+            raise SystemExit(f"Unknown fake tool {name!r}; choose from {', '.join(FAKE_TOOLS)}")
+        latencies[name] = float(seconds)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the toolkit web interface')
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma-separated client counts to run in turn')
+    parser.add_argument('--duration', type=float, default=15, help='Seconds per concurrency level')
+    parser.add_argument('--endpoints', help='Comma-separated paths (default: dashboard, backups, status, a log)')
+    parser.add_argument('--latency', help='Added latency per fake, e.g. toolkit=0.5,nvidia-smi=0.2')
+    parser.add_argument('--real-tools', action='store_true', help='Use the host tools instead of fakes')
+    parser.add_argument('--backups', type=int, default=50, help='Backups reported by the fake toolkit')
+    parser.add_argument('--snapshots', type=int, default=200, help='Timeshift snapshots in the fake data file')
+    parser.add_argument('--log-lines', type=int, default=5000, help='Lines in the fake toolkit log')
+    parser.add_argument('--server', choices=['threaded', 'single', 'processes', 'gunicorn'], default='threaded',
+                        help='How to serve the app (werkzeug threaded/single/forking, or gunicorn)')
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes for processes/gunicorn')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker')
+    parser.add_argument('--timeout', type=float, default=60, help='Per-request client timeout in seconds')
+    parser.add_argument('--output', default='web-load-results.json', help='JSON results file')
+    args = parser.parse_args()
+
+    if args.server == 'gunicorn' and not shutil.which('gunicorn'):
+        raise SystemExit('gunicorn is not installed')
+
+    workdir = tempfile.mkdtemp(prefix='srt-load-')
+    try:
+        bin_dir, toolkit_dir, toolkit_log = build_fake_toolkit(
+            workdir, parse_latencies(args.latency), args.backups, args.snapshots, args.log_lines)
+        if args.real_tools:
+            bin_dir = None
+
+        endpoints = (args.endpoints.split(',') if args.endpoints else DEFAULT_ENDPOINTS)
+        endpoints = [e.format(toolkit_log=toolkit_log) for e in endpoints]
+
+        port = free_port()
+        server = start_server(args, bin_dir, toolkit_dir, port)
+        try:
+            # Warm up imports, template compilation and the first subprocess forks
+            run_level(port, endpoints, 1, 1, args.timeout)
+
+            results = {
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'server': args.server,
+                'workers': args.workers,
+                'fakes': not args.real_tools,
+                'latency': parse_latencies(args.latency),
+                'levels': [],
+            }
+            for concurrency in (int(c) for c in args.concurrency.split(',') if c):
+                level = run_level(port, endpoints, concurrency, args.duration, args.timeout)
+                results['levels'].append(level)
+                print_level(level)
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
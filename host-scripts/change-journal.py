@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Host-side change journal daemon for incremental backup scans
+
+Records every path that changes under --root into BACKUP_DIR/.toolkit/journal/
+(format in lib/journal.py), so estimate-backup and create-backup can skip
+walking the whole tree. Uses fanotify filesystem marks when the kernel and
+privileges allow it (Linux 5.9+, CAP_SYS_ADMIN). Otherwise it falls back to
+recursive inotify watches, which need one watch per directory
+(fs.inotify.max_user_watches).
+
+Paths excluded unconditionally by the exclude policy, and BACKUP_DIR itself,
+are not journaled. A queue overflow is recorded as a gap, and the next scan
+walks the tree again.
+
+Usage:
+    sudo host-scripts/change-journal.py [--root /] [--backup-dir DIR] [--backend auto|fanotify|inotify]
+"""
+
+import argparse
+import ctypes
+import errno
+import os
+import select
+import signal
+import struct
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(SCRIPT_DIR), 'lib'))
+
+import excludes  # noqa: E402
+import journal  # noqa: E402
+import scanner  # noqa: E402
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+# Filesystems whose contents are never backed up
+PSEUDO_FILESYSTEMS = frozenset((
+    'proc', 'sysfs', 'devtmpfs', 'devpts', 'tmpfs', 'cgroup', 'cgroup2', 'securityfs', 'debugfs',
+    'tracefs', 'configfs', 'fusectl', 'mqueue', 'hugetlbfs', 'pstore', 'bpf', 'autofs',
+    'binfmt_misc', 'nsfs', 'efivarfs', 'rpc_pipefs',
+))
+
+MOUNT_CHECK_SECONDS = 30
+
+# fanotify (linux/fanotify.h)
+FAN_CLOEXEC = 0x1
+FAN_NONBLOCK = 0x2
+FAN_CLASS_NOTIF = 0x0
+FAN_UNLIMITED_QUEUE = 0x10
+FAN_REPORT_DFID_NAME = 0x400 | 0x800
+FAN_MARK_ADD = 0x1
+FAN_MARK_FILESYSTEM = 0x100
+FAN_MODIFY = 0x2
+FAN_ATTRIB = 0x4
+FAN_CLOSE_WRITE = 0x8
+FAN_MOVED_FROM = 0x40
+FAN_MOVED_TO = 0x80
+FAN_CREATE = 0x100
+FAN_DELETE = 0x200
+FAN_Q_OVERFLOW = 0x4000
+FAN_ONDIR = 0x40000000
+FAN_EVENT_INFO_TYPE_FID = 1
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+FAN_EVENT_INFO_TYPE_DFID = 3
+FAN_MASK = (FAN_MODIFY | FAN_ATTRIB | FAN_CLOSE_WRITE | FAN_MOVED_FROM | FAN_MOVED_TO
+            | FAN_CREATE | FAN_DELETE | FAN_ONDIR)
+AT_FDCWD = -100
+O_PATH = 0o10000000
+
+FAN_METADATA = struct.Struct('<IBBHQii')
+FAN_INFO_HEADER = struct.Struct('<BBH')
+FSID = struct.Struct('<II')
+HANDLE_HEADER = struct.Struct('<Ii')
+
+# inotify (linux/inotify.h)
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+           | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+INOTIFY_EVENT = struct.Struct('<iIII')
+
+TREE_CHANGES = (FAN_CREATE | FAN_DELETE | FAN_MOVED_FROM | FAN_MOVED_TO)
+
+
+def _check(result, what):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, f'{what}: {os.strerror(code)}')
+    return result
+
+
+def _unescape(field):
+    """Undo the octal escapes /proc/self/mounts uses for spaces and tabs"""
+    return field.encode().decode('unicode_escape').encode('latin-1').decode('utf-8', 'surrogateescape')
+
+
+def list_mounts(root, skip):
+    """Mountpoints of real filesystems at or below root"""
+    mounts = []
+    with open('/proc/self/mounts') as f:
+        for line in f:
+            fields = line.split()
+            mountpoint, fstype = _unescape(fields[1]), fields[2]
+            if fstype in PSEUDO_FILESYSTEMS or skip(mountpoint):
+                continue
+            if root == '/' or mountpoint == root or mountpoint.startswith(root + '/'):
+                mounts.append(mountpoint)
+    if root not in mounts and not any(root.startswith(m.rstrip('/') + '/') for m in mounts):
+        mounts.insert(0, root)
+    return mounts
+
+
+class Fanotify:
+    """Filesystem-wide marks reporting the parent directory handle and name of each change"""
+
+    name = 'fanotify'
+
+    def __init__(self, root, skip):
+        self.skip = skip
+        self.fd = _check(libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC | FAN_NONBLOCK | FAN_UNLIMITED_QUEUE
+                                            | FAN_REPORT_DFID_NAME, os.O_RDONLY | os.O_LARGEFILE),
+                         'fanotify_init')
+        self.mount_fds = {}
+        self.directories = {}
+        for mountpoint in list_mounts(root, skip):
+            self.add_mount(mountpoint)
+
+    def add_mount(self, mountpoint):
+        fsid = os.statvfs(mountpoint).f_fsid
+        if fsid in self.mount_fds:
+            return
+        _check(libc.fanotify_mark(self.fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, ctypes.c_uint64(FAN_MASK),
+                                  AT_FDCWD, os.fsencode(mountpoint)), f'fanotify_mark {mountpoint}')
+        self.mount_fds[fsid] = os.open(mountpoint, os.O_RDONLY | os.O_DIRECTORY)
+
+    def _directory(self, fsid, handle):
+        """Path of the directory a file handle refers to (None once it is gone)"""
+        path = self.directories.get(handle)
+        if path is not None:
+            return path
+        mount_fd = self.mount_fds.get(fsid)
+        if mount_fd is None:
+            return None
+        fd = libc.open_by_handle_at(mount_fd, ctypes.c_char_p(handle), O_PATH)
+        if fd < 0:
+            return None
+        try:
+            path = os.readlink(f'/proc/self/fd/{fd}')
+        finally:
+            os.close(fd)
+        if path.endswith(' (deleted)'):
+            return None
+        if len(self.directories) > 100000:
+            self.directories.clear()
+        self.directories[handle] = path
+        return path
+
+    def read(self, writer):
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + FAN_METADATA.size <= len(data):
+            event_len, _, _, metadata_len, mask, fd, _ = FAN_METADATA.unpack_from(data, offset)
+            if fd >= 0:
+                os.close(fd)
+            if mask & FAN_Q_OVERFLOW:
+                writer.gap('fanotify queue overflow')
+            info = offset + metadata_len
+            while info + FAN_INFO_HEADER.size <= offset + event_len:
+                info_type, _, info_len = FAN_INFO_HEADER.unpack_from(data, info)
+                if info_type in (FAN_EVENT_INFO_TYPE_FID, FAN_EVENT_INFO_TYPE_DFID_NAME, FAN_EVENT_INFO_TYPE_DFID):
+                    self._record(writer, data, info, info_type, info_len, mask)
+                info += info_len or event_len
+            offset += event_len or len(data)
+
+    def _record(self, writer, data, info, info_type, info_len, mask):
+        start = info + FAN_INFO_HEADER.size
+        val0, val1 = FSID.unpack_from(data, start)
+        handle_bytes, _ = HANDLE_HEADER.unpack_from(data, start + FSID.size)
+        handle_start = start + FSID.size
+        handle_end = handle_start + HANDLE_HEADER.size + handle_bytes
+        directory = self._directory(val0 | val1 << 32, bytes(data[handle_start:handle_end]))
+        if directory is None:
+            # The directory is gone; its own deletion is journaled from its parent
+            return
+        path = directory
+        if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+            name = data[handle_end:info + info_len].split(b'\0', 1)[0]
+            if name and name != b'.':
+                path = os.path.join(directory, os.fsdecode(name))
+        if self.skip(path):
+            return
+        if mask & FAN_ONDIR and mask & TREE_CHANGES:
+            if mask & (FAN_MOVED_FROM | FAN_MOVED_TO):
+                # Cached handle paths below a renamed directory are stale
+                self.directories.clear()
+            writer.add(path, journal.SUBTREE)
+        else:
+            writer.add(path, journal.FILE)
+
+
+class Inotify:
+    """One inotify watch per directory, added as directories appear"""
+
+    name = 'inotify'
+
+    def __init__(self, root, skip, policy, writer):
+        self.skip = skip
+        self.policy = policy
+        self.writer = writer
+        self.fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC), 'inotify_init1')
+        self.paths = {}
+        # The walk crosses into the mounts below root, unlike a filesystem mark
+        self.watch_tree(root)
+
+    def add_mount(self, mountpoint):
+        self.watch_tree(mountpoint)
+
+    def watch_tree(self, top):
+        try:
+            for entry in scanner.scan(top, self.policy):
+                if entry.is_dir and not self.skip(entry.path):
+                    self._watch(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def _watch(self, path):
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), IN_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                self.writer.incomplete('out of inotify watches; raise fs.inotify.max_user_watches')
+            return
+        self.paths[wd] = path
+
+    def read(self, writer):
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].split(b'\0', 1)[0]
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                writer.gap('inotify queue overflow')
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            if self.skip(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files created before the new watches exist are covered by the subtree record
+                self.watch_tree(path)
+                writer.add(path, journal.SUBTREE)
+            elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                writer.add(path, journal.SUBTREE)
+            elif not mask & IN_DELETE_SELF:
+                writer.add(path, journal.FILE)
+
+
+def make_skip(root, policy, backup_dir):
+    """Predicate for paths never worth journaling; cached per directory"""
+    backup_dir = os.path.realpath(backup_dir)
+    cache = {}
+
+    def skip(path):
+        if root != '/' and path != root and not path.startswith(root + '/'):
+            return True
+        if path == backup_dir or path.startswith(backup_dir + '/'):
+            return True
+        directory = os.path.dirname(path)
+        excluded = cache.get(directory)
+        if excluded is None:
+            if len(cache) > 100000:
+                cache.clear()
+            excluded = cache[directory] = policy.path_rule(directory) is not None
+        return excluded or policy.path_rule(path) is not None
+
+    return skip
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Journal filesystem changes for incremental backup scans')
+    parser.add_argument('--root', default='/', help='Tree to watch (default /)')
+    parser.add_argument('--backup-dir', default=os.environ.get('BACKUP_DIR', '/var/backups/system-restore-toolkit'))
+    parser.add_argument('--config', default=os.environ.get('EXCLUDES_FILE') or excludes.DEFAULT_CONFIG)
+    parser.add_argument('--backend', choices=['auto', 'fanotify', 'inotify'], default='auto')
+    parser.add_argument('--max-bytes', type=int, default=256 * 1024 ** 2,
+                        help='Journal size after compaction that forces a full rescan')
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    policy = excludes.ExcludePolicy.load(args.config)
+    skip = make_skip(root, policy, args.backup_dir)
+    directory = journal.journal_dir(args.backup_dir)
+
+    backend = None
+    if args.backend in ('auto', 'fanotify'):
+        try:
+            backend = Fanotify(root, skip)
+        except OSError as e:
+            if args.backend == 'fanotify':
+                print(f'fanotify unavailable: {e}', file=sys.stderr)
+                sys.exit(1)
+            print(f'fanotify unavailable ({e}); falling back to inotify', file=sys.stderr)
+    writer = journal.JournalWriter(directory, root, backend.name if backend else 'inotify',
+                                   policy.config_fingerprint, max_bytes=args.max_bytes)
+    if backend is None:
+        try:
+            backend = Inotify(root, skip, policy, writer)
+        except OSError as e:
+            writer.incomplete(str(e))
+            print(f'inotify unavailable: {e}', file=sys.stderr)
+            sys.exit(1)
+    print(f'Journaling changes under {root} with {backend.name} into {directory}', file=sys.stderr)
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    poller = select.poll()
+    poller.register(backend.fd, select.POLLIN)
+    mounts = set(list_mounts(root, skip))
+    last_flush = last_mount_check = time.monotonic()
+    while running:
+        try:
+            if poller.poll(journal.FLUSH_SECONDS * 1000):
+                backend.read(writer)
+        except InterruptedError:
+            continue
+        now = time.monotonic()
+        if now - last_mount_check >= MOUNT_CHECK_SECONDS:
+            last_mount_check = now
+            current = set(list_mounts(root, skip))
+            for mountpoint in sorted(current - mounts):
+                try:
+                    backend.add_mount(mountpoint)
+                except OSError as e:
+                    writer.incomplete(f'cannot watch new mount {mountpoint}: {e}')
+                writer.add(mountpoint, journal.SUBTREE)
+            mounts = current
+        if now - last_flush >= journal.FLUSH_SECONDS:
+            last_flush = now
+            writer.flush()
+    writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,564 @@
+#!/usr/bin/env python3
+"""
+Sharded multi-stream archives for the System Restore Toolkit
+
+A single tar process reads one file at a time, so on trees with millions of
+small files a backup is bound by per-file syscall latency rather than disk
+bandwidth. This module splits the paths kept by the exclude policy into N
+shards of similar cost and archives them with N concurrent tar processes
+into one backup directory:
+
+    full-backup-<ts>.shards/
+        manifest.json               codec, per-segment entries, bytes, timings, sha256
+        stream-000.0000.tar.gz ...  files, symlinks and devices
+        stream-000-raw.0000.tar ... incompressible files, stored without a codec
+        dirs.0000.tar.gz            every directory entry, restored last
+
+Files are grouped by parent directory, so each stream still reads whole
+directories in order; a directory holding more than its share is sliced.
+A group costs its bytes plus PER_FILE_COST per entry, and groups go
+largest-first to the least loaded stream. All names of a hardlinked file
+share a group, so tar keeps them linked. Directory entries get their own
+stream, extracted after the others. That way permissions and mtimes set by
+tar are not disturbed by files still being written into them.
+
+Unless --no-adaptive is given, files are first sorted by classify.py.
+Already-compressed content (media, packages, image layers, high-entropy
+data) goes to a raw stream of the same shard instead of through the
+compressor. The manifest and the catalog record bytes per class, plus the
+ratio and CPU time of the compressed and the stored streams.
+
+Each stream is written as a series of segments of about SEGMENT_BYTES,
+cut between groups. The archive is built in OUTPUT.partial. Its
+checkpoint.json holds the plan, and after each segment it records the
+segment's path range, size and sha256 and the stream's offset. When a run
+is killed, `create --resume` re-checks the finished segments against their
+checksums and archives only the rest. Files changed in the meantime are
+picked up by the segments still to be written.
+
+Usage:
+    archive.py create --output DIR --codec gzip --streams 8 (--list FILE | --source / [--exclude ...])
+                      [--no-adaptive] [--segment-bytes N] [--resume]
+    archive.py verify DIR [--workers N]
+    archive.py restore DIR TARGET [--workers N]
+    archive.py info DIR [--format json|shell]
+"""
+
+import argparse
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import catalog
+import classify
+import excludes
+import scanner
+
+MANIFEST = 'manifest.json'
+CHECKPOINT = 'checkpoint.json'
+
+# Per-stream compressors; the parallelism comes from the streams, so each
+# compressor runs single-threaded
+COMPRESSORS = {
+    'gzip': ('gzip', '.tar.gz'),
+    'zstd': ('zstd -T1', '.tar.zst'),
+    'xz': ('xz -T1', '.tar.xz'),
+    'none': (None, '.tar'),
+}
+
+# Cost of one entry in bytes: opening and stat-ing a file and writing its tar
+# header takes about as long as streaming 64KiB from a fast SSD
+PER_FILE_COST = 64 * 1024
+
+DEFAULT_STREAMS = min(8, os.cpu_count() or 2)
+
+# Streams are written as segments of about this cost, each checkpointed when done
+SEGMENT_BYTES = 1024 ** 3
+
+
+class Group:
+    """Paths archived together by one stream"""
+
+    __slots__ = ('paths', 'bytes', 'cost')
+
+    def __init__(self):
+        self.paths = []
+        self.bytes = 0
+        self.cost = 0
+
+    def add(self, path, size):
+        self.paths.append(path)
+        self.bytes += size
+        self.cost += size + PER_FILE_COST
+
+    def extend(self, other):
+        self.paths.extend(other.paths)
+        self.bytes += other.bytes
+        self.cost += other.cost
+
+
+def read_list(path):
+    """Paths from a NUL-separated list written by estimate.py --write-list"""
+    with open(path, 'rb') as f:
+        return [p.decode('utf-8', 'surrogateescape') for p in f.read().split(b'\0') if p]
+
+
+def stat_paths(paths, workers=scanner.DEFAULT_WORKERS):
+    """Yield scanner Entries for listed paths, calling lstat on a thread pool"""
+    def stat_chunk(chunk):
+        entries = []
+        for path in chunk:
+            try:
+                entries.append(scanner.lstat_entry(path))
+            except OSError:
+                continue
+        return entries
+
+    chunks = (paths[i:i + 1024] for i in range(0, len(paths), 1024))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entries in executor.map(stat_chunk, chunks):
+            yield from entries
+
+
+def plan(entries, streams, classes=None):
+    """Split entries into at most `streams` shards plus a list of directories.
+
+    Each shard maps a stream kind ('compress', or 'store' for content the
+    classifier found incompressible) to its list of Groups.
+    """
+    classes = classes or {}
+    dirs = []
+    directories = {}
+    sliceable = {}
+    link_owner = {}
+    for entry in entries:
+        if entry.is_dir:
+            dirs.append(entry.path)
+            continue
+        key = (os.path.dirname(entry.path),
+               'store' if classes.get(entry.path) in classify.INCOMPRESSIBLE else 'compress')
+        size = entry.size
+        if entry.nlink > 1:
+            inode = (entry.dev, entry.ino)
+            if inode in link_owner:
+                # Later names are stored as tar link records next to the first
+                key, size = link_owner[inode], 0
+            else:
+                link_owner[inode] = key
+            sliceable[key] = False
+        directories.setdefault(key, []).append((entry.path, size))
+
+    total = sum(size + PER_FILE_COST for items in directories.values() for _, size in items)
+    # Slice directories bigger than a quarter of a stream's share
+    limit = max(total // (streams * 4), PER_FILE_COST)
+    groups = []
+    for key, items in directories.items():
+        group = Group()
+        for path, size in items:
+            if group.paths and group.cost + size + PER_FILE_COST > limit and sliceable.get(key, True):
+                groups.append((key[1], group))
+                group = Group()
+            group.add(path, size)
+        groups.append((key[1], group))
+
+    shards = [{} for _ in range(streams)]
+    heap = [(0, index) for index in range(streams)]
+    for kind, group in sorted(groups, key=lambda g: g[1].cost, reverse=True):
+        load, index = heapq.heappop(heap)
+        shards[index].setdefault(kind, []).append(group)
+        heapq.heappush(heap, (load + group.cost, index))
+    return [shard for shard in shards if shard], dirs
+
+
+def class_stats(entries, classes):
+    """Files and bytes per classifier class"""
+    stats = {}
+    for entry in entries:
+        cls = classes.get(entry.path)
+        if cls:
+            totals = stats.setdefault(cls, {'files': 0, 'bytes': 0})
+            totals['files'] += 1
+            totals['bytes'] += entry.size
+    return stats
+
+
+def _write_list(path, paths):
+    with open(path, 'wb') as f:
+        for item in paths:
+            f.write(item.encode('utf-8', 'surrogateescape') + b'\0')
+
+
+def _tar_command(codec, *args):
+    program = COMPRESSORS[codec][0]
+    command = ['tar']
+    if program:
+        command.append(f'--use-compress-program={program}')
+    return command + list(args)
+
+
+def _run_stream(command):
+    started = time.monotonic()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result, time.monotonic() - started
+
+
+def _run_measured(command, pass_fds=()):
+    """Run a tar stream; returns (returncode, stderr, wall seconds, CPU seconds incl. the compressor)"""
+    started = time.monotonic()
+    with tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=err, pass_fds=pass_fds)
+        # wait4 reports the usage of tar and of the compressor it reaped
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        err.seek(0)
+        stderr = err.read()
+    return process.returncode, stderr, time.monotonic() - started, usage.ru_utime + usage.ru_stime
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _segments(groups, limit):
+    """Cut a stream's groups into segments costing about `limit`, never splitting a group"""
+    segment = Group()
+    for group in groups:
+        if segment.paths and segment.cost + group.cost > limit:
+            yield segment
+            segment = Group()
+        segment.extend(group)
+    yield segment
+
+
+@contextmanager
+def _exclusive(partial):
+    """Hold the partial directory's lock so two runs never write the same segments.
+
+    Yields the lock's descriptor. tar children inherit it, so the lock stays
+    held by a killed run's orphans until they exit.
+    """
+    with open(os.path.join(partial, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f'{partial} is being written by another process') from None
+        yield lock.fileno()
+
+
+def _new_checkpoint(partial, codec, streams, entries, adaptive, segment_bytes):
+    """Plan the archive and write every segment's path list; returns the checkpoint"""
+    # Segments left by an earlier plan would end up in the backup directory
+    for name in os.listdir(partial):
+        if name != '.lock':
+            os.unlink(os.path.join(partial, name))
+    started = time.monotonic()
+    entries = list(entries)
+    classes = classify.classify_entries(entries) if adaptive and codec != 'none' else {}
+    shards, dirs = plan(entries, streams, classes)
+
+    dir_group = Group()
+    for path in dirs:
+        dir_group.add(path, 0)
+    # Directory entries are tiny, so they always fit one segment
+    layout = [('dirs', codec, [dir_group], float('inf'))]
+    for index, shard in enumerate(shards):
+        if 'compress' in shard:
+            layout.append((f'stream-{index:03d}', codec, shard['compress'], segment_bytes))
+        if 'store' in shard:
+            layout.append((f'stream-{index:03d}-raw', 'none', shard['store'], segment_bytes))
+
+    checkpoint = {'version': 1, 'codec': codec, 'adaptive': bool(classes),
+                  'classes': class_stats(entries, classes), 'streams': []}
+    for name, stream_codec, groups, limit in layout:
+        segments = []
+        for number, segment in enumerate(_segments(groups, limit)):
+            segment_name = f'{name}.{number:04d}'
+            _write_list(os.path.join(partial, f'.{segment_name}.list'), segment.paths)
+            segments.append({
+                'file': segment_name + COMPRESSORS[stream_codec][1],
+                'list': f'.{segment_name}.list',
+                'entries': len(segment.paths),
+                'source_bytes': segment.bytes,
+                # Completed path range; lists are in plan order, not sorted
+                'first': segment.paths[0] if segment.paths else None,
+                'last': segment.paths[-1] if segment.paths else None,
+                'done': False,
+            })
+        checkpoint['streams'].append({'name': name, 'codec': stream_codec, 'offset': 0, 'segments': segments})
+    checkpoint['plan_seconds'] = round(time.monotonic() - started, 3)
+    catalog.write_json_atomic(os.path.join(partial, CHECKPOINT), checkpoint)
+    return checkpoint
+
+
+def _validate(partial, checkpoint):
+    """Re-check completed segments against their checksums; returns how many can be kept"""
+    kept = 0
+    for stream in checkpoint['streams']:
+        stream['offset'] = 0
+        for segment in stream['segments']:
+            if not segment['done']:
+                continue
+            path = os.path.join(partial, segment['file'])
+            try:
+                segment['done'] = (os.path.getsize(path) == segment['archive_bytes']
+                                   and _sha256(path) == segment['sha256'])
+            except OSError:
+                segment['done'] = False
+            if segment['done']:
+                stream['offset'] += segment['archive_bytes']
+                kept += 1
+    return kept
+
+
+def _write_stream(partial, stream, checkpoint, lock, lock_fd):
+    """Archive a stream's pending segments in order, checkpointing after each one"""
+    for segment in stream['segments']:
+        if segment['done']:
+            continue
+        archive_path = os.path.join(partial, segment['file'])
+        returncode, stderr, seconds, cpu = _run_measured(_tar_command(
+            stream['codec'], '--null', '--no-recursion', '--ignore-failed-read',
+            '-T', os.path.join(partial, segment['list']), '-cf', archive_path), pass_fds=(lock_fd,))
+        if returncode != 0:
+            return f"{segment['file']}: {stderr.decode(errors='replace').strip()[-300:]}"
+        archive_bytes = os.path.getsize(archive_path)
+        checksum = _sha256(archive_path)
+        with lock:
+            segment.update(done=True, seconds=round(seconds, 3), cpu_seconds=round(cpu, 3),
+                           archive_bytes=archive_bytes, sha256=checksum)
+            stream['offset'] += archive_bytes
+            catalog.write_json_atomic(os.path.join(partial, CHECKPOINT), checkpoint)
+    return None
+
+
+def create(output, codec, streams, entries, adaptive=True, segment_bytes=SEGMENT_BYTES, resume=False):
+    """Archive entries into output/ with concurrent tar streams; returns the manifest.
+
+    Progress is checkpointed per segment in OUTPUT.partial. With resume=True
+    the checkpoint there is continued and `entries` is ignored.
+    """
+    if codec not in COMPRESSORS:
+        raise ValueError(f'Unknown codec: {codec}')
+    started = time.monotonic()
+    partial = output.rstrip('/') + '.partial'
+    checkpoint_path = os.path.join(partial, CHECKPOINT)
+    if resume and not os.path.exists(checkpoint_path):
+        raise RuntimeError(f'No checkpoint to resume in {partial}')
+    os.makedirs(partial, exist_ok=True)
+    with _exclusive(partial) as lock_fd:
+        if resume:
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            resumed = _validate(partial, checkpoint)
+        else:
+            checkpoint = _new_checkpoint(partial, codec, streams, entries, adaptive, segment_bytes)
+            resumed = 0
+
+        lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=len(checkpoint['streams'])) as executor:
+            failed = [error for error in executor.map(
+                lambda stream: _write_stream(partial, stream, checkpoint, lock, lock_fd),
+                checkpoint['streams']) if error]
+        if failed:
+            raise RuntimeError('tar failed for ' + '; '.join(failed) + f' (resumable from {partial})')
+
+        manifest = {'version': 1, 'codec': checkpoint['codec'], 'adaptive': checkpoint['adaptive'],
+                    'plan_seconds': checkpoint['plan_seconds'], 'resumed_segments': resumed,
+                    'streams': [], 'dirs': None}
+        for stream in checkpoint['streams']:
+            for segment in stream['segments']:
+                os.unlink(os.path.join(partial, segment['list']))
+                info = {'file': segment['file'], 'codec': stream['codec'], 'entries': segment['entries'],
+                        'seconds': segment['seconds'], 'cpu_seconds': segment['cpu_seconds'],
+                        'archive_bytes': segment['archive_bytes'], 'sha256': segment['sha256']}
+                if stream['name'] == 'dirs':
+                    manifest['dirs'] = info
+                else:
+                    info.update(stream=stream['name'], source_bytes=segment['source_bytes'])
+                    manifest['streams'].append(info)
+
+        all_streams = manifest['streams'] + [manifest['dirs']]
+        manifest['archive_bytes'] = sum(s['archive_bytes'] for s in all_streams)
+        manifest['cpu_seconds'] = round(sum(s['cpu_seconds'] for s in all_streams), 3)
+        manifest['compression'] = compression_summary(manifest['streams'])
+        manifest['classes'] = checkpoint['classes']
+        manifest['seconds'] = round(time.monotonic() - started, 3)
+        catalog.write_json_atomic(os.path.join(partial, MANIFEST), manifest)
+        os.unlink(checkpoint_path)
+        os.unlink(os.path.join(partial, '.lock'))
+    os.rename(partial, output)
+    return manifest
+
+
+def compression_summary(streams):
+    """Ratio and CPU time of the compressed streams versus the ones stored raw"""
+    summary = {}
+    for stream in streams:
+        kind = 'stored' if stream['codec'] == 'none' else 'compressed'
+        totals = summary.setdefault(kind, {'source_bytes': 0, 'archive_bytes': 0, 'cpu_seconds': 0.0})
+        totals['source_bytes'] += stream['source_bytes']
+        totals['archive_bytes'] += stream['archive_bytes']
+        totals['cpu_seconds'] = round(totals['cpu_seconds'] + stream['cpu_seconds'], 3)
+    for totals in summary.values():
+        totals['ratio'] = round(totals['archive_bytes'] / totals['source_bytes'], 4) if totals['source_bytes'] else None
+    return summary
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def stream_count(manifest):
+    """Streams the archive was written with; a raw stream belongs to its shard's stream"""
+    return len({s['stream'] for s in manifest['streams']})
+
+
+def _parallel(commands, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_stream, commands))
+
+
+def verify(directory, workers=DEFAULT_STREAMS):
+    """Checksum and list every stream concurrently; returns (entries, errors)"""
+    manifest = load_manifest(directory)
+    streams = manifest['streams'] + [manifest['dirs']]
+    commands = [_tar_command(s.get('codec', manifest['codec']), '-tf', os.path.join(directory, s['file']))
+                for s in streams]
+    entries = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        checksums = list(executor.map(lambda s: _sha256(os.path.join(directory, s['file'])) if 'sha256' in s else None,
+                                      streams))
+    for stream, checksum in zip(streams, checksums):
+        if checksum and checksum != stream['sha256']:
+            errors.append(f"{stream['file']}: sha256 mismatch")
+    for stream, (result, _) in zip(streams, _parallel(commands, workers)):
+        listed = result.stdout.count(b'\n')
+        entries += listed
+        # No comparison with the planned entries: files deleted before their segment
+        # was written are skipped by --ignore-failed-read, and the sha256 covers the rest
+        if result.returncode != 0:
+            errors.append(f"{stream['file']}: {result.stderr.decode(errors='replace').strip()[-300:]}")
+    return entries, errors
+
+
+def restore(directory, target, workers=DEFAULT_STREAMS):
+    """Extract the file streams concurrently, then the directory stream"""
+    manifest = load_manifest(directory)
+    extract = ('--numeric-owner', '-xpf')
+    commands = [_tar_command(s.get('codec', manifest['codec']), *extract, os.path.join(directory, s['file']),
+                             '-C', target)
+                for s in manifest['streams']]
+    errors = []
+    for stream, (result, _) in zip(manifest['streams'], _parallel(commands, workers)):
+        if result.returncode != 0:
+            errors.append(f"{stream['file']}: {result.stderr.decode(errors='replace').strip()[-300:]}")
+    dirs = manifest['dirs']
+    result, _ = _run_stream(_tar_command(dirs.get('codec', manifest['codec']), *extract,
+                                         os.path.join(directory, dirs['file']), '-C', target))
+    if result.returncode != 0:
+        errors.append(f"{dirs['file']}: {result.stderr.decode(errors='replace').strip()[-300:]}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded multi-stream backup archives')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('create')
+    p.add_argument('--output', required=True, help='Backup directory to create (built as OUTPUT.partial)')
+    p.add_argument('--codec', default='gzip', choices=sorted(COMPRESSORS))
+    p.add_argument('--streams', type=int, default=DEFAULT_STREAMS)
+    p.add_argument('--list', help='NUL-separated paths from estimate.py --write-list')
+    p.add_argument('--source', default='/', help='Scan this tree when no --list is given')
+    p.add_argument('--config', default=os.environ.get('EXCLUDES_FILE') or excludes.DEFAULT_CONFIG)
+    p.add_argument('--exclude', action='append', default=[])
+    p.add_argument('--segment-bytes', type=int, default=SEGMENT_BYTES,
+                   help='Checkpoint granularity: bytes per stream segment')
+    p.add_argument('--resume', action='store_true', help='Continue from the checkpoint in OUTPUT.partial')
+    p.add_argument('--no-adaptive', action='store_true',
+                   help='Compress every file instead of storing incompressible ones raw')
+    p.add_argument('--format', choices=['json', 'shell'], default='json')
+
+    for mode in ('verify', 'restore'):
+        p = sub.add_parser(mode)
+        p.add_argument('directory')
+        if mode == 'restore':
+            p.add_argument('target')
+        p.add_argument('--workers', type=int, default=DEFAULT_STREAMS)
+
+    p = sub.add_parser('info')
+    p.add_argument('directory')
+    p.add_argument('--format', choices=['json', 'shell'], default='json')
+
+    args = parser.parse_args()
+
+    if args.mode == 'create':
+        if args.resume:
+            entries = None
+        elif args.list:
+            entries = stat_paths(read_list(args.list))
+        else:
+            policy = excludes.ExcludePolicy.load(args.config, args.exclude)
+            entries = scanner.scan(args.source, policy)
+        try:
+            manifest = create(args.output, args.codec, max(1, args.streams), entries,
+                              adaptive=not args.no_adaptive, segment_bytes=max(1, args.segment_bytes),
+                              resume=args.resume)
+        except (RuntimeError, OSError) as e:
+            print(f'Sharded archive failed: {e}', file=sys.stderr)
+            sys.exit(1)
+        if args.format == 'json':
+            print(json.dumps(manifest, indent=2))
+        else:
+            print(f"ARCHIVE_BYTES={manifest['archive_bytes']}")
+            print(f"CODEC={manifest['codec']}")
+            print(f"STREAMS={stream_count(manifest)}")
+            print(f"RESUMED_SEGMENTS={manifest['resumed_segments']}")
+            print(f"SECONDS={manifest['seconds']}")
+            print(f"CPU_SECONDS={manifest['cpu_seconds']}")
+            print(f"STORED_BYTES={manifest['compression'].get('stored', {}).get('source_bytes', 0)}")
+            # Single-line JSON; catalog.py parses it back into objects
+            print(f"COMPRESSION={json.dumps(manifest['compression'], separators=(',', ':'))}")
+            print(f"CLASSES={json.dumps(manifest['classes'], separators=(',', ':'))}")
+    elif args.mode == 'info':
+        try:
+            manifest = load_manifest(args.directory)
+        except (OSError, ValueError) as e:
+            print(f'Cannot read the manifest of {args.directory}: {e}', file=sys.stderr)
+            sys.exit(1)
+        if args.format == 'json':
+            print(json.dumps(manifest, indent=2))
+        else:
+            print(f"ARCHIVE_BYTES={manifest['archive_bytes']}")
+            print(f"CODEC={manifest['codec']}")
+            print(f"STREAMS={stream_count(manifest)}")
+    elif args.mode == 'verify':
+        entries, errors = verify(args.directory, args.workers)
+        for error in errors:
+            print(error, file=sys.stderr)
+        print(entries)
+        sys.exit(1 if errors else 0)
+    else:
+        errors = restore(args.directory, args.target, args.workers)
+        for error in errors:
+            print(error, file=sys.stderr)
+        sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
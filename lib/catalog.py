@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Backup catalog for the System Restore Toolkit
+
+Each backup gets one JSON document in BACKUP_DIR/.toolkit/catalog/<id>.json
+describing how it was made (engine, codec, source), how big it is and what
+it took. Documents are written to a temporary file and renamed into place,
+so readers never see a partial entry.
+
+Usage from the shell:
+    catalog.py BACKUP_DIR record ID key=value [key=value ...]
+    catalog.py BACKUP_DIR update ID key=value [key=value ...]
+    catalog.py BACKUP_DIR show ID
+    catalog.py BACKUP_DIR get ID KEY
+    catalog.py BACKUP_DIR list
+    catalog.py BACKUP_DIR remove ID
+"""
+
+import fcntl
+import json
+import math
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+STATE_DIRNAME = '.toolkit'
+
+
+def state_dir(backup_dir):
+    """Directory for toolkit metadata that lives alongside the backups"""
+    path = os.path.join(backup_dir, STATE_DIRNAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def catalog_dir(backup_dir):
+    path = os.path.join(state_dir(backup_dir), 'catalog')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def backup_id(name):
+    """Strip engine/codec suffixes so every layout of a backup shares one id"""
+    name = os.path.basename(name.rstrip('/'))
+    for suffix in ('.tar.gz', '.tar.zst', '.tar.xz', '.tar'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name.split('.', 1)[0]
+
+
+def _entry_path(backup_dir, entry_id):
+    return os.path.join(catalog_dir(backup_dir), f'{backup_id(entry_id)}.json')
+
+
+def write_json_atomic(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def _locked(backup_dir):
+    """Serialise read-modify-write updates between concurrent toolkit runs"""
+    with open(os.path.join(catalog_dir(backup_dir), '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_entry(backup_dir, entry_id):
+    try:
+        with open(_entry_path(backup_dir, entry_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_entry(backup_dir, entry):
+    entry = dict(entry)
+    entry['id'] = backup_id(entry['id'])
+    entry.setdefault('created', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    with _locked(backup_dir):
+        write_json_atomic(_entry_path(backup_dir, entry['id']), entry)
+    return entry
+
+
+def update_entry(backup_dir, entry_id, fields):
+    """Merge fields into an entry (creating it if needed) and return the result"""
+    with _locked(backup_dir):
+        entry = load_entry(backup_dir, entry_id) or {'id': backup_id(entry_id)}
+        entry.update(fields)
+        write_json_atomic(_entry_path(backup_dir, entry_id), entry)
+    return entry
+
+
+def remove_entry(backup_dir, entry_id):
+    with _locked(backup_dir):
+        try:
+            os.unlink(_entry_path(backup_dir, entry_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def list_entries(backup_dir):
+    """All catalog entries, oldest first"""
+    directory = os.path.join(backup_dir, STATE_DIRNAME, 'catalog')
+    entries = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return entries
+    for name in names:
+        if name.endswith('.json') and not name.startswith('.'):
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return sorted(entries, key=lambda e: (e.get('created', ''), e.get('id', '')))
+
+
+# Fields the shell passes as numbers or as single-line JSON; anything else
+# (names, descriptions, paths, ids) is kept as the string it was given
+NUMERIC_FIELDS = {'chunks', 'streams'}
+NUMERIC_SUFFIXES = ('_bytes', '_files', '_chunks', '_seconds')
+JSON_FIELDS = {'compression', 'classes'}
+
+
+def _reject_constant(name):
+    raise ValueError(f'{name} is not valid JSON')
+
+
+def parse_value(key, value):
+    """Interpret a key=value argument from the shell according to its field"""
+    if key in NUMERIC_FIELDS or key.endswith(NUMERIC_SUFFIXES):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        # nan and inf would make the entry invalid JSON
+        return number if math.isfinite(number) else value
+    if key in JSON_FIELDS:
+        try:
+            return json.loads(value, parse_constant=_reject_constant)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_fields(args):
+    fields = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            raise SystemExit(f'Expected key=value, got {arg!r}')
+        fields[key] = parse_value(key, value)
+    return fields
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+
+    backup_dir, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+
+    if command == 'record' and args:
+        entry = save_entry(backup_dir, dict(parse_fields(args[1:]), id=args[0]))
+        print(json.dumps(entry, indent=2, sort_keys=True))
+    elif command == 'update' and args:
+        entry = update_entry(backup_dir, args[0], parse_fields(args[1:]))
+        print(json.dumps(entry, indent=2, sort_keys=True))
+    elif command == 'show' and args:
+        entry = load_entry(backup_dir, args[0])
+        if entry is None:
+            print(f'No catalog entry for {args[0]}', file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(entry, indent=2, sort_keys=True))
+    elif command == 'get' and len(args) == 2:
+        value = (load_entry(backup_dir, args[0]) or {}).get(args[1])
+        if value is not None:
+            print(value if isinstance(value, str) else json.dumps(value))
+    elif command == 'list':
+        print(json.dumps(list_entries(backup_dir), indent=2, sort_keys=True))
+    elif command == 'remove' and args:
+        sys.exit(0 if remove_entry(backup_dir, args[0]) else 1)
+    else:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Compressibility classifier for backup streams
+
+Pushing JPEGs, videos, packages and image layers through gzip burns CPU for
+almost no gain. classify() decides per file whether it is worth compressing:
+
+    small        under SNIFF_MIN bytes; not worth opening, compressed with the rest
+    known        extension of an already-compressed format (.jpg, .deb, .zst, ...)
+    magic        content starts with a compressed-format signature
+    entropy      sampled bytes are close to random (> HIGH_ENTROPY bits/byte)
+    trial        zlib level 1 on the sample saved less than MIN_SAVING
+    text         none of the above; compressed
+
+Only files of at least SNIFF_MIN bytes are opened. They hold most of the
+bytes, and opening millions of small files would cost more than it saves.
+
+    classify.py FILE [FILE ...]     print the class of each file
+"""
+
+import math
+import os
+import stat
+import sys
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SNIFF_MIN = 64 * 1024
+SAMPLE_SIZE = 16 * 1024
+HIGH_ENTROPY = 7.9
+LOW_ENTROPY = 6.0
+MIN_SAVING = 0.05
+
+# Classes whose content is stored without compression
+INCOMPRESSIBLE = frozenset(('known', 'magic', 'entropy', 'trial'))
+
+COMPRESSED_EXTENSIONS = frozenset((
+    # images, audio, video
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'avif', 'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac',
+    'mp4', 'm4v', 'mkv', 'webm', 'avi', 'mov',
+    # archives and packages
+    'gz', 'tgz', 'bz2', 'tbz2', 'xz', 'txz', 'zst', 'lz4', 'lzma', '7z', 'rar', 'zip', 'jar', 'war',
+    'whl', 'egg', 'deb', 'rpm', 'apk', 'snap', 'squashfs', 'cab', 'xpi', 'crx',
+    # zip-based documents and fonts
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub', 'woff', 'woff2',
+))
+
+# (offset, signature) of formats that are already compressed
+MAGIC = (
+    (0, b'\x1f\x8b'),                  # gzip (also Docker image layers)
+    (0, b'\x28\xb5\x2f\xfd'),          # zstd
+    (0, b'\xfd7zXZ\x00'),              # xz
+    (0, b'BZh'),                       # bzip2
+    (0, b'\x04\x22\x4d\x18'),          # lz4
+    (0, b'PK\x03\x04'),                # zip, jar, docx, ...
+    (0, b'7z\xbc\xaf\x27\x1c'),        # 7z
+    (0, b'Rar!'),                      # rar
+    (0, b'\x89PNG'),                   # png
+    (0, b'\xff\xd8\xff'),              # jpeg
+    (0, b'GIF8'),                      # gif
+    (0, b'OggS'),                      # ogg
+    (0, b'fLaC'),                      # flac
+    (0, b'ID3'),                       # mp3
+    (0, b'hsqs'),                      # squashfs
+    (0, b'!<arch>\ndebian'),           # deb
+    (0, b'\xed\xab\xee\xdb'),          # rpm
+    (4, b'ftyp'),                      # mp4, mov, heic
+    (8, b'WEBP'),                      # webp
+)
+
+
+def extension(path):
+    name = path.rsplit('/', 1)[-1]
+    return name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+
+
+def entropy(data):
+    """Shannon entropy of data in bits per byte"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def _sample(f, size):
+    """Read SAMPLE_SIZE bytes from the start, middle and end of a file"""
+    chunks = []
+    for offset in (0, size // 2, max(0, size - SAMPLE_SIZE)):
+        f.seek(offset)
+        chunks.append(f.read(SAMPLE_SIZE))
+    return b''.join(chunks)
+
+
+def classify(path, size):
+    """Return the class name for a regular file of `size` bytes"""
+    if extension(path) in COMPRESSED_EXTENSIONS:
+        return 'known'
+    if size < SNIFF_MIN:
+        return 'small'
+    try:
+        with open(path, 'rb') as f:
+            sample = _sample(f, size)
+    except OSError:
+        return 'text'
+    for offset, signature in MAGIC:
+        if sample[offset:offset + len(signature)] == signature:
+            return 'magic'
+    bits = entropy(sample)
+    if bits > HIGH_ENTROPY:
+        return 'entropy'
+    if bits < LOW_ENTROPY:
+        return 'text'
+    saving = 1 - len(zlib.compress(sample, 1)) / len(sample)
+    return 'trial' if saving < MIN_SAVING else 'text'
+
+
+def classify_entries(entries, workers=8):
+    """Map path -> class for the regular files among scanner Entries"""
+    files = [(e.path, e.size) for e in entries if stat.S_ISREG(e.mode)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        classes = executor.map(lambda item: classify(*item), files)
+        return {path: cls for (path, _), cls in zip(files, classes)}
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+    for path in sys.argv[1:]:
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f'{path}: {e.strerror}', file=sys.stderr)
+            continue
+        print(f'{classify(path, size):8} {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -24,34 +24,150 @@ fi
 # Configuration
 DEFAULT_BACKUP_DIR="/var/backups/system-restore-toolkit"
 DEFAULT_LOG_DIR="/var/log/system-restore-toolkit"
-CONFIG_FILE="/etc/system-restore-toolkit.conf"
+CONFIG_FILE="${CONFIG_FILE:-/etc/system-restore-toolkit.conf}"
+DEFAULT_BACKUP_SOURCE="/"
+DEFAULT_BACKUP_COMPRESSION="gzip"
+DEFAULT_BACKUP_ENGINE="tar"
+DEFAULT_BACKUP_ADAPTIVE="1"
+# Write a file manifest per backup for diff-backups (lib/manifest.py)
+DEFAULT_BACKUP_MANIFEST="1"
+# Record a structured system state with each backup (lib/system_state.py)
+DEFAULT_BACKUP_SYSTEM_STATE="1"
+# Remote sink URL (s3://BUCKET/PREFIX); empty keeps backups in BACKUP_DIR only
+DEFAULT_BACKUP_SINK=""
+# Log lifecycle (see lib/logrotate.py): compress logs idle for LOG_COMPRESS_AFTER_HOURS,
+# cut live ones past LOG_ROTATE_BYTES, delete archives past LOG_RETENTION_DAYS or
+# while LOG_DIR holds more than LOG_MAX_BYTES
+DEFAULT_LOG_ROTATE="1"
+DEFAULT_LOG_COMPRESS_AFTER_HOURS="24"
+DEFAULT_LOG_ROTATE_BYTES=$((64 * 1024 * 1024))
+DEFAULT_LOG_RETENTION_DAYS="30"
+DEFAULT_LOG_MAX_BYTES=$((512 * 1024 * 1024))
+TOOLKIT_LIB_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+# Exclude policy shared by backups, estimates and Timeshift (see lib/excludes.py)
+DEFAULT_EXCLUDES_FILE="$(dirname "$TOOLKIT_LIB_DIR")/configs/excludes.json"
+
+# Fallback tar --exclude globs, used only when python3 cannot apply the policy
+DEFAULT_BACKUP_EXCLUDES=(
+    '/proc/*'
+    '/tmp/*'
+    '/mnt/*'
+    '/dev/*'
+    '/sys/*'
+    '/run/*'
+    '/media/*'
+    '/var/cache/*'
+    '/var/tmp/*'
+)
 
 # Initialize log file (will be set in init_toolkit)
 LOG_FILE=""
 
+# Log format: "text" ([LEVEL] date message) or "json" (one JSON object per line)
+LOG_FORMAT="${LOG_FORMAT:-text}"
+
+# Identifies every log line and span written by one toolkit invocation;
+# the web interface passes its task id so both sides correlate
+OPERATION_ID="${OPERATION_ID:-}"
+OPERATION_NAME="${OPERATION_NAME:-}"
+
+# Span start times (nanoseconds since the epoch), keyed by phase
+declare -A SPAN_STARTS=()
+
+# Escape a string for use inside a JSON string literal
+json_escape() {
+    local s="$1"
+    s="${s//\\/\\\\}"
+    s="${s//\"/\\\"}"
+    s="${s//$'\n'/\\n}"
+    s="${s//$'\r'/\\r}"
+    s="${s//$'\t'/\\t}"
+    printf '%s' "$s"
+}
+
+# Append one line to the log file. printf to an O_APPEND descriptor issues a
+# single write(), so lines from concurrent writers never interleave.
+append_log_line() {
+    [[ -n "$LOG_FILE" ]] || return 0
+    printf '%s\n' "$1" >> "$LOG_FILE" 2>/dev/null || true
+}
+
+# Write a structured event; extra is a pre-formatted JSON fragment (",\"k\":v")
+log_event() {
+    local level="$1"
+    local message="$2"
+    local extra="${3:-}"
+    
+    append_log_line "{\"ts\":\"$(date -u '+%Y-%m-%dT%H:%M:%S.%3NZ')\",\"level\":\"${level}\",\"op\":\"$(json_escape "$OPERATION_ID")\",\"command\":\"$(json_escape "$OPERATION_NAME")\",\"msg\":\"$(json_escape "$message")\"${extra}}"
+}
+
+write_log() {
+    local level="$1"
+    local msg="$2"
+    
+    if [[ "$LOG_FORMAT" == "json" ]]; then
+        log_event "${level,,}" "$msg"
+    else
+        append_log_line "[$level] $(date '+%Y-%m-%d %H:%M:%S') $msg"
+    fi
+}
+
 # Logging functions
 log_info() {
     local msg="[INFO] $(date '+%Y-%m-%d %H:%M:%S') $1"
     echo -e "${BLUE}${msg}${NC}"
-    [[ -n "$LOG_FILE" ]] && echo "$msg" >> "$LOG_FILE" 2>/dev/null || true
+    write_log "INFO" "$1"
 }
 
 log_success() {
     local msg="[SUCCESS] $(date '+%Y-%m-%d %H:%M:%S') $1"
     echo -e "${GREEN}${msg}${NC}"
-    [[ -n "$LOG_FILE" ]] && echo "$msg" >> "$LOG_FILE" 2>/dev/null || true
+    write_log "SUCCESS" "$1"
 }
 
 log_warning() {
     local msg="[WARNING] $(date '+%Y-%m-%d %H:%M:%S') $1"
     echo -e "${YELLOW}${msg}${NC}"
-    [[ -n "$LOG_FILE" ]] && echo "$msg" >> "$LOG_FILE" 2>/dev/null || true
+    write_log "WARNING" "$1"
 }
 
 log_error() {
     local msg="[ERROR] $(date '+%Y-%m-%d %H:%M:%S') $1"
     echo -e "${RED}${msg}${NC}" >&2
-    [[ -n "$LOG_FILE" ]] && echo "$msg" >> "$LOG_FILE" 2>/dev/null || true
+    write_log "ERROR" "$1"
+}
+
+# Timing spans: span_begin PHASE ... span_end PHASE [STATUS] [BYTES]
+span_begin() {
+    local phase="$1"
+    SPAN_STARTS[$phase]=$(date '+%s%N')
+    
+    if [[ "$LOG_FORMAT" == "json" ]]; then
+        log_event "info" "begin $phase" ",\"event\":\"span_start\",\"phase\":\"$(json_escape "$phase")\",\"start_ns\":${SPAN_STARTS[$phase]}"
+    fi
+}
+
+span_end() {
+    local phase="$1"
+    local status="${2:-ok}"
+    local bytes="${3:-}"
+    local start_ns="${SPAN_STARTS[$phase]:-}"
+    local end_ns
+    end_ns=$(date '+%s%N')
+    
+    [[ -n "$start_ns" ]] || return 0
+    unset "SPAN_STARTS[$phase]"
+    
+    local duration_ms=$(( (end_ns - start_ns) / 1000000 ))
+    
+    if [[ "$LOG_FORMAT" == "json" ]]; then
+        local extra=",\"event\":\"span_end\",\"phase\":\"$(json_escape "$phase")\",\"status\":\"$(json_escape "$status")\",\"start_ns\":${start_ns},\"end_ns\":${end_ns},\"duration_ms\":${duration_ms}"
+        [[ -n "$bytes" ]] && extra+=",\"bytes\":${bytes}"
+        log_event "info" "end $phase" "$extra"
+    else
+        append_log_line "[SPAN] $(date '+%Y-%m-%d %H:%M:%S') phase=$phase status=$status duration_ms=$duration_ms${bytes:+ bytes=$bytes}"
+    fi
 }
 
 # Check if running as root
@@ -113,6 +229,87 @@ check_disk_space() {
     return 0
 }
 
+# Check available disk space against an exact byte count
+check_disk_space_bytes() {
+    local path="${1:-.}"
+    local required_bytes="${2:-0}"
+    
+    local available_kb
+    available_kb=$(df -P "$path" | awk 'NR==2 {print $4}')
+    local available_bytes=$((available_kb * 1024))
+    
+    if [[ $available_bytes -lt $required_bytes ]]; then
+        log_error "Insufficient disk space. Required: $(format_bytes "$required_bytes"), Available: $(format_bytes "$available_bytes")"
+        return 1
+    fi
+    
+    log_info "Disk space check passed. Required: $(format_bytes "$required_bytes"), Available: $(format_bytes "$available_bytes")"
+    return 0
+}
+
+# Human readable byte count
+format_bytes() {
+    numfmt --to=iec-i --suffix=B "${1:-0}" 2>/dev/null || echo "${1:-0} bytes"
+}
+
+# Print the fallback exclude globs for backups, one per line
+get_backup_excludes() {
+    printf '%s\n' "${DEFAULT_BACKUP_EXCLUDES[@]}" "$BACKUP_DIR/*"
+}
+
+# Arguments selecting the exclude policy for lib/*.py helpers; the backup
+# directory itself is always excluded on top of the configured rules
+exclude_policy_args() {
+    printf '%s\0' --config "$EXCLUDES_FILE" --exclude "$(realpath -m "$BACKUP_DIR")/*"
+}
+
+# Run one of the Python helpers in lib/
+run_lib_python() {
+    local script="$1"
+    shift
+    
+    if ! command -v python3 &> /dev/null; then
+        log_warning "python3 not found; skipping $script"
+        return 1
+    fi
+    python3 "${TOOLKIT_LIB_DIR}/${script}" "$@"
+}
+
+# Record or update a backup's catalog entry: catalog_record ID key=value...
+catalog_record() {
+    run_lib_python catalog.py "$BACKUP_DIR" update "$@" > /dev/null || \
+        log_warning "Could not update backup catalog for $1"
+}
+
+# Manifest file of a backup, by name or id (see lib/manifest.py)
+backup_manifest_path() {
+    local backup_id
+    backup_id=$(basename "$1")
+    echo "$BACKUP_DIR/.toolkit/manifests/${backup_id%%.*}.manifest"
+}
+
+# Compress, cut and expire the logs in LOG_DIR; extra arguments go to logrotate.py
+rotate_logs() {
+    run_lib_python logrotate.py rotate "$LOG_DIR" \
+        --compress-after-hours "$LOG_COMPRESS_AFTER_HOURS" --rotate-bytes "$LOG_ROTATE_BYTES" \
+        --max-age-days "$LOG_RETENTION_DAYS" --max-bytes "$LOG_MAX_BYTES" "$@"
+}
+
+# Drop the catalog entry and manifest of a removed backup, and any system
+# state no other backup shares
+forget_backup() {
+    run_lib_python catalog.py "$BACKUP_DIR" remove "$1" &> /dev/null || true
+    sudo rm -f "$(backup_manifest_path "$1")"
+    if command -v python3 &> /dev/null; then
+        sudo python3 "${TOOLKIT_LIB_DIR}/system_state.py" prune --backup-dir "$BACKUP_DIR" &> /dev/null || true
+    fi
+}
+
+# Print one field of a backup's catalog entry (empty if unknown)
+catalog_get() {
+    run_lib_python catalog.py "$BACKUP_DIR" get "$1" "$2" 2>/dev/null || true
+}
+
 # Validate LVM setup
 check_lvm() {
     if ! command -v lvcreate &> /dev/null; then
@@ -133,6 +330,83 @@ get_timestamp() {
     date '+%Y%m%d_%H%M%S'
 }
 
+# Get the tar --use-compress-program value for a codec (empty for none)
+get_compress_program() {
+    local codec="${1:-$DEFAULT_BACKUP_COMPRESSION}"
+    
+    case "$codec" in
+        gzip) echo "gzip" ;;
+        zstd) echo "zstd -T0" ;;
+        xz)   echo "xz -T0" ;;
+        none) echo "" ;;
+        *)
+            log_error "Unknown compression codec: $codec"
+            return 1
+            ;;
+    esac
+}
+
+# Get the archive file extension for a codec
+get_archive_extension() {
+    case "${1:-$DEFAULT_BACKUP_COMPRESSION}" in
+        gzip) echo ".tar.gz" ;;
+        zstd) echo ".tar.zst" ;;
+        xz)   echo ".tar.xz" ;;
+        none) echo ".tar" ;;
+        *)    return 1 ;;
+    esac
+}
+
+# Most recent rsync snapshot in BACKUP_DIR (empty if none)
+latest_rsync_snapshot() {
+    find "$BACKUP_DIR" -maxdepth 1 -type d -name 'full-backup-*.rsync' 2>/dev/null | sort | tail -n 1
+}
+
+# Detect the codec of an existing archive (or btrfs send stream) from its file name
+detect_archive_codec() {
+    case "$1" in
+        *.tar.gz|*.btrfs.gz)   echo "gzip" ;;
+        *.tar.zst|*.btrfs.zst) echo "zstd" ;;
+        *.tar.xz|*.btrfs.xz)   echo "xz" ;;
+        *.tar|*.btrfs)         echo "none" ;;
+        *)                     return 1 ;;
+    esac
+}
+
+# True if PATH is a btrfs subvolume (snapshots can only be taken of subvolumes)
+is_btrfs_subvolume() {
+    [[ "$(stat -f -c %T "$1" 2>/dev/null)" == "btrfs" ]] && sudo btrfs subvolume show "$1" &> /dev/null
+}
+
+# Where read-only snapshots of SUBVOLUME are kept; it must be on the same filesystem
+btrfs_snapshot_dir() {
+    echo "${BTRFS_SNAPSHOT_DIR:-${1%/}/.toolkit-snapshots}"
+}
+
+# Id of the newest btrfs backup of SOURCE whose snapshot can still serve as a send parent (empty if none)
+latest_btrfs_parent() {
+    local source="$1"
+    local backup_file backup_id snapshot
+    while read -r backup_file; do
+        [[ -n "$backup_file" ]] || continue
+        backup_id=$(basename "$backup_file")
+        backup_id="${backup_id%%.*}"
+        [[ "$(catalog_get "$backup_id" source)" == "$source" ]] || continue
+        snapshot=$(catalog_get "$backup_id" snapshot)
+        if [[ -n "$snapshot" && -d "$snapshot" ]]; then
+            echo "$backup_id"
+            return 0
+        fi
+    done < <(find "$BACKUP_DIR" -maxdepth 1 -type f -name 'full-backup-*.btrfs*' 2>/dev/null | sort -r)
+}
+
+# True if NAME is a completed backup in BACKUP_SINK (and not in BACKUP_DIR)
+sink_has_backup() {
+    local name="$1"
+    [[ -n "$BACKUP_SINK" && ! -e "$name" && ! -e "$BACKUP_DIR/$name" ]] || return 1
+    run_lib_python sinks.py head "$BACKUP_SINK" "$(basename "$name")" &> /dev/null
+}
+
 # Generate backup description with system info
 get_system_description() {
     local custom_desc="${1:-}"
@@ -172,6 +446,9 @@ load_config() {
 init_toolkit() {
     load_config
     
+    LOG_FORMAT="${LOG_FORMAT:-text}"
+    OPERATION_ID="${OPERATION_ID:-$(date '+%Y%m%d%H%M%S')-$$}"
+    
     # Set up logging directory - prefer local if system not writable
     LOG_DIR="${LOG_DIR:-$DEFAULT_LOG_DIR}"
     
@@ -185,6 +462,24 @@ init_toolkit() {
         LOG_FILE="${LOG_DIR}/toolkit-$(date '+%Y%m%d').log"
     fi
     
+    # Set up backup source and compression
+    BACKUP_SOURCE="${BACKUP_SOURCE:-$DEFAULT_BACKUP_SOURCE}"
+    BACKUP_COMPRESSION="${BACKUP_COMPRESSION:-$DEFAULT_BACKUP_COMPRESSION}"
+    BACKUP_ENGINE="${BACKUP_ENGINE:-$DEFAULT_BACKUP_ENGINE}"
+    local cpus
+    cpus=$(nproc 2>/dev/null || echo 2)
+    BACKUP_STREAMS="${BACKUP_STREAMS:-$(( cpus < 8 ? cpus : 8 ))}"
+    BACKUP_ADAPTIVE="${BACKUP_ADAPTIVE:-$DEFAULT_BACKUP_ADAPTIVE}"
+    BACKUP_SINK="${BACKUP_SINK:-$DEFAULT_BACKUP_SINK}"
+    BACKUP_MANIFEST="${BACKUP_MANIFEST:-$DEFAULT_BACKUP_MANIFEST}"
+    BACKUP_SYSTEM_STATE="${BACKUP_SYSTEM_STATE:-$DEFAULT_BACKUP_SYSTEM_STATE}"
+    EXCLUDES_FILE="${EXCLUDES_FILE:-$DEFAULT_EXCLUDES_FILE}"
+    LOG_ROTATE="${LOG_ROTATE:-$DEFAULT_LOG_ROTATE}"
+    LOG_COMPRESS_AFTER_HOURS="${LOG_COMPRESS_AFTER_HOURS:-$DEFAULT_LOG_COMPRESS_AFTER_HOURS}"
+    LOG_ROTATE_BYTES="${LOG_ROTATE_BYTES:-$DEFAULT_LOG_ROTATE_BYTES}"
+    LOG_RETENTION_DAYS="${LOG_RETENTION_DAYS:-$DEFAULT_LOG_RETENTION_DAYS}"
+    LOG_MAX_BYTES="${LOG_MAX_BYTES:-$DEFAULT_LOG_MAX_BYTES}"
+    
     # Set up backup directory
     BACKUP_DIR="${BACKUP_DIR:-$DEFAULT_BACKUP_DIR}"
     if [[ -w "$(dirname "$BACKUP_DIR")" ]] || [[ $EUID -eq 0 ]]; then
@@ -195,5 +490,10 @@ init_toolkit() {
         ensure_directory "$BACKUP_DIR" "755"
     fi
     
+    # The first run of each day archives what earlier days left behind
+    if [[ "$LOG_ROTATE" == "1" && ! -e "$LOG_FILE" ]]; then
+        rotate_logs > /dev/null 2>&1 || true
+    fi
+    
     log_info "System Restore Toolkit v2.0 initialized"
 }
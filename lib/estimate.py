@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Pre-backup size estimator and change-rate scanner
+
+Walks the backup source in parallel (see scanner.py) with the backup's
+exclude policy (see excludes.py), updates the persisted inode/mtime/size database
+and predicts the archive size. The prediction is the source size times
+the median compression ratio of recent catalogued backups made with the
+same codec, or a conservative default when there is no history.
+
+When host-scripts/change-journal.py is running, the walk is replaced by the
+previous scan plus the paths journaled since (see journal.py), so the cost
+follows the number of changes rather than the size of the tree. Any doubt
+about the journal (daemon stopped, gap, policy change) falls back to a full
+walk. --no-journal forces one.
+
+The "cow" subcommand sizes an LVM snapshot from the historical change rate
+alone, without walking the tree again.
+
+    estimate.py backup --backup-dir DIR --source / --codec gzip [--exclude PATTERN ...]
+                       [--config EXCLUDES_FILE] [--write-list FILE] [--no-journal]
+    estimate.py cow --backup-dir DIR --source / [--hours 24]
+
+--format shell prints KEY=VALUE lines for lib/common.sh to read.
+--write-list saves every kept path, NUL-separated with parents before their
+children, for tar --null --no-recursion -T.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+
+import catalog
+import excludes
+import journal
+import scanner
+
+# Archive/source ratios assumed until the catalog has real numbers for a codec
+DEFAULT_RATIOS = {'gzip': 0.6, 'zstd': 0.55, 'xz': 0.5, 'none': 1.0}
+
+# Headroom over the prediction required to start a backup
+SAFETY_MARGIN = 1.15
+
+GIB = 1024 ** 3
+DEFAULT_COW_BYTES = 5 * GIB
+MIN_COW_BYTES = 1 * GIB
+
+
+def historical_ratio(backup_dir, codec, engine='tar', samples=10):
+    """Median archive/source ratio of the last successful full backups with this codec"""
+    ratios = []
+    for entry in reversed(catalog.list_entries(backup_dir)):
+        if entry.get('codec') != codec or entry.get('engine', 'tar') != engine:
+            continue
+        source_bytes = entry.get('source_bytes')
+        archive_bytes = entry.get('archive_bytes')
+        if source_bytes and archive_bytes:
+            ratios.append(archive_bytes / source_bytes)
+        if len(ratios) >= samples:
+            break
+    if ratios:
+        return statistics.median(ratios), 'catalog'
+    return DEFAULT_RATIOS.get(codec, 1.0), 'default'
+
+
+def _listed(entries, list_file):
+    for entry in entries:
+        list_file.write(entry.path.encode('utf-8', 'surrogateescape') + b'\0')
+        yield entry
+
+
+def estimate_backup(backup_dir, source, codec, engine, policy, workers, update=True, list_path=None,
+                    use_journal=True):
+    errors = []
+    database = scanner.ScanDatabase(catalog.state_dir(backup_dir), source)
+    list_file = open(list_path, 'wb') if list_path else None
+    journal_directory = journal.journal_dir(backup_dir)
+    changes, fallback = None, None
+    try:
+        if use_journal:
+            try:
+                changes, position = journal.changes_since(journal_directory, database, source, policy)
+            except journal.JournalUnavailable as e:
+                fallback = str(e)
+        if changes is not None:
+            entries = journal.incremental_scan(database, changes, source, policy, workers)
+        else:
+            position = journal.position(journal_directory, source, policy.config_fingerprint) if use_journal else None
+            entries = scanner.scan(source, policy, workers, on_error=lambda path, error: errors.append(path))
+        if list_file:
+            entries = _listed(entries, list_file)
+        result = database.record(entries, update=update)
+        if update:
+            generation, seq = position or (None, None)
+            database.set_meta(policy=policy.fingerprint, journal_generation=generation, journal_seq=seq)
+        rate = database.change_rate()
+    finally:
+        database.close()
+        if list_file:
+            list_file.close()
+
+    ratio, ratio_source = historical_ratio(backup_dir, codec, engine)
+    predicted = int(result['total_bytes'] * ratio)
+
+    result.update({
+        'source': source,
+        'codec': codec,
+        'engine': engine,
+        'compression_ratio': round(ratio, 4),
+        'ratio_source': ratio_source,
+        'predicted_archive_bytes': predicted,
+        'required_bytes': int(predicted * SAFETY_MARGIN),
+        'change_rate_bytes_per_hour': int(rate) if rate is not None else None,
+        'unreadable_paths': len(errors),
+        'scan_mode': 'journal' if changes is not None else 'full',
+        'journal_changes': len(changes) if changes is not None else None,
+        'journal_fallback': fallback,
+    })
+    return result
+
+
+def estimate_cow(backup_dir, source, hours):
+    """Snapshot CoW size that should survive `hours` of writes at the observed change rate"""
+    database = scanner.ScanDatabase(catalog.state_dir(backup_dir), source)
+    try:
+        rate = database.change_rate()
+    finally:
+        database.close()
+
+    if rate is None:
+        return {'cow_bytes': DEFAULT_COW_BYTES, 'change_rate_bytes_per_hour': None, 'basis': 'default'}
+    # Block-level CoW copies whole chunks for partial writes, so allow twice the file-level rate
+    cow = max(MIN_COW_BYTES, int(rate * hours * 2))
+    return {'cow_bytes': cow, 'change_rate_bytes_per_hour': int(rate), 'basis': 'history'}
+
+
+def print_result(result, output_format):
+    if output_format == 'json':
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            print(f'{key.upper()}={int(value)}')
+        elif value is None:
+            print(f'{key.upper()}=')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate backup size and snapshot CoW space')
+    parser.add_argument('mode', choices=['backup', 'cow'])
+    parser.add_argument('--backup-dir', required=True)
+    parser.add_argument('--source', default='/')
+    parser.add_argument('--codec', default='gzip')
+    parser.add_argument('--engine', default='tar')
+    parser.add_argument('--exclude', action='append', default=[], help='Extra anchored exclude pattern (repeatable)')
+    parser.add_argument('--config', default=os.environ.get('EXCLUDES_FILE') or excludes.DEFAULT_CONFIG,
+                        help='Exclude policy file')
+    parser.add_argument('--write-list', metavar='FILE', help='Write the kept paths, NUL-separated, to FILE')
+    parser.add_argument('--workers', type=int, default=scanner.DEFAULT_WORKERS)
+    parser.add_argument('--hours', type=float, default=24, help='Expected snapshot lifetime for CoW sizing')
+    parser.add_argument('--no-update', action='store_true', help='Do not replace the stored scan')
+    parser.add_argument('--no-journal', action='store_true', help='Walk the whole tree even if a change journal is usable')
+    parser.add_argument('--format', choices=['json', 'shell'], default='json')
+    args = parser.parse_args()
+
+    if args.mode == 'backup':
+        if not os.path.isdir(args.source):
+            print(f'Source not found: {args.source}', file=sys.stderr)
+            sys.exit(1)
+        policy = excludes.ExcludePolicy.load(args.config, args.exclude)
+        result = estimate_backup(args.backup_dir, args.source, args.codec, args.engine,
+                                 policy, args.workers, update=not args.no_update,
+                                 list_path=args.write_list, use_journal=not args.no_journal)
+    else:
+        result = estimate_cow(args.backup_dir, args.source, args.hours)
+
+    print_result(result, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Exclude policy shared by backups, the size estimator and Timeshift
+
+Rules come from configs/excludes.json (EXCLUDES_FILE). Each rule has a name
+and a list of patterns:
+
+    /var/cache/*           anchored: * matches one path component
+    /home/*/Downloads/**   ** matches any number of components
+    node_modules, *.pyc    unanchored: matches a file or directory name anywhere
+
+Rules with min_size and/or older_than_days only exclude regular files that
+meet every limit. Directories tagged with a valid CACHEDIR.TAG keep the
+directory and the tag file but lose their contents, like tar --exclude-caches.
+
+Anchored patterns are compiled into a trie of path components, so the walk
+carries a small matcher state from each directory to its children instead
+of testing every pattern against every full path. Name patterns are a dict
+lookup for literals plus one combined regex for the globs.
+
+Usage:
+    excludes.py explain [--config FILE] [--exclude PATTERN ...] [PATH]
+    excludes.py timeshift [--config FILE] [--template FILE] [--btrfs]
+    excludes.py patterns [--config FILE]
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import stat
+import sys
+import time
+
+import scanner
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'configs', 'excludes.json')
+
+CACHEDIR_TAG = 'CACHEDIR.TAG'
+CACHEDIR_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+CACHEDIR_RULE = 'cachedir-tag'
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+def parse_size(value):
+    """Parse 100M / 2G / 4096 style sizes into bytes"""
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r'\s*(\d+)\s*([KMGT]?)i?B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Invalid size: {value!r}')
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+class Rule:
+    """One named exclude rule; conditional rules only apply to matching files"""
+
+    def __init__(self, name, patterns, home=False, min_size=None, older_than_days=None,
+                 timeshift_patterns=None):
+        self.name = name
+        self.patterns = list(patterns)
+        self.home = home
+        self.min_size = parse_size(min_size) if min_size is not None else None
+        self.older_than_days = older_than_days
+        self.timeshift_patterns = list(timeshift_patterns) if timeshift_patterns else None
+
+    @property
+    def conditional(self):
+        return self.min_size is not None or self.older_than_days is not None
+
+    def applies(self, entry, now):
+        if not self.conditional:
+            return True
+        if entry.is_dir or not stat.S_ISREG(entry.mode):
+            return False
+        if self.min_size is not None and entry.size < self.min_size:
+            return False
+        if self.older_than_days is not None and entry.mtime_ns > (now - self.older_than_days * 86400) * 1e9:
+            return False
+        return True
+
+
+class _Node:
+    """Trie node for anchored patterns; rules holds the indexes of rules ending here"""
+
+    __slots__ = ('literals', 'globs', 'doublestar', 'loop', 'rules')
+
+    def __init__(self, loop=False):
+        self.literals = {}
+        self.globs = []
+        self.doublestar = None
+        self.loop = loop
+        self.rules = []
+
+
+def _closure(nodes):
+    """Add the ** nodes reachable without consuming a path component"""
+    result = []
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node in result:
+            continue
+        result.append(node)
+        if node.doublestar is not None:
+            stack.append(node.doublestar)
+    return tuple(result)
+
+
+class ExcludePolicy:
+    """Compiled set of rules; see the module docstring for pattern syntax"""
+
+    def __init__(self, rules, cachedir_tag=True, now=None):
+        self.rules = list(rules)
+        self.cachedir_tag = cachedir_tag
+        self.now = now if now is not None else time.time()
+        # Identify the config and extra patterns a loaded policy came from, and the config alone
+        self.fingerprint = None
+        self.config_fingerprint = None
+        self._root = _Node()
+        self._names = {}
+        name_globs = []
+        for index, rule in enumerate(self.rules):
+            for pattern in rule.patterns:
+                if not pattern.startswith('/') and '/' in pattern.rstrip('/'):
+                    pattern = '/**/' + pattern
+                if pattern.startswith('/'):
+                    self._add_anchored(pattern, index)
+                elif GLOB_CHARS.search(pattern):
+                    name_globs.append((index, pattern))
+                else:
+                    self._names.setdefault(pattern, []).append(index)
+        self._name_globs = [index for index, _ in name_globs]
+        self._name_regex = None
+        if name_globs:
+            self._name_regex = re.compile('|'.join(
+                f'(?P<g{i}>{fnmatch.translate(pattern)})' for i, (_, pattern) in enumerate(name_globs)))
+            self._name_glob_regexes = [re.compile(fnmatch.translate(p)) for _, p in name_globs]
+
+    @classmethod
+    def load(cls, path=None, extra_patterns=(), now=None):
+        """Load rules from a JSON config; extra patterns form a final 'command-line' rule"""
+        with open(path or DEFAULT_CONFIG, 'rb') as f:
+            raw = f.read()
+        config = json.loads(raw)
+        rules = [Rule(r['name'], r.get('patterns', []), home=r.get('home', False),
+                      min_size=r.get('min_size'), older_than_days=r.get('older_than_days'),
+                      timeshift_patterns=r.get('timeshift_patterns'))
+                 for r in config.get('rules', [])]
+        if extra_patterns:
+            rules.append(Rule('command-line', extra_patterns))
+        policy = cls(rules, cachedir_tag=config.get('cachedir_tag', True), now=now)
+        policy.fingerprint = fingerprint(raw, extra_patterns)
+        policy.config_fingerprint = fingerprint(raw)
+        return policy
+
+    @property
+    def has_conditional(self):
+        return any(rule.conditional for rule in self.rules)
+
+    def _add_anchored(self, pattern, index):
+        parts = [p for p in pattern.strip('/').split('/') if p]
+        node = self._root
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            if part == '**' and last:
+                # A trailing ** matches every descendant (but not the directory itself)
+                node = self._glob_child(node, '*', loop=True)
+            elif part == '**':
+                if node.doublestar is None:
+                    node.doublestar = _Node(loop=True)
+                node = node.doublestar
+            elif GLOB_CHARS.search(part):
+                node = self._glob_child(node, part)
+            else:
+                node = node.literals.setdefault(part, _Node())
+        node.rules.append(index)
+
+    @staticmethod
+    def _glob_child(node, part, loop=False):
+        for regex, child in node.globs:
+            if regex.pattern == fnmatch.translate(part) and child.loop == loop:
+                return child
+        child = _Node(loop=loop)
+        node.globs.append((re.compile(fnmatch.translate(part)), child))
+        return child
+
+    def state_for(self, path):
+        """Matcher state for an existing directory, found by walking its components from /"""
+        state = _closure([self._root])
+        for part in [p for p in os.path.abspath(path).split('/') if p]:
+            state = self._step(state, part)
+        return state
+
+    @staticmethod
+    def _step(state, name):
+        nodes = []
+        for node in state:
+            if node.loop:
+                nodes.append(node)
+            child = node.literals.get(name)
+            if child is not None:
+                nodes.append(child)
+            for regex, child in node.globs:
+                if regex.match(name):
+                    nodes.append(child)
+        return _closure(nodes)
+
+    def _candidates(self, state, name):
+        indexes = []
+        for node in state:
+            indexes.extend(node.rules)
+        indexes.extend(self._names.get(name, ()))
+        if self._name_regex is not None:
+            match = self._name_regex.match(name)
+            if match:
+                first = int(match.lastgroup[1:])
+                indexes.append(self._name_globs[first])
+                # The combined regex only reports the first alternative; check the
+                # rest individually only when that one might not apply
+                if self.rules[self._name_globs[first]].conditional:
+                    indexes.extend(self._name_globs[i] for i, regex in enumerate(self._name_glob_regexes)
+                                   if i > first and regex.match(name))
+        return sorted(set(indexes))
+
+    def match(self, state, entry):
+        """Return (rule name or None, child state) for an entry in a directory with `state`"""
+        name = entry.path.rsplit('/', 1)[-1]
+        child_state = self._step(state, name)
+        for index in self._candidates(child_state, name):
+            rule = self.rules[index]
+            if rule.applies(entry, self.now):
+                return rule.name, child_state
+        return None, child_state
+
+    def path_rule(self, path):
+        """Name of the unconditional rule excluding path or one of its parents, if any"""
+        state = _closure([self._root])
+        for part in [p for p in os.path.abspath(path).split('/') if p]:
+            state = self._step(state, part)
+            for index in self._candidates(state, part):
+                if not self.rules[index].conditional:
+                    return self.rules[index].name
+        return None
+
+    def is_tagged_cache(self, directory, names):
+        """True if `directory` holds a CACHEDIR.TAG with the standard signature"""
+        if not self.cachedir_tag or CACHEDIR_TAG not in names:
+            return False
+        try:
+            with open(os.path.join(directory, CACHEDIR_TAG), 'rb') as f:
+                return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+        except OSError:
+            return False
+
+    def timeshift_lists(self):
+        """Pattern lists for Timeshift's exclude_list_default and exclude_list_home"""
+        default, home = [], []
+        for rule in self.rules:
+            patterns = rule.timeshift_patterns if rule.conditional else rule.patterns
+            for pattern in patterns or ():
+                if pattern not in default:
+                    default.append(pattern)
+                if rule.home and pattern.startswith('/home/') and pattern not in home:
+                    home.append(pattern)
+        return default, home
+
+
+def fingerprint(config_bytes, extra_patterns=()):
+    """Short digest of a policy's config file contents and extra patterns"""
+    digest = hashlib.sha256(config_bytes)
+    for pattern in extra_patterns:
+        digest.update(b'\0' + pattern.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()[:16]
+
+
+def explain(policy, root, workers=scanner.DEFAULT_WORKERS):
+    """Bytes and files each rule keeps out of a backup of root"""
+    report = {}
+    kept = {'bytes': 0, 'files': 0}
+    seen_inodes = set()
+
+    def count(totals, entry):
+        if entry.is_dir:
+            return
+        totals['files'] += 1
+        if entry.nlink > 1:
+            key = (entry.dev, entry.ino)
+            if key in seen_inodes:
+                return
+            seen_inodes.add(key)
+        totals['bytes'] += entry.size
+
+    def on_exclude(entry, rule):
+        totals = report.setdefault(rule, {'bytes': 0, 'files': 0, 'paths': 0})
+        count(totals, entry)
+
+    def on_excluded_path(entry, rule):
+        report.setdefault(rule, {'bytes': 0, 'files': 0, 'paths': 0})['paths'] += 1
+
+    for entry in scanner.scan(root, policy=policy, workers=workers, on_exclude=on_exclude,
+                              on_excluded_path=on_excluded_path):
+        count(kept, entry)
+    return {'source': os.path.abspath(root), 'kept': kept, 'rules': report}
+
+
+def format_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return f'{count:.0f}{unit}' if unit == 'B' else f'{count:.1f}{unit}'
+        count /= 1024
+    return f'{count:.1f}TiB'
+
+
+def render_template(policy, template_path, btrfs=False):
+    with open(template_path) as f:
+        config = json.load(f)
+    for key in [k for k in config if k.startswith('_')]:
+        del config[key]
+    default, home = policy.timeshift_lists()
+    config['btrfs_mode'] = btrfs
+    config['exclude_list_default'] = default
+    config['exclude_list_home'] = home
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backup exclude policy tools')
+    parser.add_argument('mode', choices=['explain', 'timeshift', 'patterns'])
+    parser.add_argument('path', nargs='?', default='/')
+    parser.add_argument('--config', default=os.environ.get('EXCLUDES_FILE') or DEFAULT_CONFIG)
+    parser.add_argument('--exclude', action='append', default=[], help='Extra anchored pattern (repeatable)')
+    parser.add_argument('--workers', type=int, default=scanner.DEFAULT_WORKERS)
+    parser.add_argument('--template', default=os.path.join(os.path.dirname(DEFAULT_CONFIG), 'timeshift.json'))
+    parser.add_argument('--btrfs', action='store_true', help='Generate a btrfs_mode Timeshift config')
+    parser.add_argument('--format', choices=['json', 'text'], default='text')
+    args = parser.parse_intermixed_args()
+
+    policy = ExcludePolicy.load(args.config, args.exclude)
+
+    if args.mode == 'timeshift':
+        print(json.dumps(render_template(policy, args.template, args.btrfs), indent=2))
+    elif args.mode == 'patterns':
+        for rule in policy.rules:
+            print(f"{rule.name}: {' '.join(rule.patterns)}")
+    else:
+        if not os.path.isdir(args.path):
+            print(f'Not a directory: {args.path}', file=sys.stderr)
+            sys.exit(1)
+        result = explain(policy, args.path, args.workers)
+        if args.format == 'json':
+            print(json.dumps(result, indent=2))
+            return
+        print(f"{'RULE':<24} {'SAVED':>10} {'FILES':>10} {'PATHS':>8}")
+        rules = sorted(result['rules'].items(), key=lambda item: item[1]['bytes'], reverse=True)
+        for name, totals in rules:
+            print(f"{name:<24} {format_bytes(totals['bytes']):>10} {totals['files']:>10} {totals['paths']:>8}")
+        saved = sum(t['bytes'] for t in result['rules'].values())
+        print(f"{'(excluded total)':<24} {format_bytes(saved):>10}")
+        print(f"{'(backed up)':<24} {format_bytes(result['kept']['bytes']):>10} {result['kept']['files']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Filesystem change journal for O(changes) incremental scans
+
+host-scripts/change-journal.py watches the backup source with fanotify (or
+inotify) and appends every changed path to BACKUP_DIR/.toolkit/journal/.
+The estimator (and therefore create-backup) then rebuilds its scan from the
+previous scan in ScanDatabase plus the journaled paths, instead of walking
+and stat-ing the whole tree.
+
+    journal.log     records: <seq u64><kind u8><path>\\0, appended every FLUSH_SECONDS
+    journal.json    generation, root, backend, policy fingerprint, last_seq,
+                    gap_seq, heartbeat
+
+Record kinds:
+
+    F   the path itself changed (created, written, chmod, deleted, moved)
+    T   everything below the path may have changed (directory created, moved
+        or deleted, events overflowed for it); rescan the subtree
+    G   gap marker: changes may have been lost just before this sequence number
+
+Sequence numbers are assigned when records are flushed, so a change that is
+not on disk yet when a scan reads the journal gets a higher number and is
+picked up by the next scan. Compaction keeps one record per path with its
+highest sequence number, and drops records under a T record that is at
+least as new. Every reader still sees each path that changed after the
+position it last consumed.
+
+An incremental scan is used only when nothing could have been missed. The
+journal must be the same generation (daemon run) the last scan recorded,
+with no gap since, a fresh heartbeat and the same exclude config. The
+previous scan must hold full entries made with the same policy. Otherwise
+the caller falls back to a full walk, which records a new baseline.
+
+Usage:
+    journal.py status [--backup-dir DIR]
+"""
+
+import argparse
+import json
+import os
+import stat
+import struct
+import sys
+import time
+
+import catalog
+import scanner
+
+LOG_NAME = 'journal.log'
+META_NAME = 'journal.json'
+
+FILE = b'F'
+SUBTREE = b'T'
+GAP = b'G'
+
+RECORD = struct.Struct('<Qc')
+
+# How often the daemon flushes records and refreshes its heartbeat
+FLUSH_SECONDS = 2
+# A heartbeat older than this means the daemon is not running
+STALE_SECONDS = 60
+
+
+class JournalUnavailable(Exception):
+    """The journal cannot vouch for every change since the last scan"""
+
+
+def journal_dir(backup_dir):
+    return os.path.join(catalog.state_dir(backup_dir), 'journal')
+
+
+def _encode(path):
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def _is_under(path, root):
+    return root == '/' or path == root or path.startswith(root + '/')
+
+
+def read_records(path):
+    """Yield (seq, kind, path) for every complete record in a journal log"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    offset = 0
+    while offset + RECORD.size < len(data):
+        end = data.find(b'\0', offset + RECORD.size)
+        if end < 0:
+            # A record still being appended
+            break
+        seq, kind = RECORD.unpack_from(data, offset)
+        yield seq, kind, data[offset + RECORD.size:end].decode('utf-8', 'surrogateescape')
+        offset = end + 1
+
+
+def read_meta(directory):
+    try:
+        with open(os.path.join(directory, META_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def compact_records(records):
+    """One record per path (highest seq, T if it ever was one), minus records a newer T covers"""
+    latest = {}
+    for seq, kind, path in records:
+        if kind == GAP:
+            continue
+        previous = latest.get(path)
+        if previous is not None:
+            seq = max(seq, previous[0])
+            if previous[1] == SUBTREE:
+                kind = SUBTREE
+        latest[path] = (seq, kind)
+
+    subtrees = {path: seq for path, (seq, kind) in latest.items() if kind == SUBTREE}
+    kept = []
+    for path, (seq, kind) in latest.items():
+        parent = path
+        covered = False
+        while parent not in ('/', ''):
+            parent = os.path.dirname(parent)
+            if subtrees.get(parent, -1) >= seq:
+                covered = True
+                break
+        if not covered:
+            kept.append((seq, kind, path))
+    kept.sort()
+    return kept
+
+
+class JournalWriter:
+    """Append side of the journal, used by the change-journal daemon"""
+
+    def __init__(self, directory, root, backend, policy_fingerprint, max_bytes=256 * 1024 ** 2):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.log_path = os.path.join(directory, LOG_NAME)
+        self.max_bytes = max_bytes
+        self.pending = {}
+        # A new generation tells readers that nothing before this run was recorded
+        self.meta = {
+            'version': 1,
+            'generation': os.urandom(8).hex(),
+            'root': os.path.abspath(root),
+            'backend': backend,
+            'policy': policy_fingerprint,
+            'pid': os.getpid(),
+            'started': time.time(),
+            'updated': time.time(),
+            'last_seq': 0,
+            'gap_seq': 0,
+            'gap_reason': None,
+            'complete': True,
+            'incomplete_reason': None,
+            'compacted': None,
+            'stopped': None,
+        }
+        self.log = open(self.log_path, 'wb')
+        self.compacted_bytes = 0
+        self._write_meta()
+
+    def _write_meta(self):
+        self.meta['updated'] = time.time()
+        catalog.write_json_atomic(os.path.join(self.directory, META_NAME), self.meta)
+
+    def add(self, path, kind=FILE):
+        if self.pending.get(path) != SUBTREE:
+            self.pending[path] = kind
+
+    def gap(self, reason):
+        """Record that changes may have been lost (queue overflow, dropped watch)"""
+        self.flush()
+        self.meta['last_seq'] += 1
+        self.log.write(RECORD.pack(self.meta['last_seq'], GAP) + _encode(self.meta['root']) + b'\0')
+        self.log.flush()
+        self.meta['gap_seq'] = self.meta['last_seq']
+        self.meta['gap_reason'] = reason
+        self._write_meta()
+
+    def incomplete(self, reason):
+        """Mark the journal unusable for this run (e.g. out of inotify watches)"""
+        self.meta['complete'] = False
+        self.meta['incomplete_reason'] = reason
+        self._write_meta()
+
+    def flush(self):
+        """Append pending paths and refresh the heartbeat"""
+        if self.pending:
+            records = []
+            for path, kind in self.pending.items():
+                self.meta['last_seq'] += 1
+                records.append(RECORD.pack(self.meta['last_seq'], kind) + _encode(path) + b'\0')
+            self.log.write(b''.join(records))
+            self.log.flush()
+            self.pending.clear()
+            size = self.log.tell()
+            if size > max(16 * 1024 ** 2, 2 * self.compacted_bytes):
+                self.compact()
+        self._write_meta()
+
+    def compact(self):
+        self.log.close()
+        kept = compact_records(read_records(self.log_path))
+        temp = self.log_path + '.tmp'
+        with open(temp, 'wb') as f:
+            for seq, kind, path in kept:
+                f.write(RECORD.pack(seq, kind) + _encode(path) + b'\0')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.log_path)
+        self.log = open(self.log_path, 'ab')
+        self.compacted_bytes = self.log.tell()
+        self.meta['compacted'] = time.time()
+        if self.compacted_bytes > self.max_bytes:
+            # Too many distinct paths changed; start over and let scans walk once
+            self.log.truncate(0)
+            self.compacted_bytes = 0
+            self.gap(f'journal exceeded {self.max_bytes} bytes after compaction')
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        # Changes after this point go unrecorded
+        self.meta['stopped'] = time.time()
+        self.incomplete('change journal daemon stopped')
+
+
+def _check(meta, source, config_fingerprint, now):
+    if meta is None:
+        raise JournalUnavailable('no change journal')
+    if now - meta.get('updated', 0) > STALE_SECONDS:
+        raise JournalUnavailable(f"change journal daemon not running (no heartbeat for {int(now - meta['updated'])}s)")
+    if not meta.get('complete', True):
+        raise JournalUnavailable(f"change journal incomplete: {meta.get('incomplete_reason')}")
+    if not _is_under(source, meta['root']):
+        raise JournalUnavailable(f"change journal watches {meta['root']}, not {source}")
+    if meta.get('policy') != config_fingerprint:
+        raise JournalUnavailable('change journal was started with a different exclude config')
+
+
+def position(directory, source, config_fingerprint):
+    """(generation, seq) to record with a full scan, or None if the journal is not usable.
+
+    Read it before walking, so changes made during the walk are picked up next time.
+    """
+    meta = read_meta(directory)
+    try:
+        _check(meta, source, config_fingerprint, time.time())
+    except JournalUnavailable:
+        return None
+    return meta['generation'], meta['last_seq']
+
+
+def changes_since(directory, database, source, policy):
+    """Changed paths under source since the scan stored in database.
+
+    Returns ({path: kind}, (generation, seq)); raises JournalUnavailable when
+    a full scan is needed.
+    """
+    meta = read_meta(directory)
+    _check(meta, source, policy.config_fingerprint, time.time())
+    if not database.has_entries():
+        raise JournalUnavailable('no previous scan to apply changes to')
+    if database.get_meta('policy') != policy.fingerprint:
+        raise JournalUnavailable('exclude policy changed since the last scan')
+    if database.get_meta('journal_generation') != meta['generation']:
+        raise JournalUnavailable('change journal restarted since the last scan')
+    since = int(database.get_meta('journal_seq') or 0)
+    if since < meta['gap_seq']:
+        raise JournalUnavailable(f"change journal has a gap since the last scan: {meta['gap_reason']}")
+
+    changes = {}
+    last = since
+    for seq, kind, path in read_records(os.path.join(directory, LOG_NAME)):
+        last = max(last, seq)
+        if seq <= since or kind == GAP or not _is_under(path, source):
+            continue
+        if changes.get(path) != SUBTREE:
+            changes[path] = kind
+    return changes, (meta['generation'], last)
+
+
+class _Filter:
+    """Applies the exclude policy to single paths the way a walk from source would"""
+
+    def __init__(self, source, policy):
+        self.source = source
+        self.policy = policy
+        self.states = {}
+        self.kept_dirs = {source: True}
+
+    def _state(self, directory):
+        state = self.states.get(directory)
+        if state is None:
+            state = self.states[directory] = self.policy.state_for(directory)
+        return state
+
+    def _tagged(self, directory):
+        return self.policy.is_tagged_cache(directory, {'CACHEDIR.TAG'})
+
+    def dir_kept(self, directory):
+        kept = self.kept_dirs.get(directory)
+        if kept is None:
+            try:
+                kept = self.keep(scanner.lstat_entry(directory))
+            except OSError:
+                kept = False
+            self.kept_dirs[directory] = kept
+        return kept
+
+    def keep(self, entry):
+        if entry.path == self.source:
+            return True
+        parent, name = os.path.split(entry.path)
+        if not self.dir_kept(parent):
+            return False
+        if self.policy is None:
+            return True
+        if name != 'CACHEDIR.TAG' and self._tagged(parent):
+            return False
+        rule, _ = self.policy.match(self._state(parent), entry)
+        return rule is None
+
+
+def incremental_scan(database, changes, source, policy, workers=scanner.DEFAULT_WORKERS):
+    """Yield the Entries a full scan of source would, from the stored scan plus changes"""
+    source = os.path.abspath(source)
+    subtrees = {path for path, kind in changes.items() if kind == SUBTREE}
+    # A new or removed cache tag changes what is kept in its whole directory
+    subtrees.update(os.path.dirname(path) for path in changes if os.path.basename(path) == 'CACHEDIR.TAG')
+
+    def under_subtree(path):
+        while True:
+            if path in subtrees:
+                return True
+            if path == source or path in ('/', ''):
+                return False
+            path = os.path.dirname(path)
+
+    # Only the topmost changed subtrees need walking
+    roots = sorted(path for path in subtrees if path == source or not under_subtree(os.path.dirname(path)))
+    check = _Filter(source, policy)
+    fresh = {}
+    for root in roots:
+        if not os.path.lexists(root) or not check.keep(scanner.lstat_entry(root)):
+            continue
+        for entry in scanner.scan(root, policy, workers):
+            fresh[entry.path] = entry
+    for path, kind in changes.items():
+        if kind != FILE or under_subtree(path):
+            continue
+        try:
+            entry = scanner.lstat_entry(path)
+        except OSError:
+            continue
+        if check.keep(entry):
+            fresh[path] = entry
+
+    # Time-dependent rules (e.g. older_than_days) can start applying without any change
+    recheck = policy is not None and policy.has_conditional
+    last_parent, parent_state, parent_skipped = None, None, False
+    # Merged in the stored scan's order, which compares paths as bytes
+    new = iter(sorted(fresh.values(), key=lambda e: os.fsencode(e.path)))
+    pending = next(new, None)
+    for entry in database.entries():
+        if entry.path in changes:
+            continue
+        parent = os.path.dirname(entry.path)
+        if parent != last_parent:
+            last_parent = parent
+            parent_skipped = under_subtree(parent)
+            parent_state = policy.state_for(parent) if recheck and not parent_skipped else None
+        if parent_skipped or entry.path in subtrees:
+            continue
+        if recheck and entry.path != source and stat.S_ISREG(entry.mode):
+            if policy.match(parent_state, entry)[0] is not None:
+                continue
+        while pending is not None and os.fsencode(pending.path) < os.fsencode(entry.path):
+            yield pending
+            pending = next(new, None)
+        yield entry
+    while pending is not None:
+        yield pending
+        pending = next(new, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Change journal status')
+    parser.add_argument('mode', choices=['status'])
+    parser.add_argument('--backup-dir', default=os.environ.get('BACKUP_DIR', '/var/backups/system-restore-toolkit'))
+    args = parser.parse_args()
+
+    directory = journal_dir(args.backup_dir)
+    meta = read_meta(directory)
+    if meta is None:
+        print(f'No change journal in {directory}', file=sys.stderr)
+        sys.exit(1)
+    records = sum(1 for _ in read_records(os.path.join(directory, LOG_NAME)))
+    age = time.time() - meta['updated']
+    print(json.dumps(dict(meta, records=records, heartbeat_age_seconds=round(age, 1),
+                          running=meta.get('stopped') is None and age <= STALE_SECONDS), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Log rotation into seekable compressed archives, and reads that see through them
+
+Quiet or oversized logs are compressed into `.log.gz` archives made of
+independent gzip members, one per BLOCK_SIZE of log lines. Each member
+carries an extra field 'SL' holding its compressed length and the number
+of lines in it. A reader walks the member headers, plus each member's
+ISIZE trailer, to map uncompressed offsets to members. It then
+decompresses only the members a read touches. The archives are still
+ordinary gzip files for zcat, zgrep or gzip -t.
+
+Member layout (little-endian, RFC 1952 with FEXTRA):
+
+    1f 8b 08 04  mtime(4) xfl os  xlen=12  'S' 'L'  slen=8  member length(4)  lines(4)
+    raw deflate data
+    crc32(4)  isize(4)
+
+Rotation, per directory and glob:
+- a plain log not written for --compress-after-hours is compressed and
+  removed. Dated logs (toolkit-YYYYMMDD.log) keep their name. Others get
+  the time of their last write appended;
+- a plain log over --rotate-bytes is compressed in place: the archived
+  bytes are cut from its head and later writes are kept (copy-truncate,
+  so writers holding the file open are not disturbed);
+- archives older than --max-age-days are deleted;
+- while the directory's logs exceed --max-bytes, the oldest archives are
+  deleted. Plain logs are never deleted.
+
+Usage:
+    logrotate.py rotate DIR [--pattern GLOB ...] [--compress-after-hours H] [--rotate-bytes N]
+                            [--max-age-days D] [--max-bytes N] [--format text|shell]
+    logrotate.py compress FILE [--output FILE.gz]
+    logrotate.py cat FILE [--offset N] [--length N]
+    logrotate.py tail FILE [-n LINES]
+"""
+
+import argparse
+import fnmatch
+import gzip
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+BLOCK_SIZE = 256 * 1024
+COMPRESS_LEVEL = 6
+FEXTRA = 0x04
+MEMBER_HEADER = struct.Struct('<BBBBIBBH2sHII')
+MEMBER_TRAILER = struct.Struct('<II')
+DATED_LOG_RE = re.compile(r'-\d{8}(?:-\d{6})?\.log$')
+COPY_CHUNK = 1024 * 1024
+
+Block = namedtuple('Block', 'offset stored_offset stored_length length lines')
+
+# (path, mtime_ns, size) -> list of Block; archives are immutable once renamed into place
+_index_cache = {}
+_INDEX_CACHE_MAX = 256
+
+
+def write_member(out, data):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    body = compressor.compress(data) + compressor.flush()
+    member_length = MEMBER_HEADER.size + len(body) + MEMBER_TRAILER.size
+    out.write(MEMBER_HEADER.pack(0x1f, 0x8b, 8, FEXTRA, 0, 0, 255, 12, b'SL', 8, member_length, data.count(b'\n')))
+    out.write(body)
+    out.write(MEMBER_TRAILER.pack(zlib.crc32(data), len(data) & 0xffffffff))
+    return member_length
+
+
+def compress_stream(source, out, limit=None, block_size=BLOCK_SIZE):
+    """Write up to limit bytes of source as members cut after a newline; returns bytes read"""
+    carry = b''
+    consumed = 0
+    while True:
+        want = block_size - len(carry)
+        if limit is not None:
+            want = min(want, limit - consumed)
+        chunk = source.read(want) if want > 0 else b''
+        consumed += len(chunk)
+        data = carry + chunk
+        if not data:
+            return consumed
+        if chunk and len(data) >= block_size:
+            cut = data.rfind(b'\n') + 1
+            # A line longer than a whole block is split
+            cut = cut or len(data)
+        else:
+            cut = len(data)
+        write_member(out, data[:cut])
+        carry = data[cut:]
+
+
+def _write_archive(path, destination, limit=None):
+    """Compress path (its first limit bytes) into destination atomically; returns bytes archived"""
+    tmp_path = f'{destination}.tmp'
+    try:
+        with open(path, 'rb') as source, open(tmp_path, 'wb') as out:
+            archived = compress_stream(source, out, limit)
+            out.flush()
+            os.fsync(out.fileno())
+        stat = os.stat(path)
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.rename(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return archived
+
+
+def compress_file(path, destination=None):
+    """Compress a finished log into a seekable archive and remove it"""
+    destination = destination or f'{path}.gz'
+    before = os.stat(path)
+    _write_archive(path, destination)
+    after = os.stat(path)
+    if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+        # Written to while we compressed it: keep the log, drop the archive
+        os.unlink(destination)
+        return None
+    os.unlink(path)
+    return destination
+
+
+def cut_head(path, destination):
+    """Archive what path holds now and remove it from the log, keeping later writes"""
+    size = os.path.getsize(path)
+    _write_archive(path, destination, limit=size)
+    with open(path, 'r+b') as f:
+        f.seek(size)
+        later = f.read()
+        f.seek(0)
+        f.truncate()
+        f.write(later)
+    return size
+
+
+def archive_name(path, when, keep_name=True):
+    """Archive path for a plain log
+
+    A dated log keeps its name when it is archived whole. Other logs and
+    partial cuts get the time `when` appended.
+    """
+    if keep_name and DATED_LOG_RE.search(os.path.basename(path)) and not os.path.exists(f'{path}.gz'):
+        return f'{path}.gz'
+    stamp = datetime.fromtimestamp(when).strftime('%Y%m%d-%H%M%S')
+    name = f'{path[:-len(".log")]}-{stamp}.log.gz'
+    count = 1
+    while os.path.exists(name):
+        name = f'{path[:-len(".log")]}-{stamp}-{count}.log.gz'
+        count += 1
+    return name
+
+
+def rotate(log_dir, patterns=('*.log',), compress_after_hours=24, rotate_bytes=64 * 1024 * 1024,
+           max_age_days=30, max_bytes=512 * 1024 * 1024, now=None):
+    """Compress, cut and expire the logs in log_dir matching patterns; returns counts"""
+    now = now or time.time()
+    result = {'compressed': 0, 'cut': 0, 'expired': 0, 'evicted': 0,
+              'freed_bytes': 0, 'archived_bytes': 0, 'total_bytes': 0}
+    archive_patterns = [f'{pattern}.gz' for pattern in patterns]
+
+    def matching(names, globs):
+        return [name for name in names if any(fnmatch.fnmatch(name, glob) for glob in globs)]
+
+    for name in matching(sorted(os.listdir(log_dir)), patterns):
+        path = os.path.join(log_dir, name)
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        if stat.st_size == 0:
+            continue
+        if now - stat.st_mtime >= compress_after_hours * 3600:
+            if compress_file(path, archive_name(path, stat.st_mtime)):
+                result['compressed'] += 1
+                result['archived_bytes'] += stat.st_size
+        elif rotate_bytes and stat.st_size > rotate_bytes:
+            result['archived_bytes'] += cut_head(path, archive_name(path, now, keep_name=False))
+            result['cut'] += 1
+
+    archives = []
+    total = 0
+    names = os.listdir(log_dir)
+    archive_names = set(matching(names, archive_patterns))
+    for name in matching(names, list(patterns) + archive_patterns):
+        stat = os.stat(os.path.join(log_dir, name))
+        total += stat.st_size
+        if name in archive_names:
+            archives.append((stat.st_mtime, name, stat.st_size))
+    archives.sort()
+
+    for mtime, name, size in list(archives):
+        if max_age_days and now - mtime > max_age_days * 86400:
+            os.unlink(os.path.join(log_dir, name))
+            archives.remove((mtime, name, size))
+            total -= size
+            result['expired'] += 1
+            result['freed_bytes'] += size
+    while max_bytes and total > max_bytes and archives:
+        mtime, name, size = archives.pop(0)
+        os.unlink(os.path.join(log_dir, name))
+        total -= size
+        result['evicted'] += 1
+        result['freed_bytes'] += size
+    result['total_bytes'] = total
+    return result
+
+
+def block_index(path):
+    """Blocks of an archive written by this module, or None for any other gzip file"""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key in _index_cache:
+        return _index_cache[key]
+    blocks = []
+    offset = stored_offset = 0
+    with open(path, 'rb') as f:
+        while stored_offset < stat.st_size:
+            f.seek(stored_offset)
+            header = f.read(MEMBER_HEADER.size)
+            if len(header) < MEMBER_HEADER.size:
+                return None
+            (id1, id2, method, flags, _, _, _, xlen, subfield, slen,
+             member_length, lines) = MEMBER_HEADER.unpack(header)
+            if (id1, id2, method, xlen, subfield, slen) != (0x1f, 0x8b, 8, 12, b'SL', 8) or not flags & FEXTRA:
+                return None
+            f.seek(stored_offset + member_length - 4)
+            length = struct.unpack('<I', f.read(4))[0]
+            blocks.append(Block(offset, stored_offset, member_length, length, lines))
+            offset += length
+            stored_offset += member_length
+    if len(_index_cache) >= _INDEX_CACHE_MAX:
+        _index_cache.clear()
+    _index_cache[key] = blocks
+    return blocks
+
+
+class LogFile:
+    """Uncompressed view of a plain log or an archive, read by offset or from the end"""
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.stored_bytes = stat.st_size
+        self.mtime = stat.st_mtime
+        self.compressed = path.endswith('.gz')
+        self.blocks = block_index(path) if self.compressed else None
+        if self.blocks is not None:
+            self.size = sum(block.length for block in self.blocks)
+        elif self.compressed:
+            # Foreign gzip: no index, so it is read from the start
+            self.size = 0
+            with gzip.open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(COPY_CHUNK), b''):
+                    self.size += len(chunk)
+        else:
+            self.size = stat.st_size
+
+    def _block_data(self, f, block):
+        f.seek(block.stored_offset)
+        return zlib.decompress(f.read(block.stored_length), 31)
+
+    def iter_range(self, offset=0, length=None):
+        """Yield the bytes of [offset, offset + length) in chunks"""
+        end = self.size if length is None else min(self.size, offset + length)
+        if offset >= end:
+            return
+        if self.blocks is not None:
+            with open(self.path, 'rb') as f:
+                for block in self.blocks:
+                    if block.offset + block.length <= offset:
+                        continue
+                    if block.offset >= end:
+                        break
+                    data = self._block_data(f, block)
+                    yield data[max(0, offset - block.offset):end - block.offset]
+            return
+        opener = gzip.open if self.compressed else open
+        with opener(self.path, 'rb') as f:
+            f.seek(offset)
+            remaining = end - offset
+            while remaining > 0:
+                chunk = f.read(min(COPY_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def read(self, offset=0, length=None):
+        return b''.join(self.iter_range(offset, length))
+
+    def tail(self, lines):
+        """(offset, data) of the last lines lines"""
+        if self.blocks is not None:
+            # Line counts in the headers say how many blocks to decompress
+            needed, start = lines + 1, len(self.blocks)
+            while start > 0 and needed > 0:
+                start -= 1
+                needed -= self.blocks[start].lines
+            offset = self.blocks[start].offset if self.blocks else 0
+        elif self.compressed:
+            offset = 0
+        else:
+            offset = self.size
+            chunk = 64 * 1024
+            found = 0
+            with open(self.path, 'rb') as f:
+                while offset > 0 and found <= lines:
+                    step = min(chunk, offset)
+                    offset -= step
+                    f.seek(offset)
+                    found += f.read(step).count(b'\n')
+        data = self.read(offset)
+        keep = data.splitlines(keepends=True)[-lines:] if lines > 0 else []
+        kept = b''.join(keep)
+        return self.size - len(kept), kept
+
+    def count_lines(self):
+        if self.blocks is not None:
+            return sum(block.lines for block in self.blocks)
+        count = 0
+        last = b'\n'
+        for chunk in self.iter_range():
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+        return count + (1 if last != b'\n' else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Log rotation into seekable archives')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('rotate')
+    p.add_argument('log_dir')
+    p.add_argument('--pattern', action='append', help='Glob of logs to manage (default *.log)')
+    p.add_argument('--compress-after-hours', type=float, default=24)
+    p.add_argument('--rotate-bytes', type=int, default=64 * 1024 * 1024)
+    p.add_argument('--max-age-days', type=float, default=30)
+    p.add_argument('--max-bytes', type=int, default=512 * 1024 * 1024)
+    p.add_argument('--format', choices=['text', 'shell'], default='text')
+
+    p = sub.add_parser('compress')
+    p.add_argument('file')
+    p.add_argument('--output')
+
+    p = sub.add_parser('cat')
+    p.add_argument('file')
+    p.add_argument('--offset', type=int, default=0)
+    p.add_argument('--length', type=int)
+
+    p = sub.add_parser('tail')
+    p.add_argument('file')
+    p.add_argument('-n', '--lines', type=int, default=10)
+
+    args = parser.parse_args()
+
+    try:
+        if args.mode == 'rotate':
+            result = rotate(args.log_dir, tuple(args.pattern or ('*.log',)), args.compress_after_hours,
+                            args.rotate_bytes, args.max_age_days, args.max_bytes)
+            for key, value in result.items():
+                print(f'{key.upper()}={value}' if args.format == 'shell' else f'{key}: {value}')
+        elif args.mode == 'compress':
+            destination = compress_file(args.file, args.output)
+            if destination is None:
+                raise OSError(f'{args.file} changed while it was compressed; left as it is')
+            print(destination)
+        elif args.mode == 'cat':
+            for chunk in LogFile(args.file).iter_range(args.offset, args.length):
+                sys.stdout.buffer.write(chunk)
+        else:
+            sys.stdout.buffer.write(LogFile(args.file).tail(args.lines)[1])
+        sys.stdout.flush()
+    except BrokenPipeError:
+        sys.exit(1)
+    except (OSError, ValueError, zlib.error) as e:
+        print(f'Log {args.mode} failed: {e}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+Per-backup file manifests and a streaming diff between two of them
+
+A manifest lists every path a backup holds, sorted by path, with its
+size, mtime, mode and a 128-bit BLAKE2b digest of its contents (of the
+link target for symlinks). It is built from the scan the backup was made
+from (see scanner.py), so no archive is read. Digests are cached in the
+scan database under the file's inode, size and mtime. Only new or changed
+files are read again.
+
+Layout (little-endian):
+
+    b'SRTMANI1'
+    blocks       u32 compressed length, u32 entries, zlib(columns)
+    end          u32 0, u32 0
+    footer       JSON (source, created, entries, bytes), u32 footer length
+
+A block holds up to BLOCK_ENTRIES entries as columns:
+- front-coded paths: shared-prefix lengths (u16), suffix lengths (u16)
+  and the suffixes;
+- sizes and mtimes (i64);
+- modes (u32);
+- digests (16 bytes each, all zero when not hashed).
+Paths are front-coded against the previous path in the same block, so
+every block decodes on its own.
+
+`diff` merge-joins two manifests while reading them block by block.
+Memory stays flat however many entries there are. It reports added,
+removed and modified paths with their byte deltas. Paths whose mtime
+changed but whose content did not are only counted.
+
+Usage:
+    manifest.py build --backup-dir DIR --source / --output FILE [--workers N] [--format json|shell]
+    manifest.py diff OLD NEW [--format text|json|ndjson] [--summary]
+    manifest.py show FILE
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import stat
+import struct
+import sys
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import catalog
+import scanner
+
+MAGIC = b'SRTMANI1'
+BLOCK_ENTRIES = 4096
+DIGEST_BYTES = 16
+NO_DIGEST = bytes(DIGEST_BYTES)
+READ_BYTES = 1024 * 1024
+_BLOCK = struct.Struct('<II')
+_FOOTER = struct.Struct('<I')
+
+
+def _little(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def file_digest(path, size, mtime_ns, mode):
+    """Content digest, or NO_DIGEST if the path is not a regular file or symlink,
+    is unreadable, or no longer matches the scanned size and mtime"""
+    digest = hashlib.blake2b(digest_size=DIGEST_BYTES)
+    try:
+        if stat.S_ISLNK(mode):
+            digest.update(os.readlink(os.fsencode(path)))
+            return digest.digest()
+        if not stat.S_ISREG(mode):
+            return NO_DIGEST
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOATIME', 0))
+        except PermissionError:
+            # O_NOATIME is refused for files we do not own unless running as root
+            fd = os.open(path, os.O_RDONLY)
+        with open(fd, 'rb', buffering=0) as f:
+            st = os.fstat(fd)
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return NO_DIGEST
+            buffer = bytearray(READ_BYTES)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                digest.update(view[:n])
+            if os.fstat(fd).st_mtime_ns != mtime_ns:
+                return NO_DIGEST
+    except OSError:
+        return NO_DIGEST
+    return digest.digest()
+
+
+def _shared_prefix(a, b):
+    """Length of the common prefix of two byte strings, from the highest differing bit"""
+    n = min(len(a), len(b))
+    differ = int.from_bytes(a[:n], 'big') ^ int.from_bytes(b[:n], 'big')
+    return n - (differ.bit_length() + 7) // 8
+
+
+class ManifestWriter:
+    """Writes sorted (path bytes, size, mtime_ns, mode, digest) entries block by block"""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.tmp_path = f'{path}.partial'
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(MAGIC)
+        self.footer = {'source': source, 'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                       'entries': 0, 'bytes': 0}
+        self.block = []
+        self.last = b''
+
+    def add(self, path, size, mtime_ns, mode, digest):
+        if path <= self.last and self.footer['entries']:
+            raise ValueError(f'manifest entries out of order at {os.fsdecode(path)}')
+        self.last = path
+        self.block.append((path, size, mtime_ns, mode, digest))
+        self.footer['entries'] += 1
+        if stat.S_ISREG(mode):
+            self.footer['bytes'] += size
+        if len(self.block) >= BLOCK_ENTRIES:
+            self._flush()
+
+    def _flush(self):
+        if not self.block:
+            return
+        paths, sizes, mtimes, modes, digests = zip(*self.block)
+        prefixes, suffix_lengths, suffixes = array('H'), array('H'), []
+        previous = b''
+        for path in paths:
+            shared = _shared_prefix(previous, path)
+            prefixes.append(shared)
+            suffix_lengths.append(len(path) - shared)
+            suffixes.append(path[shared:])
+            previous = path
+        columns = [
+            _little(prefixes).tobytes(), _little(suffix_lengths).tobytes(), b''.join(suffixes),
+            _little(array('q', sizes)).tobytes(), _little(array('q', mtimes)).tobytes(),
+            _little(array('I', modes)).tobytes(), b''.join(digests),
+        ]
+        data = zlib.compress(b''.join(columns), 6)
+        self.file.write(_BLOCK.pack(len(data), len(self.block)))
+        self.file.write(data)
+        self.block = []
+
+    def close(self):
+        self._flush()
+        self.file.write(_BLOCK.pack(0, 0))
+        footer = json.dumps(self.footer, sort_keys=True).encode()
+        self.file.write(footer + _FOOTER.pack(len(footer)))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
+        return self.footer
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.tmp_path)
+
+
+def _decode_block(data, count):
+    """Columns of one block back into a list of (path, size, mtime_ns, mode, digest)"""
+    offset = 0
+
+    def column(typecode):
+        nonlocal offset
+        values = array(typecode)
+        end = offset + count * values.itemsize
+        values.frombytes(data[offset:end])
+        offset = end
+        return _little(values)
+
+    prefixes = column('H')
+    suffix_lengths = column('H')
+    paths = []
+    previous = b''
+    for shared, length in zip(prefixes, suffix_lengths):
+        previous = previous[:shared] + data[offset:offset + length]
+        offset += length
+        paths.append(previous)
+    sizes = column('q')
+    mtimes = column('q')
+    modes = column('I')
+    digests = [data[offset + i * DIGEST_BYTES:offset + (i + 1) * DIGEST_BYTES] for i in range(count)]
+    return list(zip(paths, sizes, mtimes, modes, digests))
+
+
+def read_entries(path):
+    """Yield (path bytes, size, mtime_ns, mode, digest) in path order"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a backup manifest')
+        while True:
+            length, count = _BLOCK.unpack(f.read(_BLOCK.size))
+            if not count:
+                return
+            yield from _decode_block(zlib.decompress(f.read(length)), count)
+
+
+def read_footer(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a backup manifest')
+        f.seek(-_FOOTER.size, os.SEEK_END)
+        length, = _FOOTER.unpack(f.read(_FOOTER.size))
+        f.seek(-_FOOTER.size - length, os.SEEK_END)
+        return json.loads(f.read(length))
+
+
+def build(backup_dir, source, output, workers=scanner.DEFAULT_WORKERS):
+    """Write the manifest of the last scan of source; returns counts for the log"""
+    source = os.path.abspath(source)
+    database = scanner.ScanDatabase(catalog.state_dir(backup_dir), source)
+    if not database.has_entries():
+        database.close()
+        raise ValueError(f'no scan of {source} to build a manifest from; run estimate-backup first')
+    prefix = source.rstrip('/') + '/'
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    writer = ManifestWriter(output, source)
+    hashed = reused = 0
+    # Hardlinked names share one digest; only their (dev, ino) is remembered
+    linked = {}
+    try:
+        database.start_digests()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = database.digest_rows()
+            while True:
+                batch = rows.fetchmany(BLOCK_ENTRIES)
+                if not batch:
+                    break
+                pending = []
+                for path, ino, dev, nlink, size, mtime_ns, mode, digest in batch:
+                    if not path.startswith(prefix):
+                        continue  # the source directory itself
+                    if digest is not None:
+                        reused += 1
+                    elif not (stat.S_ISREG(mode) or stat.S_ISLNK(mode)):
+                        digest = NO_DIGEST
+                    elif nlink > 1 and (dev, ino) in linked:
+                        digest = linked[(dev, ino)]
+                    else:
+                        digest = executor.submit(file_digest, path, size, mtime_ns, mode)
+                        if nlink > 1 and stat.S_ISREG(mode):
+                            linked[(dev, ino)] = digest
+                    pending.append((path, ino, size, mtime_ns, mode, digest))
+                fresh = []
+                for path, ino, size, mtime_ns, mode, digest in pending:
+                    if not isinstance(digest, bytes):
+                        digest = digest.result()
+                        hashed += 1
+                    if digest != NO_DIGEST:
+                        fresh.append((path, ino, size, mtime_ns, digest))
+                    # Directory sizes depend on the filesystem, not on what the backup holds
+                    writer.add(path[len(prefix):].encode('utf-8', 'surrogateescape'),
+                               0 if stat.S_ISDIR(mode) else size, mtime_ns, mode, digest)
+                database.add_digests(fresh)
+        footer = writer.close()
+        database.finish_digests()
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        database.close()
+    footer.update({'hashed_files': hashed, 'reused_digests': reused})
+    return footer
+
+
+def _changed(old, new):
+    """(modified, touched) for two entries of the same path"""
+    if old[3] != new[3] or old[1] != new[1]:
+        return True, False
+    new_mtime = old[2] != new[2]
+    if old[4] != NO_DIGEST and new[4] != NO_DIGEST:
+        modified = old[4] != new[4]
+        return modified, new_mtime and not modified
+    if stat.S_ISREG(new[3]):
+        # Not hashed (unreadable, or changing while read): the mtime is all there is
+        return new_mtime, False
+    # A directory's mtime moves whenever an entry in it does; those entries are reported themselves
+    return False, new_mtime
+
+
+def diff(old_path, new_path, summary):
+    """Merge-join two manifests; yields ('added'|'removed'|'modified', old, new) and fills summary"""
+    for key in ('added', 'removed', 'modified'):
+        summary.setdefault(key, {'paths': 0, 'bytes': 0})
+    summary['modified'].update(grown_bytes=0, shrunk_bytes=0)
+    summary.update(unchanged=0, touched=0)
+    old_entries = read_entries(old_path)
+    new_entries = read_entries(new_path)
+    old = next(old_entries, None)
+    new = next(new_entries, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            summary['removed']['paths'] += 1
+            summary['removed']['bytes'] += old[1]
+            yield 'removed', old, None
+            old = next(old_entries, None)
+        elif old is None or new[0] < old[0]:
+            summary['added']['paths'] += 1
+            summary['added']['bytes'] += new[1]
+            yield 'added', None, new
+            new = next(new_entries, None)
+        else:
+            modified, touched = _changed(old, new)
+            if modified:
+                delta = new[1] - old[1]
+                summary['modified']['paths'] += 1
+                summary['modified']['bytes'] += delta
+                summary['modified']['grown_bytes' if delta > 0 else 'shrunk_bytes'] += abs(delta)
+                yield 'modified', old, new
+            else:
+                summary['unchanged'] += 1
+                summary['touched'] += touched
+            old = next(old_entries, None)
+            new = next(new_entries, None)
+    summary['net_bytes'] = summary['added']['bytes'] - summary['removed']['bytes'] + summary['modified']['bytes']
+
+
+def _kind(mode):
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    if stat.S_ISLNK(mode):
+        return 'link'
+    return 'file' if stat.S_ISREG(mode) else 'other'
+
+
+def change_record(change, old, new):
+    entry = new or old
+    record = {'change': change, 'path': os.fsdecode(entry[0]), 'type': _kind(entry[3])}
+    if old:
+        record['old_size'] = old[1]
+    if new:
+        record['new_size'] = new[1]
+    record['delta_bytes'] = (new[1] if new else 0) - (old[1] if old else 0)
+    if change == 'modified' and old[3] != new[3]:
+        record['old_mode'] = oct(old[3])
+        record['new_mode'] = oct(new[3])
+    return record
+
+
+def format_bytes(count, signed=False):
+    sign = ('+' if count > 0 else '-' if count < 0 else '') if signed else ''
+    value = abs(count)
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if value < 1024 or unit == 'TiB':
+            text = f'{value}{unit}' if unit == 'B' else f'{value:.1f}{unit}'
+            return sign + text
+        value /= 1024
+
+
+def print_text(change, old, new):
+    entry = new or old
+    path = os.fsdecode(entry[0]) + ('/' if stat.S_ISDIR(entry[3]) else '')
+    if change == 'added':
+        print(f'+ {path}  ({format_bytes(new[1])})')
+    elif change == 'removed':
+        print(f'- {path}  ({format_bytes(old[1])})')
+    else:
+        detail = format_bytes(new[1] - old[1], signed=True) if new[1] != old[1] else 'same size'
+        if old[3] != new[3]:
+            detail += f', mode {stat.filemode(old[3])} -> {stat.filemode(new[3])}'
+        print(f'M {path}  ({detail})')
+
+
+def print_summary(summary):
+    modified = summary['modified']
+    print(f"Added:      {summary['added']['paths']} paths, {format_bytes(summary['added']['bytes'])}")
+    print(f"Removed:    {summary['removed']['paths']} paths, {format_bytes(summary['removed']['bytes'])}")
+    print(f"Modified:   {modified['paths']} paths, {format_bytes(modified['grown_bytes'], signed=True)} "
+          f"/ {format_bytes(-modified['shrunk_bytes'], signed=True)}")
+    print(f"Unchanged:  {summary['unchanged']} paths ({summary['touched']} with only a new mtime)")
+    print(f"Net change: {format_bytes(summary['net_bytes'], signed=True)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backup file manifests')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('build')
+    p.add_argument('--backup-dir', required=True)
+    p.add_argument('--source', default='/')
+    p.add_argument('--output', required=True)
+    p.add_argument('--workers', type=int, default=scanner.DEFAULT_WORKERS)
+    p.add_argument('--format', choices=['json', 'shell'], default='json')
+
+    p = sub.add_parser('diff')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--format', choices=['text', 'json', 'ndjson'], default='text')
+    p.add_argument('--summary', action='store_true', help='Only print the totals')
+
+    p = sub.add_parser('show')
+    p.add_argument('manifest')
+
+    args = parser.parse_args()
+
+    try:
+        if args.mode == 'build':
+            result = build(args.backup_dir, args.source, args.output, args.workers)
+            if args.format == 'json':
+                print(json.dumps(result, indent=2))
+            else:
+                for key in ('entries', 'bytes', 'hashed_files', 'reused_digests'):
+                    print(f'{key.upper()}={result[key]}')
+        elif args.mode == 'diff':
+            summary = {'old': read_footer(args.old), 'new': read_footer(args.new)}
+            changes = diff(args.old, args.new, summary)
+            if args.format == 'text':
+                for change in changes:
+                    if not args.summary:
+                        print_text(*change)
+                if not args.summary:
+                    print()
+                print_summary(summary)
+            elif args.format == 'ndjson':
+                for change in changes:
+                    if not args.summary:
+                        print(json.dumps(change_record(*change)))
+                print(json.dumps({'summary': summary}))
+            else:
+                records = [change_record(*change) for change in changes if not args.summary]
+                print(json.dumps({'summary': summary, 'changes': records}, indent=2))
+        else:
+            print(json.dumps(read_footer(args.manifest), indent=2))
+    except BrokenPipeError:
+        sys.exit(1)
+    except (OSError, ValueError) as e:
+        print(f'Manifest {args.mode} failed: {e}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Parallel filesystem scanner with a persisted change database
+
+scan() walks a tree with os.scandir on a thread pool (directory reads and
+lstat calls release the GIL, so several run at once), skipping excluded
+paths exactly as the backup does (see excludes.py). ScanDatabase keeps the
+lstat fields of every entry from the previous scan in SQLite. It reports
+how many files and bytes changed since then, and keeps a history of scans
+so change rates can be computed without walking again. The stored entries
+also let journal.py rebuild a scan from the change journal alone, and
+manifest.py keeps content digests next to them.
+"""
+
+import hashlib
+import os
+import sqlite3
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import NamedTuple
+
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 4) * 2)
+
+
+class Entry(NamedTuple):
+    path: str
+    is_dir: bool
+    size: int
+    ino: int
+    dev: int
+    nlink: int
+    mtime_ns: int
+    mode: int
+
+
+def _entry(path, st):
+    return Entry(path, stat.S_ISDIR(st.st_mode), st.st_size, st.st_ino, st.st_dev,
+                 st.st_nlink, st.st_mtime_ns, st.st_mode)
+
+
+def lstat_entry(path):
+    """Entry for a single path without following symlinks"""
+    return _entry(path, os.lstat(path))
+
+
+def _scan_dir(path, state, policy, excluded_by):
+    """List one directory; returns kept entries, excluded (entry, rule, top) tuples,
+    subdirectories to walk as (path, state, excluded_by) and errors"""
+    entries = []
+    excluded = []
+    subdirs = []
+    errors = []
+    try:
+        with os.scandir(path) as it:
+            dirents = list(it)
+    except OSError as e:
+        return entries, excluded, subdirs, [(path, e)]
+
+    tagged_cache = (policy is not None and excluded_by is None
+                    and policy.is_tagged_cache(path, {d.name for d in dirents}))
+    for dirent in dirents:
+        try:
+            st = dirent.stat(follow_symlinks=False)
+        except OSError as e:
+            errors.append((dirent.path, e))
+            continue
+        entry = _entry(dirent.path, st)
+        child_state = None
+        if excluded_by is not None:
+            excluded.append((entry, excluded_by, False))
+            rule = excluded_by
+        elif tagged_cache and dirent.name != 'CACHEDIR.TAG':
+            rule = 'cachedir-tag'
+            excluded.append((entry, rule, True))
+        elif policy is not None:
+            rule, child_state = policy.match(state, entry)
+            if rule is not None:
+                excluded.append((entry, rule, True))
+        else:
+            rule = None
+        if rule is None:
+            entries.append(entry)
+        if entry.is_dir:
+            subdirs.append((entry.path, child_state, rule))
+    return entries, excluded, subdirs, errors
+
+
+def scan(root, policy=None, workers=DEFAULT_WORKERS, on_error=None, on_exclude=None, on_excluded_path=None):
+    """Yield an Entry for root and everything below it that the exclude policy keeps.
+
+    on_excluded_path(entry, rule) is called for each path a rule matched.
+    on_exclude(entry, rule) is called for every excluded entry; passing it makes
+    the scan also walk excluded directories so their contents can be counted.
+    """
+    root = os.path.abspath(root)
+    yield lstat_entry(root)
+    root_state = policy.state_for(root) if policy is not None else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, root, root_state, policy, None)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, excluded, subdirs, errors = future.result()
+                for path, state, excluded_by in subdirs:
+                    if excluded_by is None or on_exclude is not None:
+                        pending.add(executor.submit(_scan_dir, path, state, policy, excluded_by))
+                for entry, rule, top in excluded:
+                    if top and on_excluded_path:
+                        on_excluded_path(entry, rule)
+                    if on_exclude:
+                        on_exclude(entry, rule)
+                if on_error:
+                    for path, error in errors:
+                        on_error(path, error)
+                yield from entries
+
+
+class ScanDatabase:
+    """Per-source SQLite record of the previous scan and of scan history"""
+
+    BATCH = 10000
+
+    # Paths are stored as their os.fsencode() bytes, so names that are not
+    # valid UTF-8 round-trip; BLOBs sort bytewise, parents before children.
+    # counted is 1 for files whose bytes count towards the totals: not
+    # directories, and only the first name of a hardlinked file
+    FILES_COLUMNS = ('path BLOB PRIMARY KEY, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                     'dev INTEGER, nlink INTEGER, mode INTEGER, counted INTEGER')
+    DIGESTS_COLUMNS = 'path BLOB PRIMARY KEY, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest BLOB'
+
+    def __init__(self, state_dir, source):
+        source_key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:12]
+        self.path = os.path.join(state_dir, f'scan-{source_key}.db')
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(f'''
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS files ({self.FILES_COLUMNS});
+            CREATE TABLE IF NOT EXISTS history (
+                scan_time REAL, total_bytes INTEGER, total_files INTEGER,
+                changed_bytes INTEGER, changed_files INTEGER);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS digests ({self.DIGESTS_COLUMNS});
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, **values):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                [(key, None if value is None else str(value)) for key, value in values.items()])
+
+    def has_entries(self):
+        """True once a scan has been recorded"""
+        return self.last_scan() is not None
+
+    def entries(self):
+        """Yield the stored scan as Entries in path order (parents before children)"""
+        for path, size, ino, dev, nlink, mtime_ns, mode in self.db.execute(
+                'SELECT path, size, ino, dev, nlink, mtime_ns, mode FROM files ORDER BY path'):
+            yield Entry(os.fsdecode(path), stat.S_ISDIR(mode), size, ino, dev, nlink, mtime_ns, mode)
+
+    def digest_rows(self):
+        """Yield the stored scan in path order as (path, ino, dev, nlink, size, mtime_ns, mode, digest).
+
+        digest is the cached content digest if the file still has the inode,
+        size and mtime it was computed for, else None.
+        """
+        cursor = self.db.cursor()
+        cursor.row_factory = lambda _, row: (os.fsdecode(row[0]),) + row[1:]
+        return cursor.execute('''
+            SELECT f.path, f.ino, f.dev, f.nlink, f.size, f.mtime_ns, f.mode, d.digest FROM files f
+            LEFT JOIN digests d ON d.path = f.path AND d.ino = f.ino AND d.size = f.size AND d.mtime_ns = f.mtime_ns
+            ORDER BY f.path
+        ''')
+
+    def start_digests(self):
+        """Collect a fresh digest cache; digests not re-added before finish_digests() are dropped"""
+        self.db.execute('DROP TABLE IF EXISTS digests_new')
+        self.db.execute(f'CREATE TABLE digests_new ({self.DIGESTS_COLUMNS})')
+
+    def add_digests(self, rows):
+        """Add (path, ino, size, mtime_ns, digest) rows to the cache being collected"""
+        self.db.executemany('INSERT OR REPLACE INTO digests_new VALUES (?, ?, ?, ?, ?)',
+                            ((os.fsencode(path),) + tuple(rest) for path, *rest in rows))
+
+    def finish_digests(self):
+        with self.db:
+            self.db.execute('DROP TABLE digests')
+            self.db.execute('ALTER TABLE digests_new RENAME TO digests')
+
+    def last_scan(self):
+        row = self.db.execute(
+            'SELECT scan_time, total_bytes, total_files FROM history ORDER BY scan_time DESC LIMIT 1').fetchone()
+        return {'scan_time': row[0], 'total_bytes': row[1], 'total_files': row[2]} if row else None
+
+    def record(self, entries, update=True):
+        """Compare a scan against the previous one; returns totals and changed bytes/files"""
+        db = self.db
+        db.execute('DROP TABLE IF EXISTS scan_new')
+        db.execute(f'CREATE TABLE scan_new ({self.FILES_COLUMNS})')
+
+        total_bytes = 0
+        total_files = 0
+        seen_inodes = set()
+        batch = []
+        insert = 'INSERT OR REPLACE INTO scan_new VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        for entry in entries:
+            counted = not entry.is_dir
+            if counted:
+                total_files += 1
+                # Hardlinked files are archived once, so count their bytes once
+                if entry.nlink > 1:
+                    key = (entry.dev, entry.ino)
+                    counted = key not in seen_inodes
+                    seen_inodes.add(key)
+            if counted:
+                total_bytes += entry.size
+            batch.append((os.fsencode(entry.path), entry.ino, entry.size, entry.mtime_ns,
+                          entry.dev, entry.nlink, entry.mode, int(counted)))
+            if len(batch) >= self.BATCH:
+                db.executemany(insert, batch)
+                batch = []
+        if batch:
+            db.executemany(insert, batch)
+
+        previous = self.last_scan()
+        changed_files, changed_bytes = db.execute('''
+            SELECT COUNT(*), COALESCE(SUM(n.size), 0) FROM scan_new n
+            LEFT JOIN files o ON o.path = n.path
+            WHERE n.counted = 1
+              AND (o.path IS NULL OR o.ino != n.ino OR o.size != n.size OR o.mtime_ns != n.mtime_ns)
+        ''').fetchone()
+        removed_files = db.execute('''
+            SELECT COUNT(*) FROM files o
+            WHERE o.counted = 1 AND NOT EXISTS (SELECT 1 FROM scan_new n WHERE n.path = o.path)
+        ''').fetchone()[0]
+
+        scan_time = time.time()
+        result = {
+            'scan_time': scan_time,
+            'total_bytes': total_bytes,
+            'total_files': total_files,
+            'changed_bytes': changed_bytes,
+            'changed_files': changed_files,
+            'removed_files': removed_files,
+            'previous_scan_time': previous['scan_time'] if previous else None,
+        }
+
+        if update:
+            with db:
+                db.execute('DROP TABLE files')
+                db.execute('ALTER TABLE scan_new RENAME TO files')
+                db.execute('INSERT INTO history VALUES (?, ?, ?, ?, ?)',
+                           (scan_time, total_bytes, total_files, changed_bytes, changed_files))
+        else:
+            db.execute('DROP TABLE scan_new')
+        return result
+
+    def change_rate(self, max_scans=10):
+        """Average changed bytes per hour across recent consecutive scans (None without history)"""
+        rows = self.db.execute(
+            'SELECT scan_time, changed_bytes FROM history ORDER BY scan_time DESC LIMIT ?', (max_scans,)).fetchall()
+        rows.reverse()
+        # The first scan ever reports every file as changed, so only use intervals between scans
+        intervals = [(b[0] - a[0], b[1]) for a, b in zip(rows, rows[1:]) if b[0] > a[0]]
+        if not intervals:
+            return None
+        seconds = sum(i[0] for i in intervals)
+        return sum(i[1] for i in intervals) / seconds * 3600
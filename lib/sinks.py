@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+Backup sinks: where backup streams are written besides BACKUP_DIR
+
+A sink is named by a URL. Only S3-compatible object storage is implemented
+(AWS S3, MinIO, Ceph RGW, ...):
+
+    s3://BUCKET/PREFIX      endpoint from S3_ENDPOINT (default AWS for AWS_REGION),
+                            credentials from AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+                            [/ AWS_SESSION_TOKEN]
+
+`put` streams stdin (or a file) into one object as a multipart upload. The
+stream is cut into parts that are uploaded by --concurrency threads. At
+most concurrency + 1 parts are held in memory, so a tar pipeline never
+waits on local disk. Each part carries its MD5 and a signed sha256, which
+the server checks, and each part is retried with backoff. The upload id is
+kept in --state-dir. A rerun of the same put lists the parts already on the
+server and skips every part whose MD5 matches. A re-generated stream of
+unchanged data therefore resumes instead of starting over. With
+--status-file, the upload is completed only if the producer wrote exit
+status 0 to that file before closing the stream; a failed tar is then never
+stored as a truncated backup. Once the upload completes, NAME.json is
+written next to the object with its size and sha256.
+
+`get` downloads with concurrent ranged GETs, writes the ranges to stdout in
+order, and fails if the sha256 does not match NAME.json.
+
+Usage:
+    sinks.py put URL NAME [--file PATH] [--state-dir DIR] [--status-file FILE]
+                          [--part-bytes N] [--concurrency N] [--format json|shell]
+    sinks.py get URL NAME [--concurrency N]
+    sinks.py list URL [--format json|shell]
+    sinks.py head URL NAME
+    sinks.py delete URL NAME
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+import catalog
+
+PART_BYTES = 32 * 1024 * 1024
+MIN_PART_BYTES = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# Part size doubles every PARTS_PER_STEP parts, so unbounded streams fit in MAX_PARTS
+PARTS_PER_STEP = 2000
+RANGE_BYTES = 16 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+ATTEMPTS = 6
+TIMEOUT = 120
+SIDECAR = '.json'
+
+
+class SinkError(Exception):
+    pass
+
+
+class _HTTPError(SinkError):
+    def __init__(self, status, body):
+        self.status = status
+        code = _find(_xml(body), 'Code') if body.startswith(b'<') else None
+        self.code = code
+        super().__init__(f'HTTP {status}{" " + code if code else ""}: {body[:300].decode(errors="replace")}')
+
+
+def _xml(body):
+    root = ET.fromstring(body)
+    # Drop namespaces so lookups do not depend on the server
+    for element in root.iter():
+        element.tag = element.tag.rsplit('}', 1)[-1]
+    return root
+
+
+def _find(root, tag):
+    element = root.find(f'.//{tag}')
+    return element.text if element is not None else None
+
+
+def part_size(number, base):
+    """Size of 1-based part `number`; deterministic so a rerun cuts the same parts"""
+    return base << min((number - 1) // PARTS_PER_STEP, 10)
+
+
+class S3:
+    """Minimal SigV4 S3 client on http.client, one keep-alive connection per thread"""
+
+    def __init__(self, bucket, endpoint=None, region=None, access_key=None, secret_key=None, token=None):
+        self.bucket = bucket
+        self.region = region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.token = token if token is not None else os.environ.get('AWS_SESSION_TOKEN')
+        if not self.access_key or not self.secret_key:
+            raise SinkError('AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY must be set')
+        endpoint = endpoint or os.environ.get('S3_ENDPOINT')
+        if endpoint:
+            # Custom endpoints (MinIO and friends) expect path-style addressing
+            parts = urlsplit(endpoint)
+            self.secure = parts.scheme == 'https'
+            self.host = parts.netloc
+            self.base = f'/{bucket}'
+        else:
+            self.secure = True
+            self.host = f'{bucket}.s3.{self.region}.amazonaws.com'
+            self.base = ''
+        self.local = threading.local()
+
+    def _connection(self, fresh=False):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or fresh:
+            if connection is not None:
+                connection.close()
+            cls = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            connection = self.local.connection = cls(self.host, timeout=TIMEOUT)
+        return connection
+
+    def sign(self, method, path, query, headers, payload_hash, now=None):
+        """Add SigV4 Authorization headers (https://docs.aws.amazon.com/AmazonS3/latest/API/sig-v4-header-based-auth.html)"""
+        now = now or datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = amz_date[:8]
+        headers['host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+        if self.token:
+            headers['x-amz-security-token'] = self.token
+        canonical_query = '&'.join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}"
+                                   for k, v in sorted(query.items()))
+        signed = sorted(k.lower() for k in headers)
+        lowered = {k.lower(): str(v).strip() for k, v in headers.items()}
+        canonical = '\n'.join([
+            method, quote(path, safe='/-_.~'), canonical_query,
+            ''.join(f'{k}:{lowered[k]}\n' for k in signed), ';'.join(signed), payload_hash])
+        scope = f'{date}/{self.region}/s3/aws4_request'
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (date, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f"SignedHeaders={';'.join(signed)}, Signature={signature}")
+        return headers
+
+    def request(self, method, key='', query=None, body=b'', headers=None, expect=(200,)):
+        """Signed request with retries on network errors, throttling and 5xx; returns (status, headers, body)"""
+        query = query or {}
+        path = f'{self.base}/{key}' if key else (self.base or '/')
+        payload_hash = hashlib.sha256(body).hexdigest()
+        url = quote(path, safe='/-_.~')
+        if query:
+            url += '?' + '&'.join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" if v != '' else
+                                  quote(k, safe='-_.~') for k, v in sorted(query.items()))
+        for attempt in range(ATTEMPTS):
+            signed = self.sign(method, path, query, dict(headers or {}), payload_hash)
+            try:
+                connection = self._connection(fresh=attempt > 0)
+                connection.request(method, url, body=body, headers=signed)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                error = SinkError(f'{method} {key or self.bucket}: {e}')
+            else:
+                if response.status in expect:
+                    return response.status, {k.lower(): v for k, v in response.getheaders()}, data
+                error = _HTTPError(response.status, data)
+                if response.status < 500 and response.status not in (408, 429):
+                    raise error
+            time.sleep(min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        raise error
+
+    def head(self, key):
+        try:
+            _, headers, _ = self.request('HEAD', key)
+        except _HTTPError as e:
+            if e.status == 404:
+                return None
+            raise
+        return headers
+
+    def get(self, key, start=None, end=None):
+        headers = {'Range': f'bytes={start}-{end}'} if start is not None else {}
+        return self.request('GET', key, headers=headers, expect=(200, 206))[2]
+
+    def put(self, key, body, content_type='application/octet-stream'):
+        self.request('PUT', key, body=body, headers={
+            'Content-Type': content_type,
+            'Content-MD5': base64.b64encode(hashlib.md5(body).digest()).decode()})
+
+    def delete(self, key):
+        self.request('DELETE', key, expect=(200, 204))
+
+    def list(self, prefix):
+        """Yield (key, size) under prefix"""
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix}
+            if token:
+                query['continuation-token'] = token
+            root = _xml(self.request('GET', query=query)[2])
+            for item in root.iter('Contents'):
+                yield _find(item, 'Key'), int(_find(item, 'Size'))
+            token = _find(root, 'NextContinuationToken')
+            if _find(root, 'IsTruncated') != 'true' or not token:
+                return
+
+    def create_upload(self, key):
+        return _find(_xml(self.request('POST', key, query={'uploads': ''})[2]), 'UploadId')
+
+    def upload_part(self, key, upload_id, number, data):
+        md5 = hashlib.md5(data)
+        _, headers, _ = self.request('PUT', key, query={'partNumber': number, 'uploadId': upload_id}, body=data,
+                                     headers={'Content-MD5': base64.b64encode(md5.digest()).decode()})
+        # The server rejects a body that does not match Content-MD5. Its ETag is the MD5 too,
+        # except with SSE-KMS, and completing the upload needs the ETag itself.
+        return headers.get('etag', '').strip('"') or md5.hexdigest()
+
+    def list_parts(self, key, upload_id):
+        """{part number: (etag, size)} already uploaded, or None if the upload is gone"""
+        parts = {}
+        marker = 0
+        while True:
+            try:
+                body = self.request('GET', key, query={'uploadId': upload_id, 'part-number-marker': marker})[2]
+            except _HTTPError as e:
+                if e.status == 404:
+                    return None
+                raise
+            root = _xml(body)
+            for part in root.iter('Part'):
+                parts[int(_find(part, 'PartNumber'))] = (_find(part, 'ETag').strip('"'), int(_find(part, 'Size')))
+            if _find(root, 'IsTruncated') != 'true':
+                return parts
+            marker = _find(root, 'NextPartNumberMarker')
+
+    def complete_upload(self, key, upload_id, etags):
+        body = '<CompleteMultipartUpload>' + ''.join(
+            f'<Part><PartNumber>{n}</PartNumber><ETag>"{etag}"</ETag></Part>' for n, etag in sorted(etags.items())
+        ) + '</CompleteMultipartUpload>'
+        _, _, data = self.request('POST', key, query={'uploadId': upload_id}, body=body.encode())
+        # S3 can report a failure inside a 200 response
+        root = _xml(data)
+        if root.tag == 'Error':
+            raise SinkError(f"complete {key}: {_find(root, 'Code')}: {_find(root, 'Message')}")
+
+    def abort_upload(self, key, upload_id):
+        self.request('DELETE', key, query={'uploadId': upload_id}, expect=(200, 204, 404))
+
+    def pending_uploads(self, key):
+        root = _xml(self.request('GET', query={'uploads': '', 'prefix': key})[2])
+        return [_find(u, 'UploadId') for u in root.iter('Upload') if _find(u, 'Key') == key]
+
+
+class S3Sink:
+    """Backups stored as objects under s3://BUCKET/PREFIX"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        if parts.scheme != 's3' or not parts.netloc:
+            raise SinkError(f'unsupported sink URL: {url} (expected s3://BUCKET/PREFIX)')
+        self.url = url.rstrip('/')
+        self.prefix = parts.path.strip('/')
+        self.client = S3(parts.netloc)
+
+    def key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def _state_path(self, state_dir, name):
+        return os.path.join(state_dir, f'{name}.upload.json') if state_dir else None
+
+    def put(self, name, stream, state_dir=None, part_bytes=PART_BYTES, concurrency=DEFAULT_CONCURRENCY,
+            status_file=None):
+        """Upload a stream as NAME; returns the sidecar metadata"""
+        key = self.key(name)
+        state_path = self._state_path(state_dir, name)
+        upload_id, existing = None, {}
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get('part_bytes') == part_bytes:
+                existing = self.client.list_parts(key, state['upload_id'])
+                upload_id = state['upload_id'] if existing is not None else None
+                existing = existing or {}
+        if upload_id is None:
+            upload_id = self.client.create_upload(key)
+            if state_path:
+                os.makedirs(state_dir, exist_ok=True)
+                catalog.write_json_atomic(state_path, {'key': key, 'upload_id': upload_id,
+                                                       'part_bytes': part_bytes, 'started': time.time()})
+
+        started = time.time()
+        digest = hashlib.sha256()
+        etags = {}
+        resumed = 0
+        size = 0
+        # Bounds the parts in memory: one being read plus `concurrency` uploading
+        slots = threading.BoundedSemaphore(concurrency)
+        failures = []
+
+        def upload(number, data):
+            try:
+                etags[number] = self.client.upload_part(key, upload_id, number, data)
+            except Exception as e:  # reported after the executor drains
+                failures.append(e)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            number = 0
+            while not failures:
+                number += 1
+                if number > MAX_PARTS:
+                    raise SinkError(f'stream exceeds {MAX_PARTS} parts')
+                data = _read_exact(stream, part_size(number, part_bytes))
+                if not data and number > 1:
+                    break
+                digest.update(data)
+                size += len(data)
+                uploaded = existing.get(number)
+                if uploaded and uploaded[1] == len(data) and uploaded[0] == hashlib.md5(data).hexdigest():
+                    etags[number] = uploaded[0]
+                    resumed += 1
+                else:
+                    slots.acquire()
+                    executor.submit(upload, number, data)
+                if len(data) < part_size(number, part_bytes):
+                    break
+        if failures:
+            raise SinkError(f'upload of {name} failed (rerun to resume): {failures[0]}')
+        if status_file:
+            # The producer writes its exit status before closing the pipe
+            try:
+                with open(status_file) as f:
+                    status = f.read().strip()
+            except OSError:
+                status = 'missing'
+            if status != '0':
+                raise SinkError(f'stream producer exited with status {status}; {name} left incomplete')
+
+        self.client.complete_upload(key, upload_id, etags)
+        head = self.client.head(key)
+        if head is None or int(head.get('content-length', -1)) != size:
+            raise SinkError(f'{key}: stored size does not match the {size} bytes sent')
+        meta = {'name': name, 'size': size, 'sha256': digest.hexdigest(), 'parts': len(etags),
+                'resumed_parts': resumed, 'part_bytes': part_bytes,
+                'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'seconds': round(time.time() - started, 3)}
+        self.client.put(key + SIDECAR, json.dumps(meta, indent=2).encode(), 'application/json')
+        if state_path and os.path.exists(state_path):
+            os.unlink(state_path)
+        return meta
+
+    def head(self, name):
+        """Sidecar metadata of a completed backup, or None"""
+        try:
+            return json.loads(self.client.get(self.key(name) + SIDECAR))
+        except _HTTPError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def get(self, name, out, concurrency=DEFAULT_CONCURRENCY, range_bytes=RANGE_BYTES):
+        """Write the object to a binary file object with ranged GETs; verifies sha256"""
+        meta = self.head(name)
+        if meta is None:
+            raise SinkError(f'{self.url}/{name} not found')
+        key = self.key(name)
+        size = meta['size']
+        digest = hashlib.sha256()
+        ranges = [(start, min(start + range_bytes, size) - 1) for start in range(0, size, range_bytes)]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Keep a window of requests in flight and write them back in order
+            window = []
+            pending = iter(ranges)
+            for start, end in pending:
+                window.append(executor.submit(self.client.get, key, start, end))
+                if len(window) > concurrency * 2:
+                    break
+            while window:
+                data = window.pop(0).result()
+                digest.update(data)
+                out.write(data)
+                following = next(pending, None)
+                if following:
+                    window.append(executor.submit(self.client.get, key, *following))
+        out.flush()
+        if digest.hexdigest() != meta['sha256']:
+            raise SinkError(f'{name}: sha256 {digest.hexdigest()} does not match {meta["sha256"]}')
+        return meta
+
+    def list(self):
+        """Completed backups as (name, size), newest first"""
+        prefix = self.key('')
+        objects = dict(self.client.list(prefix))
+        names = [k[len(prefix):] for k in objects if not k.endswith(SIDECAR) and k + SIDECAR in objects]
+        return sorted(((name, objects[prefix + name]) for name in names), reverse=True)
+
+    def delete(self, name):
+        key = self.key(name)
+        for upload_id in self.client.pending_uploads(key):
+            self.client.abort_upload(key, upload_id)
+        self.client.delete(key + SIDECAR)
+        self.client.delete(key)
+
+
+def _read_exact(stream, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        data = stream.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+def open_sink(url):
+    if url.startswith('s3://'):
+        return S3Sink(url)
+    raise SinkError(f'unsupported sink URL: {url}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remote backup sinks')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('put')
+    p.add_argument('url')
+    p.add_argument('name')
+    p.add_argument('--file', help='Upload this file instead of stdin')
+    p.add_argument('--state-dir', help='Keep the upload id here so a rerun resumes')
+    p.add_argument('--status-file', help='Complete only if the producer wrote exit status 0 here')
+    p.add_argument('--part-bytes', type=int, default=PART_BYTES)
+    p.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    p.add_argument('--format', choices=['json', 'shell'], default='json')
+
+    p = sub.add_parser('get')
+    p.add_argument('url')
+    p.add_argument('name')
+    p.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+
+    p = sub.add_parser('list')
+    p.add_argument('url')
+    p.add_argument('--format', choices=['json', 'shell'], default='shell')
+
+    for mode in ('head', 'delete'):
+        p = sub.add_parser(mode)
+        p.add_argument('url')
+        p.add_argument('name')
+
+    args = parser.parse_args()
+
+    try:
+        sink = open_sink(args.url)
+        if args.mode == 'put':
+            if args.part_bytes < MIN_PART_BYTES:
+                parser.error(f'--part-bytes must be at least {MIN_PART_BYTES}')
+            stream = open(args.file, 'rb') if args.file else sys.stdin.buffer
+            with stream:
+                meta = sink.put(args.name, stream, args.state_dir, args.part_bytes, max(1, args.concurrency),
+                                args.status_file)
+            if args.format == 'json':
+                print(json.dumps(meta, indent=2))
+            else:
+                for key in ('size', 'sha256', 'parts', 'resumed_parts', 'seconds'):
+                    print(f'{key.upper()}={meta[key]}')
+        elif args.mode == 'get':
+            sink.get(args.name, sys.stdout.buffer, max(1, args.concurrency))
+        elif args.mode == 'list':
+            backups = sink.list()
+            if args.format == 'json':
+                print(json.dumps([{'name': n, 'size': s} for n, s in backups], indent=2))
+            else:
+                for name, size in backups:
+                    print(f'{name}\t{size}')
+        elif args.mode == 'head':
+            meta = sink.head(args.name)
+            if meta is None:
+                print(f'{args.url}/{args.name} not found', file=sys.stderr)
+                sys.exit(1)
+            print(json.dumps(meta, indent=2))
+        else:
+            sink.delete(args.name)
+    except SinkError as e:
+        print(f'Sink {args.mode} failed: {e}', file=sys.stderr)
+        sys.exit(1)
+    except BrokenPipeError:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+"""
+Structured system state, captured with every backup
+
+Collects what scripts/current_system_state.sh prints (host, user and
+groups, Docker, tool paths, shell aliases, service status) plus the
+installed packages, the kernel command line and loaded modules, and the
+kernel build and GRUB configuration, as JSON.
+
+Probes run concurrently, each under its own timeout. A probe that fails
+or times out is recorded under "errors" and the rest of the state is
+kept. Probes whose inputs are files (the package database, the Docker
+binary, /boot/config-*) are fingerprinted by those files' mtimes and
+sizes. Their last result is reused from BACKUP_DIR/.toolkit/state-cache.json
+until a fingerprint changes, so a package list is only re-read after
+packages change.
+
+A state is stored once under BACKUP_DIR/.toolkit/states/<id>.json, where
+the id is a digest of its content. Catalog entries refer to it through
+`system_state`. Backups taken while nothing changed share one file, and
+two states with the same id are known to be equal without reading them.
+Volatile readings (load, free memory and disk) are not part of the state;
+they are stored in the catalog entry as `system_resources`.
+
+Usage:
+    system_state.py capture --backup-dir DIR [--attach ID] [--format json|shell]
+    system_state.py show --backup-dir DIR [BACKUP|STATE_ID|current] [--format text|json]
+    system_state.py diff --backup-dir DIR OLD NEW [--format text|json]
+    system_state.py prune --backup-dir DIR
+"""
+
+import argparse
+import getpass
+import glob
+import grp
+import hashlib
+import json
+import os
+import pwd
+import queue
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import catalog
+
+STATES_DIRNAME = 'states'
+CACHE_FILENAME = 'state-cache.json'
+ID_LENGTH = 16
+# Seconds a probe may overrun its own timeout before it is given up on
+GRACE_SECONDS = 1
+TOOLS = ('curl', 'wget', 'git', 'htop', 'tree', 'jq', 'tmux', 'mc', 'docker', 'docker-compose', 'ctop',
+         'tar', 'rsync', 'zstd', 'xz', 'btrfs', 'lvcreate', 'timeshift', 'python3')
+SERVICES = ('docker', 'containerd', 'ssh', 'sshd', 'cron', 'crond')
+DOCKER_PLUGIN_DIRS = ('/usr/libexec/docker/cli-plugins', '/usr/lib/docker/cli-plugins',
+                      '/usr/local/lib/docker/cli-plugins')
+PACKAGE_DATABASES = ('/var/lib/dpkg/status', '/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/Packages',
+                     '/var/lib/pacman/local')
+ALIAS_RE = re.compile(r'^\s*alias\s+([^=\s]+)=(.*)$')
+
+Probe = namedtuple('Probe', 'name collect timeout fingerprint')
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _run(command, timeout):
+    """stdout of command; a non-zero exit raises ProbeError"""
+    result = subprocess.run(command, capture_output=True, text=True, timeout=timeout,
+                            stdin=subprocess.DEVNULL)
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()
+        raise ProbeError(message[-1] if message else f'{command[0]} exited with status {result.returncode}')
+    return result.stdout
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _stamps(paths):
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps.append([path, st.st_mtime_ns, st.st_size])
+        except OSError:
+            stamps.append([path, None, None])
+    return stamps
+
+
+def _key_values(text, prefix=''):
+    """KEY=value lines (os-release, /etc/default/grub) as a dict, quotes removed"""
+    values = {}
+    for line in (text or '').splitlines():
+        key, sep, value = line.strip().partition('=')
+        if sep and key.startswith(prefix) and not key.startswith('#'):
+            values[key] = value.strip().strip('"\'')
+    return values
+
+
+def probe_host(timeout):
+    uname = os.uname()
+    meminfo = _key_values((_read('/proc/meminfo') or '').replace(':', '='))
+    os_release = _key_values(_read('/etc/os-release'))
+    return {
+        'hostname': socket.gethostname(),
+        'os': os_release.get('PRETTY_NAME'),
+        'os_id': os_release.get('ID'),
+        'os_version': os_release.get('VERSION_ID'),
+        'kernel': uname.release,
+        'kernel_version': uname.version,
+        'machine': uname.machine,
+        'cpus': os.cpu_count(),
+        'memory_bytes': int(meminfo['MemTotal'].split()[0]) * 1024 if 'MemTotal' in meminfo else None,
+    }
+
+
+def probe_user(timeout):
+    # Under sudo, describe the user who ran the toolkit rather than root
+    name = os.environ.get('SUDO_USER') or getpass.getuser()
+    groups = {g.gr_name for g in grp.getgrall() if name in g.gr_mem}
+    try:
+        groups.add(grp.getgrgid(pwd.getpwnam(name).pw_gid).gr_name)
+    except KeyError:
+        pass
+    return {'name': name, 'groups': sorted(groups)}
+
+
+def probe_tools(timeout):
+    return {tool: shutil.which(tool) for tool in TOOLS}
+
+
+def probe_docker(timeout):
+    docker = shutil.which('docker')
+    if not docker:
+        return {'installed': False}
+    try:
+        compose = _run([docker, 'compose', 'version'], timeout).strip()
+    except ProbeError:
+        compose = None
+    return {'installed': True, 'version': _run([docker, '--version'], timeout).strip(), 'compose': compose}
+
+
+def docker_fingerprint():
+    return _stamps([shutil.which('docker') or 'docker', shutil.which('docker-compose') or 'docker-compose',
+                    *DOCKER_PLUGIN_DIRS])
+
+
+def probe_aliases(timeout):
+    aliases = {}
+    for path in sorted(glob.glob('/etc/profile.d/*.sh')):
+        for line in (_read(path) or '').splitlines():
+            match = ALIAS_RE.match(line)
+            if match:
+                aliases[match.group(1)] = match.group(2).strip().strip('"\'')
+    return aliases
+
+
+def probe_services(timeout):
+    systemctl = shutil.which('systemctl')
+    if not systemctl:
+        raise ProbeError('systemctl not found')
+    output = _run([systemctl, 'show', '--no-pager', '--property=Id,LoadState,ActiveState,UnitFileState',
+                   *SERVICES], timeout)
+    services = {}
+    for block in output.strip().split('\n\n'):
+        unit = _key_values(block)
+        if unit.get('LoadState') == 'loaded':
+            services[unit['Id']] = {'active': unit.get('ActiveState'), 'enabled': unit.get('UnitFileState')}
+    return services
+
+
+def probe_packages(timeout):
+    if shutil.which('dpkg-query'):
+        output = _run(['dpkg-query', '-W', '-f=${db:Status-Abbrev}\t${binary:Package}\t${Version}\n'], timeout)
+        rows = [line.split('\t')[1:] for line in output.splitlines() if line.startswith('i')]
+        manager = 'dpkg'
+    elif shutil.which('rpm'):
+        output = _run(['rpm', '-qa', '--qf', '%{NAME}.%{ARCH}\t%{VERSION}-%{RELEASE}\n'], timeout)
+        rows = [line.split('\t') for line in output.splitlines()]
+        manager = 'rpm'
+    elif shutil.which('pacman'):
+        rows = [line.split(' ', 1) for line in _run(['pacman', '-Q'], timeout).splitlines()]
+        manager = 'pacman'
+    else:
+        raise ProbeError('no dpkg, rpm or pacman found')
+    installed = {row[0]: row[1] for row in rows if len(row) == 2}
+    return {'manager': manager, 'count': len(installed), 'installed': installed}
+
+
+def packages_fingerprint():
+    return _stamps(PACKAGE_DATABASES)
+
+
+def probe_kernel(timeout):
+    modules = [line.split(' ', 1)[0] for line in (_read('/proc/modules') or '').splitlines()]
+    return {'cmdline': (_read('/proc/cmdline') or '').strip() or None, 'modules': sorted(modules)}
+
+
+def probe_boot(timeout):
+    config = _read(f'/boot/config-{os.uname().release}')
+    grub = dict(_key_values(_read('/etc/default/grub'), 'GRUB_'))
+    for path in sorted(glob.glob('/etc/default/grub.d/*.cfg')):
+        grub.update(_key_values(_read(path), 'GRUB_'))
+    return {
+        # Options that are set; "# CONFIG_X is not set" lines are left out
+        'kernel_config': _key_values(config, 'CONFIG_') if config else None,
+        'grub': grub,
+    }
+
+
+def boot_fingerprint():
+    return _stamps([f'/boot/config-{os.uname().release}', '/etc/default/grub', '/etc/default/grub.d'])
+
+
+PROBES = (
+    Probe('host', probe_host, 2, None),
+    Probe('user', probe_user, 2, None),
+    Probe('tools', probe_tools, 2, None),
+    Probe('docker', probe_docker, 10, docker_fingerprint),
+    Probe('aliases', probe_aliases, 2, None),
+    Probe('services', probe_services, 5, None),
+    Probe('packages', probe_packages, 30, packages_fingerprint),
+    Probe('kernel', probe_kernel, 2, None),
+    Probe('boot', probe_boot, 5, boot_fingerprint),
+)
+
+
+def resources(backup_dir=None):
+    """Readings that change all the time, kept out of the state and its id"""
+    meminfo = _key_values((_read('/proc/meminfo') or '').replace(':', '='))
+    readings = {'load': list(os.getloadavg()) if hasattr(os, 'getloadavg') else None}
+    if 'MemAvailable' in meminfo:
+        readings['memory_available_bytes'] = int(meminfo['MemAvailable'].split()[0]) * 1024
+    uptime = _read('/proc/uptime')
+    readings['uptime_seconds'] = round(float(uptime.split()[0])) if uptime else None
+    readings['disks'] = {}
+    for path in dict.fromkeys(p for p in ('/', backup_dir) if p):
+        try:
+            usage = shutil.disk_usage(path)
+        except OSError:
+            continue
+        readings['disks'][path] = {'total': usage.total, 'used': usage.used, 'free': usage.free}
+    return readings
+
+
+def states_dir(backup_dir):
+    path = os.path.join(catalog.state_dir(backup_dir), STATES_DIRNAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _run_probe(probe, results):
+    """Thread body: put (name, (result, seconds), None) or (name, None, exception) on results"""
+    started = time.perf_counter()
+    try:
+        result = probe.collect(probe.timeout)
+    except Exception as e:
+        results.put((probe.name, None, e))
+        return
+    results.put((probe.name, (result, time.perf_counter() - started), None))
+
+
+def collect(backup_dir=None):
+    """(state, meta): the state holds the probe results and errors; meta says how it was gathered"""
+    started = time.perf_counter()
+    cache_path = os.path.join(catalog.state_dir(backup_dir), CACHE_FILENAME) if backup_dir else None
+    cache = _load_cache(cache_path) if cache_path else {}
+    facts, errors, timings, cached = {}, {}, {}, []
+
+    pending = []
+    for probe in PROBES:
+        fingerprint = probe.fingerprint() if probe.fingerprint else None
+        entry = cache.get(probe.name)
+        if fingerprint is not None and entry and entry.get('fingerprint') == fingerprint:
+            facts[probe.name] = entry['result']
+            cached.append(probe.name)
+        else:
+            pending.append((probe, fingerprint))
+
+    # Daemon threads rather than an executor, whose workers are joined at interpreter
+    # exit: a probe stuck past its timeout (a hung NSS lookup or mount) is abandoned
+    results = queue.Queue()
+    launched = time.monotonic()
+    deadlines = {}
+    for probe, _ in pending:
+        deadlines[probe.name] = launched + probe.timeout + GRACE_SECONDS
+        threading.Thread(target=_run_probe, args=(probe, results), name=f'probe-{probe.name}',
+                         daemon=True).start()
+    outcomes = {}
+    while len(outcomes) < len(pending):
+        remaining = max(d for name, d in deadlines.items() if name not in outcomes) - time.monotonic()
+        try:
+            name, value, error = results.get(timeout=max(0, remaining))
+        except queue.Empty:
+            break
+        outcomes[name] = (value, error)
+
+    cache_changed = False
+    for probe, fingerprint in pending:
+        if probe.name not in outcomes:
+            errors[probe.name] = f'no result within {probe.timeout}s'
+            continue
+        value, error = outcomes[probe.name]
+        if isinstance(error, subprocess.TimeoutExpired):
+            errors[probe.name] = f'timed out after {probe.timeout}s'
+            continue
+        if isinstance(error, (OSError, ValueError, KeyError, ProbeError, subprocess.SubprocessError)):
+            errors[probe.name] = str(error) or type(error).__name__
+            continue
+        if error is not None:
+            raise error
+        result, seconds = value
+        facts[probe.name] = result
+        timings[probe.name] = round(seconds * 1000, 1)
+        if fingerprint is not None:
+            cache[probe.name] = {'fingerprint': fingerprint, 'result': result}
+            cache_changed = True
+
+    if cache_changed and cache_path:
+        try:
+            catalog.write_json_atomic(cache_path, cache)
+        except OSError:
+            pass
+    meta = {
+        'captured': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'seconds': round(time.perf_counter() - started, 3),
+        'cached': cached,
+        'timings_ms': timings,
+        'resources': resources(backup_dir),
+    }
+    return {'facts': facts, 'errors': errors}, meta
+
+
+def state_id(state):
+    canonical = json.dumps(state, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha256(canonical).hexdigest()[:ID_LENGTH]
+
+
+def store(backup_dir, state):
+    """Write state under its id unless an identical one is stored; returns (id, newly written)"""
+    sid = state_id(state)
+    path = os.path.join(states_dir(backup_dir), f'{sid}.json')
+    if os.path.exists(path):
+        return sid, False
+    catalog.write_json_atomic(path, state)
+    return sid, True
+
+
+def load(backup_dir, sid):
+    with open(os.path.join(backup_dir, catalog.STATE_DIRNAME, STATES_DIRNAME, f'{sid}.json')) as f:
+        return json.load(f)
+
+
+def capture(backup_dir, attach=None):
+    state, meta = collect(backup_dir)
+    sid, new = store(backup_dir, state)
+    if attach:
+        catalog.update_entry(backup_dir, attach, {'system_state': sid, 'system_state_captured': meta['captured'],
+                                                  'system_resources': meta['resources']})
+    return dict(meta, id=sid, new=new, probes=len(PROBES), errors=state['errors'])
+
+
+def resolve(backup_dir, ref):
+    """(id, state, meta) for 'current', a stored state id or a backup name or id"""
+    if ref == 'current':
+        state, meta = collect(backup_dir)
+        return state_id(state), state, meta
+    if re.fullmatch(r'[0-9a-f]{%d}' % ID_LENGTH, ref):
+        try:
+            return ref, load(backup_dir, ref), {}
+        except FileNotFoundError:
+            pass
+    entry = catalog.load_entry(backup_dir, ref)
+    if entry is None:
+        raise ValueError(f'{ref} is neither a backup nor a stored state')
+    if not entry.get('system_state'):
+        raise ValueError(f'no system state was captured with {ref}')
+    meta = {'captured': entry.get('system_state_captured'), 'resources': entry.get('system_resources'),
+            'backup': entry['id']}
+    return entry['system_state'], load(backup_dir, entry['system_state']), meta
+
+
+def prune(backup_dir):
+    """Remove stored states no catalog entry refers to; returns how many went"""
+    referenced = {entry.get('system_state') for entry in catalog.list_entries(backup_dir)}
+    directory = os.path.join(backup_dir, catalog.STATE_DIRNAME, STATES_DIRNAME)
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if name.endswith('.json') and name[:-len('.json')] not in referenced:
+            os.unlink(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+
+def _flatten(value, path, out):
+    if isinstance(value, dict) and value:
+        for key, item in value.items():
+            _flatten(item, f'{path}.{key}' if path else str(key), out)
+    else:
+        out[path] = value
+    return out
+
+
+def diff(old, new):
+    """Changes between two states as (kind, path, old value, new value), kind being + - or ~
+
+    Lists of strings (groups, modules) are compared as sets, one change per item.
+    """
+    # Paths start at the probe name; failed probes show up under errors
+    before = _flatten(dict(old['facts'], errors=old['errors']), '', {})
+    after = _flatten(dict(new['facts'], errors=new['errors']), '', {})
+    changes = []
+    for path in sorted(before.keys() | after.keys()):
+        a, b = before.get(path), after.get(path)
+        if a == b:
+            continue
+        if path not in before:
+            changes.append(('+', path, None, b))
+        elif path not in after:
+            changes.append(('-', path, a, None))
+        elif all(isinstance(v, list) and all(isinstance(i, str) for i in v) for v in (a, b)):
+            changes.extend(('-', path, item, None) for item in sorted(set(a) - set(b)))
+            changes.extend(('+', path, None, item) for item in sorted(set(b) - set(a)))
+        else:
+            changes.append(('~', path, a, b))
+    return changes
+
+
+def _size(value):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if value < 1024 or unit == 'TiB':
+            return f'{value:.1f} {unit}' if unit != 'B' else f'{value} B'
+        value /= 1024
+
+
+def print_state(sid, state, meta):
+    facts, errors = state['facts'], state['errors']
+    print(f"System state {sid}" + (f" (captured {meta['captured']})" if meta.get('captured') else ''))
+    host = facts.get('host')
+    if host:
+        memory = f", {_size(host['memory_bytes'])} memory" if host.get('memory_bytes') else ''
+        print(f"  Host:      {host['hostname']}, {host.get('os') or 'unknown OS'}, "
+              f"kernel {host['kernel']} ({host['machine']}), {host['cpus']} CPUs{memory}")
+    if 'user' in facts:
+        print(f"  User:      {facts['user']['name']} (groups: {', '.join(facts['user']['groups']) or 'none'})")
+    docker = facts.get('docker')
+    if docker:
+        print(f"  Docker:    {docker.get('version') or 'not installed'}"
+              + (f"; {docker['compose']}" if docker.get('compose') else ''))
+    if facts.get('services'):
+        print('  Services:  ' + ', '.join(f"{unit} {info['active']}/{info['enabled']}"
+                                         for unit, info in sorted(facts['services'].items())))
+    if 'tools' in facts:
+        found = [tool for tool, path in facts['tools'].items() if path]
+        missing = [tool for tool, path in facts['tools'].items() if not path]
+        print(f"  Tools:     {', '.join(found) or 'none'}" + (f" (missing: {', '.join(missing)})" if missing else ''))
+    if facts.get('aliases'):
+        print(f"  Aliases:   {', '.join(sorted(facts['aliases']))}")
+    if 'packages' in facts:
+        print(f"  Packages:  {facts['packages']['count']} ({facts['packages']['manager']})")
+    if 'kernel' in facts:
+        print(f"  Kernel:    {len(facts['kernel']['modules'])} modules loaded; cmdline: {facts['kernel']['cmdline']}")
+    boot = facts.get('boot')
+    if boot:
+        config = f"{len(boot['kernel_config'])} kernel config options" if boot['kernel_config'] else 'no kernel config'
+        print(f"  Boot:      {config}, {len(boot['grub'])} GRUB settings")
+    disks = (meta.get('resources') or {}).get('disks') or {}
+    for path, usage in disks.items():
+        print(f"  Disk {path}: {_size(usage['used'])} used, {_size(usage['free'])} free of {_size(usage['total'])}")
+    for name, error in sorted(errors.items()):
+        print(f"  ⚠ {name}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Structured system state')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('capture')
+    p.add_argument('--backup-dir', required=True)
+    p.add_argument('--attach', help='Backup id whose catalog entry records the state')
+    p.add_argument('--format', choices=['json', 'shell'], default='json')
+
+    p = sub.add_parser('show')
+    p.add_argument('--backup-dir', required=True)
+    p.add_argument('ref', nargs='?', default='current', help='Backup name or id, state id, or current')
+    p.add_argument('--format', choices=['text', 'json'], default='text')
+
+    p = sub.add_parser('diff')
+    p.add_argument('--backup-dir', required=True)
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--format', choices=['text', 'json'], default='text')
+
+    p = sub.add_parser('prune')
+    p.add_argument('--backup-dir', required=True)
+
+    args = parser.parse_args()
+
+    try:
+        if args.mode == 'capture':
+            result = capture(args.backup_dir, args.attach)
+            if args.format == 'json':
+                print(json.dumps(result, indent=2))
+            else:
+                print(f"ID={result['id']}")
+                print(f"NEW={int(result['new'])}")
+                print(f"PROBES={result['probes']}")
+                print(f"CACHED={len(result['cached'])}")
+                print(f"ERRORS={','.join(sorted(result['errors']))}")
+                print(f"SECONDS={result['seconds']}")
+        elif args.mode == 'show':
+            sid, state, meta = resolve(args.backup_dir, args.ref)
+            if args.format == 'json':
+                print(json.dumps(dict(meta, id=sid, state=state), indent=2, sort_keys=True))
+            else:
+                print_state(sid, state, meta)
+        elif args.mode == 'diff':
+            old_id, old, _ = resolve(args.backup_dir, args.old)
+            new_id, new, _ = resolve(args.backup_dir, args.new)
+            # Equal ids mean equal content; nothing needs comparing
+            changes = [] if old_id == new_id else diff(old, new)
+            if args.format == 'json':
+                print(json.dumps({'old': old_id, 'new': new_id, 'changes': [
+                    {'change': kind, 'path': path, 'old': a, 'new': b} for kind, path, a, b in changes]}, indent=2))
+            elif not changes:
+                print(f'No changes (state {new_id})')
+            else:
+                for kind, path, a, b in changes:
+                    if kind == '~':
+                        print(f'~ {path}: {json.dumps(a)} -> {json.dumps(b)}')
+                    else:
+                        print(f'{kind} {path}: {json.dumps(b if kind == "+" else a)}')
+                counts = {kind: sum(1 for c in changes if c[0] == kind) for kind in '+-~'}
+                print(f"\n{counts['~']} changed, {counts['+']} added, {counts['-']} removed ({old_id} -> {new_id})")
+        else:
+            print(f'Removed {prune(args.backup_dir)} unreferenced state(s)')
+    except BrokenPipeError:
+        sys.exit(1)
+    except (OSError, ValueError) as e:
+        print(f'System state {args.mode} failed: {e}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
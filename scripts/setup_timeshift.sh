@@ -28,59 +28,16 @@ fi
 # Create timeshift configuration directory
 sudo mkdir -p /etc/timeshift
 
-# Create basic configuration
-cat > /tmp/timeshift_config.json << EOF
-{
-  "backup_device_uuid" : "",
-  "parent_device_uuid" : "",
-  "do_first_run" : "false",
-  "btrfs_mode" : $([ "$BACKEND" = "btrfs" ] && echo "true" || echo "false"),
-  "include_btrfs_home_for_backup" : "false",
-  "include_btrfs_home_for_restore" : "false",
-  "stop_cron_emails" : "true",
-  "schedule_monthly" : "false",
-  "schedule_weekly" : "false",
-  "schedule_daily" : "false",
-  "schedule_hourly" : "false",
-  "schedule_boot" : "false",
-  "count_monthly" : "2",
-  "count_weekly" : "3",
-  "count_daily" : "5",
-  "count_hourly" : "6",
-  "count_boot" : "5",
-  "snapshot_size" : "0",
-  "snapshot_count" : "0",
-  "date_format" : "%Y-%m-%d %H:%M:%S",
-  "exclude_list_default" : [
-    "/dev/*",
-    "/proc/*",
-    "/run/*",
-    "/tmp/*",
-    "/sys/*",
-    "/var/run/*",
-    "/var/lock/*",
-    "/lost+found",
-    "/media/*",
-    "/mnt/*",
-    "/home/*/.cache",
-    "/home/*/.local/share/Trash",
-    "/home/*/.gvfs",
-    "/home/*/.thumbnails",
-    "/home/*/Downloads",
-    "/root/.cache",
-    "/root/.local/share/Trash",
-    "/root/.thumbnails"
-  ],
-  "exclude_list_user" : [],
-  "exclude_list_home" : [
-    "/home/*/.cache",
-    "/home/*/.local/share/Trash", 
-    "/home/*/.gvfs",
-    "/home/*/.thumbnails",
-    "/home/*/Downloads/*"
-  ]
-}
-EOF
+# Generate the configuration from the template; the exclude lists come from
+# the same policy as toolkit backups (configs/excludes.json)
+TOOLKIT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
+BTRFS_ARGS=()
+[ "$BACKEND" = "btrfs" ] && BTRFS_ARGS=(--btrfs)
+
+python3 "$TOOLKIT_DIR/lib/excludes.py" timeshift \
+    --config "${EXCLUDES_FILE:-$TOOLKIT_DIR/configs/excludes.json}" \
+    --template "$TOOLKIT_DIR/configs/timeshift.json" \
+    "${BTRFS_ARGS[@]}" > /tmp/timeshift_config.json
 
 sudo mv /tmp/timeshift_config.json /etc/timeshift/timeshift.json
 sudo chmod 644 /etc/timeshift/timeshift.json
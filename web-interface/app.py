@@ -9,72 +9,474 @@ import sys
 import json
 import subprocess
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+import re
+import fnmatch
+import hmac
+import math
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, g, Response, send_file
+import importlib.util
+import shutil
+import socket
 import threading
 import time
+import zlib
+
+import fleet
+import jsonlog
+import listing
+import logsearch
+import metrics
+import profiler
 
 app = Flask(__name__)
 app.secret_key = 'system-restore-toolkit-secret-key-change-in-production'
 
 # Configuration
-SCRIPT_DIR = "/toolkit"
+SCRIPT_DIR = os.environ.get('TOOLKIT_DIR', "/toolkit")
 TOOLKIT_CMD = os.path.join(SCRIPT_DIR, 'system-restore-toolkit')
+EVENT_LOG = jsonlog.EventLog(os.environ.get(
+    'WEB_EVENT_LOG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-server-events.log')))
+BACKUP_COMMANDS = ('create-backup', 'verify-backup', 'restore-backup', 'list-backups', 'remove-backup')
+BACKUP_EXTENSIONS = ('.tar.gz', '.tar.zst', '.tar.xz', '.tar', '.rsync', '.shards',
+                     '.btrfs.gz', '.btrfs.zst', '.btrfs.xz', '.btrfs')
+BACKUP_ENGINES = ('tar', 'rsync', 'sharded', 'btrfs')
+TASKS_FILE = os.environ.get(
+    'WEB_TASKS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-tasks.json'))
+# Restart sharded/rsync backups that were running when the server went down
+AUTO_RESUME_BACKUPS = os.environ.get('AUTO_RESUME_BACKUPS', '1') == '1'
+BACKUP_STARTED_RE = re.compile(r'(?:Creating full system backup|Resuming backup): (full-backup-[^.\s]+)')
+# Output lines kept per task in TASKS_FILE
+PERSISTED_OUTPUT_LINES = 200
+BACKUP_NAME_RE = re.compile(r'^(?:full|image)-backup-[\w.-]+$')
+# /api/summary is rebuilt at most this often, however many aggregators poll it
+SUMMARY_TTL = int(os.environ.get('SUMMARY_TTL', '60'))
+# Where the toolkit keeps backups: its default when visible here, else the
+# project's backups/ directory (the toolkit's fallback and the Docker mount)
+DEFAULT_BACKUP_DIR = '/var/backups/system-restore-toolkit'
+BACKUP_DIR = os.environ.get('BACKUP_DIR') or (
+    DEFAULT_BACKUP_DIR if os.path.isdir(DEFAULT_BACKUP_DIR) else os.path.join(SCRIPT_DIR, 'backups'))
+# The web server's own logs get the toolkit's rotation rules (see lib/logrotate.py)
+WEB_LOG_DIR = os.path.dirname(os.path.abspath(EVENT_LOG.path))
+LOG_ROTATE_SETTINGS = {
+    'compress_after_hours': float(os.environ.get('LOG_COMPRESS_AFTER_HOURS', '24')),
+    'rotate_bytes': int(os.environ.get('LOG_ROTATE_BYTES', str(64 * 1024 * 1024))),
+    'max_age_days': float(os.environ.get('LOG_RETENTION_DAYS', '30')),
+    'max_bytes': int(os.environ.get('LOG_MAX_BYTES', str(512 * 1024 * 1024))),
+}
+LOG_ROTATE_INTERVAL = 3600
+# Largest slice /api/logs/<file>?offset=&length= returns at once
+MAX_LOG_READ_BYTES = 1024 * 1024
+# Work one /api/logs/search request may do before it stops and says so
+LOG_SEARCH_MAX_BYTES = int(os.environ.get('LOG_SEARCH_MAX_BYTES', str(2 * 1024 ** 3)))
+LOG_SEARCH_TIMEOUT = float(os.environ.get('LOG_SEARCH_TIMEOUT', '10'))
+# Enables /debug/profile for requests that send it; unset, the endpoint is off
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# JSON profiles list this many of the most sampled stacks; ?format=collapsed has them all
+PROFILE_STACKS = 100
+# Toolkit hosts polled by this instance for /fleet (aggregator mode)
+FLEET_CONFIG = os.environ.get('FLEET_CONFIG', os.path.join(SCRIPT_DIR, 'configs', 'fleet.json'))
+
+TIMESHIFT_BIN = os.environ.get('TIMESHIFT_BIN', '/host/var/lib/snapd/hostfs/usr/bin/timeshift')
+TIMESHIFT_SNAPSHOT_RE = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$')
+# Timeshift redraws "12.34% complete (1m 5s remaining)" while it syncs
+TIMESHIFT_PROGRESS_RE = re.compile(r'(\d+(?:\.\d+)?)% complete(?: \((.+?) remaining\))?')
+# Timeshift refuses to run twice at once; queue our own operations instead
+TIMESHIFT_LOCK = threading.Lock()
+
+def load_toolkit_module(name):
+    """Import one of the toolkit's lib/ helpers, or None where the toolkit is not installed"""
+    path = os.path.join(SCRIPT_DIR, 'lib', f'{name}.py')
+    if not os.path.exists(path):
+        return None
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Reads compressed log archives; without it only plain logs can be viewed
+logrotate = load_toolkit_module('logrotate')
+# Says which interrupted backups can be resumed; without it none are
+catalog = load_toolkit_module('catalog')
+RESUMABLE_ENGINES = ('sharded', 'rsync')
+LOG_SUFFIXES = ('.log', '.log.gz') if logrotate else ('.log',)
+
+# Worker threads are named after their task, so profiles can be matched to tasks
+TASK_THREAD_PREFIX = 'task-'
 
 class TaskManager:
-    """Simple task manager for long-running operations"""
-    def __init__(self):
+    """Simple task manager for long-running operations.
+    
+    Tasks are saved to state_file when they start, finish or name their
+    backup, so a restarted server still knows them. Tasks that were running
+    at the time are marked 'interrupted'. The state file belongs to one
+    process: the app must be served by a single process (as `python app.py`
+    does), not by several workers.
+    """
+    def __init__(self, state_file=None):
         self.tasks = {}
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self._load()
     
-    def start_task(self, task_id, command, description):
-        self.tasks[task_id] = {
-            'status': 'running',
-            'description': description,
-            'start_time': datetime.now(),
-            'output': [],
-            'error': None
-        }
+    def _load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        for task in saved:
+            for key in ('start_time', 'end_time'):
+                if task.get(key):
+                    task[key] = datetime.fromisoformat(task[key])
+            if task['status'] == 'running':
+                task['status'] = 'interrupted'
+            self.tasks[task['id']] = task
+    
+    def _save(self):
+        if not self.state_file:
+            return
+        with self.lock:
+            saved = []
+            for task in list(self.tasks.values()):
+                task = dict(task, output=task['output'][-PERSISTED_OUTPUT_LINES:])
+                for key in ('start_time', 'end_time'):
+                    if task.get(key):
+                        task[key] = task[key].isoformat()
+                saved.append(task)
+            temp = f'{self.state_file}.tmp'
+            try:
+                with open(temp, 'w') as f:
+                    json.dump(saved, f)
+                os.replace(temp, self.state_file)
+            except OSError as e:
+                print(f"Could not save tasks to {self.state_file}: {e}", file=sys.stderr)
+    
+    def start_task(self, task_id, command, description, kind=None):
+        self._new_task(task_id, description, kind)
+        self._save()
         
         def run_task():
+            self._span_start(task_id, description, kind)
             try:
-                process = subprocess.Popen(
-                    command, 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    cwd=SCRIPT_DIR
-                )
-                
-                while True:
-                    output = process.stdout.readline()
-                    if output == '' and process.poll() is not None:
-                        break
-                    if output:
-                        self.tasks[task_id]['output'].append(output.strip())
-                
-                rc = process.poll()
+                rc, stderr = self._run_process(task_id, command, kind)
                 if rc == 0:
                     self.tasks[task_id]['status'] = 'completed'
                 else:
                     self.tasks[task_id]['status'] = 'failed'
-                    self.tasks[task_id]['error'] = process.stderr.read()
+                    self.tasks[task_id]['error'] = stderr
                     
             except Exception as e:
                 self.tasks[task_id]['status'] = 'failed'
                 self.tasks[task_id]['error'] = str(e)
+            
+            self._finish(task_id, description, kind)
         
-        thread = threading.Thread(target=run_task)
+        thread = threading.Thread(target=run_task, name=f'{TASK_THREAD_PREFIX}{task_id}')
         thread.start()
         return task_id
     
+    def start_batch(self, task_id, steps, description, kind=None, lock=None, after=None):
+        """Run (label, command) steps one after another in a single task
+        
+        A failed step does not stop the ones after it; the task fails if any
+        step did. With a lock, the steps run only while holding it, so batches
+        of the same kind queue up instead of overlapping. The after command
+        runs once at the end, still under the lock.
+        """
+        self._new_task(task_id, description, kind)
+        task = self.tasks[task_id]
+        task['progress'] = {'done': 0, 'total': len(steps), 'current': None}
+        task['results'] = []
+        self._save()
+        
+        def run_batch():
+            self._span_start(task_id, description, kind)
+            failures = []
+            try:
+                if lock is not None and not lock.acquire(blocking=False):
+                    task['progress']['current'] = 'Waiting for another operation to finish'
+                    lock.acquire()
+                try:
+                    for label, command in steps:
+                        task['progress'].update(current=label, percent=None, remaining=None)
+                        task['output'].append(f'==> {label}')
+                        rc, stderr = self._run_process(task_id, command, kind)
+                        task['results'].append({'step': label, 'status': 'completed' if rc == 0 else 'failed',
+                                                'error': stderr.strip() if rc else None})
+                        if rc != 0:
+                            failures.append(f'{label}: {stderr.strip() or f"exit status {rc}"}')
+                        task['progress']['done'] += 1
+                        self._save()
+                    if after:
+                        task['progress'].update(current='Refreshing', percent=None, remaining=None)
+                        rc, stderr = self._run_process(task_id, after, kind)
+                        if rc != 0:
+                            failures.append(f'refresh: {stderr.strip() or f"exit status {rc}"}')
+                finally:
+                    if lock is not None:
+                        lock.release()
+                task['progress']['current'] = None
+                task['status'] = 'failed' if failures else 'completed'
+                task['error'] = '\n'.join(failures) or None
+            except Exception as e:
+                task['status'] = 'failed'
+                task['error'] = str(e)
+            
+            self._finish(task_id, description, kind)
+        
+        thread = threading.Thread(target=run_batch, name=f'{TASK_THREAD_PREFIX}{task_id}')
+        thread.start()
+        return task_id
+    
+    def _new_task(self, task_id, description, kind):
+        self.tasks[task_id] = {
+            'id': task_id,
+            'status': 'running',
+            'kind': kind,
+            'description': description,
+            'start_time': datetime.now(),
+            'end_time': None,
+            'output': [],
+            'error': None
+        }
+    
+    def _span_start(self, task_id, description, kind):
+        if jsonlog.LOG_FORMAT == 'json':
+            EVENT_LOG.write('info', description, op=task_id, event='span_start', phase=kind or 'task',
+                            start_ns=time.time_ns())
+    
+    def _run_process(self, task_id, command, kind):
+        """Run command, streaming its output into the task; returns (returncode, stderr)"""
+        task = self.tasks[task_id]
+        # The CLI tags its own log lines with our task id so both sides correlate
+        env = dict(os.environ, OPERATION_ID=task_id)
+        process = subprocess.Popen(
+            command, 
+            stdout=subprocess.PIPE, 
+            stderr=subprocess.PIPE,
+            text=True,
+            cwd=SCRIPT_DIR,
+            env=env
+        )
+        
+        progress_line = False
+        while True:
+            output = process.stdout.readline()
+            if output == '' and process.poll() is not None:
+                break
+            if not output:
+                continue
+            line = output.strip()
+            match = TIMESHIFT_PROGRESS_RE.search(line) if kind == 'timeshift' else None
+            if match:
+                # Timeshift redraws one progress line; keep only the latest
+                task.setdefault('progress', {}).update(
+                    percent=float(match.group(1)), remaining=match.group(2))
+                if progress_line:
+                    task['output'][-1] = line
+                else:
+                    task['output'].append(line)
+                progress_line = True
+                continue
+            progress_line = False
+            task['output'].append(line)
+            match = BACKUP_STARTED_RE.search(line) if kind == 'backup' else None
+            if match and 'backup_id' not in task:
+                task['backup_id'] = match.group(1)
+                self._save()
+        
+        return process.wait(), process.stderr.read()
+    
+    def _finish(self, task_id, description, kind):
+        task = self.tasks[task_id]
+        task['end_time'] = datetime.now()
+        if jsonlog.LOG_FORMAT == 'json':
+            duration = (task['end_time'] - task['start_time']).total_seconds()
+            EVENT_LOG.write('error' if task['status'] == 'failed' else 'info', description, op=task_id,
+                            event='span_end', phase=kind or 'task', status=task['status'],
+                            duration_ms=int(duration * 1000))
+        if kind == 'backup':
+            record_backup_metrics(task)
+        self._save()
+    
     def get_task(self, task_id):
         return self.tasks.get(task_id)
+    
+    def resume_interrupted(self):
+        """Start `create-backup --resume` for each interrupted backup that can be resumed
+        
+        Only backups whose catalog entry is still in-progress and that were
+        made by a resumable engine (sharded, rsync) or sent to a BACKUP_SINK
+        qualify; the toolkit cannot continue anything else.
+        """
+        for task in list(self.tasks.values()):
+            if task['status'] != 'interrupted' or task.get('kind') != 'backup':
+                continue
+            if not task.get('backup_id') or task.get('resumed_by'):
+                continue
+            entry = catalog.load_entry(BACKUP_DIR, task['backup_id']) if catalog else None
+            if not entry or entry.get('status') != 'in-progress':
+                continue
+            if entry.get('engine') not in RESUMABLE_ENGINES and not entry.get('sink'):
+                continue
+            task['resumed_by'] = f"resume_{task['backup_id']}_{int(time.time())}"
+            self.start_task(
+                task['resumed_by'],
+                [TOOLKIT_CMD, 'create-backup', '--resume', task['backup_id']],
+                f"Resuming backup: {task['backup_id']}",
+                kind='backup'
+            )
+    
+    def status_counts(self):
+        counts = {('running',): 0, ('completed',): 0, ('failed',): 0}
+        for task in list(self.tasks.values()):
+            key = (task['status'],)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+task_manager = TaskManager(TASKS_FILE)
+fleet_poller = fleet.FleetPoller(FLEET_CONFIG)
+backup_index = listing.BackupIndex(BACKUP_DIR)
+timeshift_index = listing.TimeshiftIndex(os.path.join(SCRIPT_DIR, 'shared-data', 'timeshift-info.json'))
+
+TASKS_GAUGE = metrics.Gauge(
+    'srt_tasks', 'Background tasks known to the task manager, by status', ['status'],
+    callback=task_manager.status_counts)
+
+BACKUP_CREATED_RE = re.compile(r'Backup created: (\S+) \((\d+) bytes\)')
+
+def record_backup_metrics(task):
+    """Record duration, size and throughput of a finished backup task"""
+    metrics.BACKUPS.inc(status=task['status'])
+    if task['status'] != 'completed':
+        return
+    
+    duration = (task['end_time'] - task['start_time']).total_seconds()
+    metrics.BACKUP_DURATION.observe(duration)
+    metrics.BACKUP_LAST_SUCCESS.set(time.time())
+    
+    for line in task['output']:
+        match = BACKUP_CREATED_RE.search(line)
+        if match:
+            backup_bytes = int(match.group(2))
+            metrics.BACKUP_BYTES.inc(backup_bytes)
+            metrics.BACKUP_LAST_BYTES.set(backup_bytes)
+            metrics.BACKUP_LAST_THROUGHPUT.set(backup_bytes / duration if duration > 0 else 0)
+            break
+    
+    # Per-phase timings are only available when the CLI writes JSON logs
+    toolkit_log = os.path.join(SCRIPT_DIR, "logs", f'toolkit-{task["start_time"].strftime("%Y%m%d")}.log')
+    for event in jsonlog.iter_events(toolkit_log, op=task['id'], event='span_end'):
+        if isinstance(event.get('duration_ms'), (int, float)):
+            metrics.BACKUP_PHASE_DURATION.observe(event['duration_ms'] / 1000, phase=event.get('phase', 'unknown'))
+
+def timed_run(command, **kwargs):
+    """subprocess.run() that records duration, timeouts and failures per command"""
+    label = metrics.command_label(command)
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(command, **kwargs)
+    except subprocess.TimeoutExpired:
+        metrics.SUBPROCESS_TIMEOUTS.inc(command=label)
+        raise
+    except Exception:
+        metrics.SUBPROCESS_FAILURES.inc(command=label)
+        raise
+    finally:
+        metrics.SUBPROCESS_DURATION.observe(time.perf_counter() - start, command=label)
+    
+    if result.returncode != 0:
+        metrics.SUBPROCESS_FAILURES.inc(command=label)
+    return result
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-task_manager = TaskManager()
+@app.after_request
+def record_request_metrics(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, method=request.method, route=route)
+        metrics.HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    return response
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample the stacks of all threads for ?seconds=N (default 5, at most 60) at ?hz=N (default 100)
+    
+    Needs the ADMIN_TOKEN in an X-Admin-Token or "Authorization: Bearer"
+    header. Returns JSON with the most sampled stacks and, per thread, the
+    lines it was executing most often; TaskManager workers also carry their
+    task. ?format=collapsed returns every stack in collapsed format for
+    flamegraph.pl or speedscope. ?lines=1 splits frames by line.
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Profiling is disabled; set ADMIN_TOKEN to enable it'}), 403
+    supplied = request.headers.get('X-Admin-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        supplied = authorization[len('Bearer '):]
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'error': 'A valid admin token is required'}), 401
+    
+    try:
+        seconds = float(request.args.get('seconds', 5))
+        hz = float(request.args.get('hz', profiler.DEFAULT_HZ))
+    except ValueError:
+        return jsonify({'error': 'seconds and hz must be numbers'}), 400
+    # nan slips through every comparison below and would keep the sampler running forever
+    if not (math.isfinite(seconds) and math.isfinite(hz)):
+        return jsonify({'error': 'seconds and hz must be finite'}), 400
+    if seconds <= 0:
+        return jsonify({'error': 'seconds must be positive'}), 400
+    seconds = min(seconds, profiler.MAX_SECONDS)
+    hz = max(1, min(int(hz), profiler.MAX_HZ))
+    
+    sampler = profiler.Sampler(hz, lines=request.args.get('lines') == '1')
+    try:
+        sampler.run(seconds)
+    except profiler.ProfilerBusy as e:
+        return jsonify({'error': str(e)}), 409
+    
+    if request.args.get('format') == 'collapsed':
+        return Response(sampler.collapsed(), mimetype='text/plain')
+    
+    threads = sampler.threads()
+    now = datetime.now()
+    for thread in threads:
+        task = task_manager.get_task(thread['name'][len(TASK_THREAD_PREFIX):]) \
+            if thread['name'].startswith(TASK_THREAD_PREFIX) else None
+        if task:
+            thread['task'] = {
+                'id': task['id'],
+                'kind': task.get('kind'),
+                'status': task['status'],
+                'description': task['description'],
+                'running_seconds': round((now - task['start_time']).total_seconds()),
+                'progress': task.get('progress'),
+                'last_output': task['output'][-1] if task['output'] else None,
+            }
+    return jsonify(dict(
+        sampler.summary(),
+        stacks=[{'stack': stack, 'count': count} for stack, count in sampler.stacks.most_common(PROFILE_STACKS)],
+        distinct_stacks=len(sampler.stacks),
+        threads=threads,
+    ))
+
+@metrics.timed(metrics.FUNCTION_DURATION, function='run_toolkit_command')
 def run_toolkit_command(command):
     """Execute toolkit command and return result"""
     try:
-        result = subprocess.run(
+        result = timed_run(
             [TOOLKIT_CMD] + command,
             capture_output=True,
             text=True,
@@ -99,6 +501,7 @@ def run_toolkit_command(command):
             'error': str(e)
         }
 
+@metrics.timed(metrics.FUNCTION_DURATION, function='get_timeshift_snapshots')
 def get_timeshift_snapshots():
     """Get Timeshift snapshots by reading from shared JSON file"""
     try:
@@ -107,7 +510,7 @@ def get_timeshift_snapshots():
         from datetime import datetime
         
         # Path to the shared JSON file - mounted as part of the project directory
-        json_file_path = "/toolkit/shared-data/timeshift-info.json"
+        json_file_path = os.path.join(SCRIPT_DIR, "shared-data", "timeshift-info.json")
         
         # Check if file exists
         if not os.path.exists(json_file_path):
@@ -158,65 +561,6 @@ def get_timeshift_snapshots():
             'summary': []
         }
 
-def get_parsed_backups():
-    """Get parsed backup information for table display"""
-    try:
-        backup_result = run_toolkit_command(['list-backups'])
-        
-        if backup_result.get('success'):
-            output = backup_result.get('output', '')
-            lines = output.strip().split('\n')
-            backups = []
-            
-            for i, line in enumerate(lines):
-                line = line.strip()
-                if '.tar.gz' in line and line.startswith('*'):
-                    filename = line.replace('*', '').strip()
-                    
-                    size_info = 'Unknown'
-                    if i + 1 < len(lines) and 'Size:' in lines[i + 1]:
-                        size_info = lines[i + 1].strip().replace('Size:', '').strip()
-                    
-                    name_parts = filename.replace('full-backup-', '').replace('.tar.gz', '')
-                    formatted_date = 'Unknown'
-                    display_name = filename
-                    
-                    if '_' in name_parts:
-                        try:
-                            date_part, time_part = name_parts.split('_', 1)
-                            formatted_date = f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}"
-                            formatted_time = f"{time_part[:2]}:{time_part[2:4]}:{time_part[4:6]}"
-                            display_name = f"{formatted_date} {formatted_time}"
-                        except:
-                            display_name = name_parts
-                    
-                    backups.append({
-                        'filename': filename,
-                        'name': display_name,
-                        'size': size_info,
-                        'type': 'Full System',
-                        'date': formatted_date,
-                        'raw_name': name_parts
-                    })
-            
-            return {
-                'success': True,
-                'backups': backups,
-                'summary': f"Found {len(backups)} backup(s)"
-            }
-        else:
-            return {
-                'success': False,
-                'error': backup_result.get('error', 'Failed to get backup information'),
-                'backups': []
-            }
-    except Exception as e:
-        return {
-            'success': False,
-            'error': str(e),
-            'backups': []
-        }
-
 @app.route('/')
 def dashboard():
     """Main dashboard - Focus on Backups & Timeshift"""
@@ -227,7 +571,7 @@ def dashboard():
     backup_count = 0
     if backups_info['success'] and backups_info['output']:
         for line in backups_info['output'].split('\n'):
-            if '*' in line and 'full-backup-' in line and '.tar.gz' in line:
+            if '*' in line and 'full-backup-' in line and line.strip().endswith(BACKUP_EXTENSIONS):
                 backup_count += 1
     
     return render_template('dashboard.html', 
@@ -237,27 +581,24 @@ def dashboard():
 
 @app.route('/backups')
 def backups():
-    """Full system backups management"""
-    backups_info = get_parsed_backups()
-    
-    # Count backups for backups page
-    backup_count = 0
-    if backups_info and "success" in backups_info and backups_info["success"] and backups_info.get("backups"):
-        backup_count = len(backups_info["backups"])
-    return render_template('backups.html', 
-                         backups_info=backups_info,
-                         backup_count=backup_count)
+    """Full system backups management; rows are loaded page by page from /api/backups"""
+    return render_template('backups.html', backup_dir=BACKUP_DIR)
 
 @app.route('/create-backup', methods=['POST'])
 def create_backup():
     """Create new full system backup"""
     description = request.form.get('description', 'Web UI backup')
+    engine = request.form.get('engine', 'tar')
+    if engine not in BACKUP_ENGINES:
+        flash(f'Unknown backup engine: {engine}', 'error')
+        return redirect(url_for('backups'))
     
     task_id = f"backup_{int(time.time())}"
     task_manager.start_task(
         task_id,
-        [TOOLKIT_CMD, 'create-backup', description],
-        f"Creating backup: {description}"
+        [TOOLKIT_CMD, 'create-backup', '--engine', engine, description],
+        f"Creating backup: {description}",
+        kind='backup'
     )
     
     flash(f'Backup creation started. Task ID: {task_id}', 'info')
@@ -267,22 +608,42 @@ def create_backup():
 def timeshift():
     """Timeshift management with real snapshot data"""
     timeshift_info = get_timeshift_snapshots()
-    return render_template('timeshift.html', timeshift_info=timeshift_info)
+    running = [task['id'] for task in list(task_manager.tasks.values())
+               if task.get('kind') == 'timeshift' and task['status'] == 'running']
+    return render_template('timeshift.html', timeshift_info=timeshift_info, timeshift_tasks=running)
 
 @app.route('/create-timeshift', methods=['POST'])
 def create_timeshift():
-    """Create Timeshift backup"""
+    """Create Timeshift backup in the background"""
     description = request.form.get('description', 'Web UI timeshift backup')
     
-    result = run_toolkit_command(['timeshift-create', description])
-    
-    if result['success']:
-        flash('Timeshift backup created successfully!', 'success')
-    else:
-        flash(f'Timeshift backup failed: {result["error"]}', 'error')
+    task_id = f"timeshift_create_{int(time.time())}"
+    task_manager.start_batch(
+        task_id,
+        [('Create snapshot', [TOOLKIT_CMD, 'timeshift-create', description])],
+        f"Creating Timeshift snapshot: {description}",
+        kind='timeshift',
+        lock=TIMESHIFT_LOCK,
+        after=timeshift_refresh_command()
+    )
     
+    flash(f'Timeshift snapshot creation started. Task ID: {task_id}', 'info')
     return redirect(url_for('timeshift'))
 
+def timeshift_refresh_command():
+    """Command that rewrites shared-data/timeshift-info.json"""
+    return ['python3', os.path.join(SCRIPT_DIR, 'host-scripts', 'update-timeshift-data.py')]
+
+def start_timeshift_delete(snapshot_names):
+    """Delete snapshots one by one in a single background task; returns the task id"""
+    task_id = f"timeshift_delete_{int(time.time() * 1000)}"
+    steps = [(f'Delete {name}', ['sudo', TIMESHIFT_BIN, '--delete', '--snapshot', name, '--yes'])
+             for name in snapshot_names]
+    noun = 'snapshot' if len(steps) == 1 else 'snapshots'
+    return task_manager.start_batch(
+        task_id, steps, f"Deleting {len(steps)} Timeshift {noun}",
+        kind='timeshift', lock=TIMESHIFT_LOCK, after=timeshift_refresh_command())
+
 @app.route('/logs')
 def logs():
     """View system logs - enhanced with multiple sources"""
@@ -292,28 +653,28 @@ def logs():
     # 1. Toolkit logs from logs directory
     if os.path.exists(log_dir):
         for filename in sorted(os.listdir(log_dir)):
-            if filename.endswith(".log"):
+            if filename.endswith(LOG_SUFFIXES):
                 filepath = os.path.join(log_dir, filename)
                 log_files.append({
                     "name": filename,
                     "size": os.path.getsize(filepath),
                     "modified": datetime.fromtimestamp(os.path.getmtime(filepath)),
                     "type": "Toolkit",
-                    "description": "Main toolkit operations log"
+                    "description": "Compressed toolkit log archive" if filename.endswith(".gz") else "Main toolkit operations log"
                 })
     
     # 2. Web interface logs
     web_log_dir = os.path.join(SCRIPT_DIR, "web-interface")
     if os.path.exists(web_log_dir):
         for filename in sorted(os.listdir(web_log_dir)):
-            if filename.startswith("web-server") and filename.endswith(".log"):
+            if filename.startswith("web-server") and filename.endswith(LOG_SUFFIXES):
                 filepath = os.path.join(web_log_dir, filename)
                 log_files.append({
                     "name": f"web-interface/{filename}",
                     "size": os.path.getsize(filepath),
                     "modified": datetime.fromtimestamp(os.path.getmtime(filepath)),
                     "type": "Web Interface",
-                    "description": "Web server operations and errors"
+                    "description": "Compressed web server log archive" if filename.endswith(".gz") else "Web server operations and errors"
                 })
     
     # 3. Add virtual log entries for system logs (read-only access)
@@ -356,7 +717,162 @@ def api_status():
         'timeshift': timeshift_info
     })
 
-@app.route('/api/task/<task_id>')
+def build_host_summary():
+    """What a fleet aggregator needs to know about this host, from the backup index"""
+    newest = backup_index.page(sort='date', order='desc', limit=1)
+    last_backup = None
+    for backup in newest['items']:
+        if backup['timestamp']:
+            last_backup = {'name': backup['name'], 'timestamp': backup['timestamp'],
+                           'size': backup['size'], 'engine': backup['engine']}
+    disk = shutil.disk_usage('/')
+    return {
+        'hostname': socket.gethostname(),
+        'generated': time.time(),
+        'backups_ok': newest['success'],
+        'backup_count': newest['total'],
+        'last_backup': last_backup,
+        'disk': {'total': disk.total, 'used': disk.used, 'free': disk.free,
+                 'percent': round(disk.used / disk.total * 100, 1) if disk.total else None},
+        'running_tasks': task_manager.status_counts().get(('running',), 0),
+    }
+
+_summary_cache = {'data': None, 'time': 0}
+_summary_lock = threading.Lock()
+
+@app.route('/api/summary')
+def api_summary():
+    """Small status document for fleet aggregators, cached for SUMMARY_TTL seconds.
+    
+    Concurrent requests wait on the lock for one rebuild instead of each
+    building their own.
+    """
+    with _summary_lock:
+        hit = _summary_cache['data'] is not None and time.time() - _summary_cache['time'] < SUMMARY_TTL
+        metrics.record_cache('summary', hit)
+        if not hit:
+            _summary_cache.update(data=build_host_summary(), time=time.time())
+        return jsonify(_summary_cache['data'])
+
+@app.context_processor
+def inject_fleet_enabled():
+    return {'fleet_enabled': fleet_poller.enabled()}
+
+@app.route('/fleet')
+def fleet_overview():
+    """Backup freshness across the hosts in FLEET_CONFIG, from the poller's cache"""
+    fleet_poller.start()
+    return render_template('fleet.html', fleet=fleet_poller.overview())
+
+@app.route('/api/fleet')
+def api_fleet():
+    fleet_poller.start()
+    return jsonify(fleet_poller.overview())
+
+def listing_page(index):
+    """One page of an index for the sort, filter and cursor query parameters"""
+    args = request.args
+    try:
+        return jsonify(index.page(
+            sort=args.get('sort'), order=args.get('order', 'desc'), cursor=args.get('cursor'),
+            limit=args.get('limit', listing.DEFAULT_LIMIT),
+            since=args.get('since'), until=args.get('until'), tag=args.get('tag'), q=args.get('q')))
+    except listing.ListingError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/backups')
+def api_backups():
+    """Backups, newest first by default
+    
+    ?sort=date|size|name|tags&order=desc|asc&limit=N&cursor=C, filtered by
+    since/until (YYYY-MM-DD), tag (engine, codec, local or remote) and q
+    (text in the name or description). Pass next_cursor back for the next page.
+    """
+    return listing_page(backup_index)
+
+@app.route('/api/timeshift/snapshots')
+def api_timeshift_snapshot_list():
+    """Timeshift snapshots, paginated like /api/backups (sort: date, name, tags)"""
+    return listing_page(timeshift_index)
+
+@app.route('/api/backups/diff')
+def api_backups_diff():
+    """Stream the changes between two backups (?old=NAME&new=NAME[&summary=1]) as NDJSON.
+
+    One line per added, removed or modified path, then a {"summary": ...}
+    line. The toolkit merge-joins the two manifests while reading them, so
+    the first lines arrive before the diff is complete.
+    """
+    old = request.args.get('old', '')
+    new = request.args.get('new', '')
+    if not BACKUP_NAME_RE.match(old) or not BACKUP_NAME_RE.match(new):
+        return jsonify({'error': 'old and new must be backup names'}), 400
+    
+    command = [TOOLKIT_CMD, 'diff-backups', '--format', 'ndjson']
+    if request.args.get('summary') == '1':
+        command.append('--summary')
+    process = subprocess.Popen(command + [old, new], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, cwd=SCRIPT_DIR)
+    
+    # Wait for the first JSON line, so a missing manifest is an error response rather than an empty stream
+    first = None
+    for line in process.stdout:
+        if line.startswith('{'):
+            first = line
+            break
+    if first is None:
+        errors = [line for line in process.stderr.read().splitlines() if 'ERROR' in line]
+        process.wait()
+        return jsonify({'error': errors[0] if errors else 'diff-backups failed'}), 404
+    
+    def generate():
+        try:
+            yield first
+            for line in process.stdout:
+                if line.startswith('{'):
+                    yield line
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/logs/search')
+def api_log_search():
+    """Search every toolkit and web server log, archives included, streaming matches as NDJSON
+    
+    ?q=TEXT (literal; regex=1 for a regular expression, case=1 to match case),
+    since/until (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS), files (comma-separated
+    globs over the names /logs lists, e.g. web-interface/*) and limit.
+    Each match is {"file", "offset", "line"}; offset can be passed to
+    /api/logs/<file>?offset= to read around it. The last line is a summary
+    whose "truncated" names the cap (limit, bytes or time) that ended the search.
+    """
+    try:
+        matcher = logsearch.Matcher(request.args.get('q', ''), regex=request.args.get('regex') == '1',
+                                    case_sensitive=request.args.get('case') == '1')
+        since = logsearch.parse_time(request.args['since']) if request.args.get('since') else None
+        until = logsearch.parse_time(request.args['until'], end=True) if request.args.get('until') else None
+        limit = max(1, min(int(request.args.get('limit', logsearch.DEFAULT_LIMIT)), logsearch.MAX_LIMIT))
+    except ValueError as e:
+        # logsearch.SearchError is a ValueError, as is a non-numeric limit
+        return jsonify({'error': str(e)}), 400
+    
+    globs = [g.strip() for g in request.args.get('files', '').split(',') if g.strip()]
+    files = [(name, path) for name, path in searchable_logs()
+             if not globs or any(fnmatch.fnmatch(name, g) for g in globs)]
+    search = logsearch.LogSearch(files, matcher, since=since, until=until, limit=limit,
+                                 max_bytes=LOG_SEARCH_MAX_BYTES, timeout=LOG_SEARCH_TIMEOUT)
+    
+    def generate():
+        for item in search:
+            if item.get('done'):
+                metrics.FUNCTION_DURATION.observe(item['elapsed_ms'] / 1000, function='log_search')
+            yield json.dumps(item) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route("/api/logs/<filename>")
 @app.route("/api/logs/<path:filename>")
 def api_log_content(filename):
@@ -372,63 +888,103 @@ def api_log_content(filename):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-def get_toolkit_log_content(filename):
-    """Get toolkit log content"""
-    log_dir = os.path.join(SCRIPT_DIR, "logs")
-    log_path = os.path.join(log_dir, filename)
+def searchable_logs():
+    """(name, path) of every toolkit and web server log the Logs page lists"""
+    logs = []
+    for log_dir, prefix in ((os.path.join(SCRIPT_DIR, "logs"), ""),
+                            (os.path.join(SCRIPT_DIR, "web-interface"), "web-interface/")):
+        try:
+            names = os.listdir(log_dir)
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith(LOG_SUFFIXES) and (not prefix or name.startswith("web-server")):
+                logs.append((prefix + name, os.path.join(log_dir, name)))
+    return logs
+
+def resolve_log_path(filename):
+    """Path of a toolkit log (NAME) or web server log (web-interface/NAME), or None"""
+    if filename.startswith("web-interface/"):
+        log_dir = os.path.join(SCRIPT_DIR, "web-interface")
+        name = filename[len("web-interface/"):]
+        if not name.startswith("web-server"):
+            return None
+    else:
+        log_dir = os.path.join(SCRIPT_DIR, "logs")
+        name = filename
+    log_path = os.path.realpath(os.path.join(log_dir, name))
+    if os.path.dirname(log_path) != os.path.realpath(log_dir):
+        return None
+    if not name.endswith(LOG_SUFFIXES) or not os.path.isfile(log_path):
+        return None
+    return log_path
+
+def read_log_content(filename, log_type, tail_lines):
+    """JSON with the last tail_lines lines of a log, or the ?offset=&length= byte range of it
     
-    # Security check
-    if not filename.endswith(".log") or not os.path.exists(log_path):
+    Compressed archives are read block by block, so neither form
+    decompresses more of an archive than it returns.
+    """
+    log_path = resolve_log_path(filename)
+    if log_path is None:
         return jsonify({"error": "Log file not found"}), 404
     
-    if not os.path.abspath(log_path).startswith(os.path.abspath(log_dir)):
-        return jsonify({"error": "Access denied"}), 403
+    try:
+        offset = int(request.args['offset']) if 'offset' in request.args else None
+        length = min(int(request.args.get('length', MAX_LOG_READ_BYTES)), MAX_LOG_READ_BYTES)
+        tail_lines = int(request.args.get('tail', tail_lines))
+    except ValueError:
+        return jsonify({"error": "offset, length and tail must be numbers"}), 400
     
-    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-        lines = f.readlines()
-        if len(lines) > 1000:
-            content = "... (showing last 1000 lines)\n" + "".join(lines[-1000:])
+    if logrotate is None:
+        with open(log_path, "rb") as f:
+            data = f.read()
+        size, lines = len(data), data.count(b"\n")
+        start = max(0, min(offset, size)) if offset is not None else None
+        if start is not None:
+            data = data[start:start + length]
         else:
-            content = "".join(lines)
+            kept = data.splitlines(keepends=True)[-tail_lines:] if tail_lines > 0 else []
+            start, data = size - len(b"".join(kept)), b"".join(kept)
+    else:
+        log = logrotate.LogFile(log_path)
+        size, lines = log.size, log.count_lines()
+        if offset is not None:
+            start = max(0, min(offset, size))
+            data = log.read(start, length)
+        else:
+            start, data = log.tail(tail_lines)
     
+    content = data.decode("utf-8", errors="replace")
+    if offset is None and start > 0:
+        content = f"... (showing last {tail_lines} lines)\n" + content
     return jsonify({
         "success": True,
         "content": content,
         "filename": filename,
-        "lines": len(lines),
-        "type": "Toolkit Log"
+        "lines": lines,
+        "type": log_type,
+        "offset": start,
+        "length": len(data),
+        "size": size,
+        "compressed": log_path.endswith(".gz")
     })
 
+def get_toolkit_log_content(filename):
+    """Get toolkit log content"""
+    return read_log_content(filename, "Toolkit Log", 1000)
+
 def get_web_interface_log_content(filename):
     """Get web interface log content"""
-    # Remove web-interface/ prefix
-    actual_filename = filename.replace("web-interface/", "")
-    log_path = os.path.join(SCRIPT_DIR, "web-interface", actual_filename)
-    
-    if not os.path.exists(log_path):
-        return jsonify({"error": "Web log file not found"}), 404
-    
-    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-        lines = f.readlines()
-        if len(lines) > 500:
-            content = "... (showing last 500 lines)\n" + "".join(lines[-500:])
-        else:
-            content = "".join(lines)
-    
-    return jsonify({
-        "success": True,
-        "content": content,
-        "filename": filename,
-        "lines": len(lines),
-        "type": "Web Interface Log"
-    })
+    return read_log_content(filename, "Web Interface Log", 500)
 
+@metrics.timed(metrics.FUNCTION_DURATION, function='get_system_log_content')
 def get_system_log_content(filename):
     """Get system log content (filtered)"""
     try:
         if filename == "system/timeshift.log":
             # Get Timeshift-related entries from syslog
-            result = subprocess.run(
+            result = timed_run(
                 ["sudo", "grep", "-i", "timeshift", "/var/log/syslog"],
                 capture_output=True, text=True, timeout=10
             )
@@ -459,7 +1015,7 @@ def get_system_log_content(filename):
             content_parts = []
             
             # Check syslog for backup-related entries
-            result = subprocess.run(
+            result = timed_run(
                 ["sudo", "grep", "-iE", "(backup|tar|rsync)", "/var/log/syslog"],
                 capture_output=True, text=True, timeout=10
             )
@@ -473,11 +1029,17 @@ def get_system_log_content(filename):
             # Check toolkit logs for backup entries
             toolkit_log = os.path.join(SCRIPT_DIR, "logs", f'toolkit-{datetime.now().strftime("%Y%m%d")}.log')
             if os.path.exists(toolkit_log):
-                with open(toolkit_log, "r", encoding="utf-8", errors="replace") as f:
-                    toolkit_lines = [line.strip() for line in f.readlines() if "backup" in line.lower()]
-                    if toolkit_lines:
-                        content_parts.append("=== Toolkit Backup Entries ===")
-                        content_parts.extend(toolkit_lines[-50:])  # Last 50 entries
+                toolkit_lines = []
+                for event in jsonlog.iter_events(toolkit_log):
+                    if 'command' in event:
+                        # Structured line: filter on fields instead of scanning the text
+                        if event['command'] in BACKUP_COMMANDS:
+                            toolkit_lines.append(jsonlog.format_event(event))
+                    elif "backup" in event.get('msg', '').lower():
+                        toolkit_lines.append(jsonlog.format_event(event))
+                if toolkit_lines:
+                    content_parts.append("=== Toolkit Backup Entries ===")
+                    content_parts.extend(toolkit_lines[-50:])  # Last 50 entries
             
             content = "\n".join(content_parts) if content_parts else "No backup operations found in logs."
             
@@ -491,7 +1053,7 @@ def get_system_log_content(filename):
         
         elif filename == "system/system-events.log":
             # Get general system events related to our toolkit
-            result = subprocess.run(
+            result = timed_run(
                 ["sudo", "grep", "-iE", "(restore|snapshot|toolkit)", "/var/log/syslog"],
                 capture_output=True, text=True, timeout=10
             )
@@ -525,20 +1087,57 @@ def get_system_log_content(filename):
     except Exception as e:
         return jsonify({"error": f"Error reading system logs: {str(e)}"}), 500
 
-@app.route("/api/logs/<filename>/download")
+@app.route("/api/logs/<path:filename>/download")
 def api_log_download(filename):
-    """API endpoint to download log file"""
-    log_dir = os.path.join(SCRIPT_DIR, "logs")
-    log_path = os.path.join(log_dir, filename)
+    """Download a log, decompressed, with HTTP Range support
     
-    if not filename.endswith(".log") or not os.path.exists(log_path):
+    Without a Range header and with gzip in Accept-Encoding, the body is
+    gzip-encoded on the fly. ?raw=1 sends an archive as it is stored.
+    """
+    log_path = resolve_log_path(filename)
+    if log_path is None:
         return "Log file not found", 404
     
-    if not os.path.abspath(log_path).startswith(os.path.abspath(log_dir)):
-        return "Access denied", 403
+    if logrotate is None or (log_path.endswith(".gz") and request.args.get("raw") == "1"):
+        return send_file(log_path, as_attachment=True, conditional=True)
+    
+    log = logrotate.LogFile(log_path)
+    download_name = os.path.basename(log_path)
+    if download_name.endswith(".gz"):
+        download_name = download_name[:-len(".gz")]
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{download_name}"',
+        "Last-Modified": datetime.utcfromtimestamp(log.mtime).strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        "Vary": "Accept-Encoding",
+    }
+    
+    if request.headers.get("Range"):
+        byte_range = request.range.range_for_length(log.size) if request.range else None
+        if byte_range is None:
+            # Malformed, unsatisfiable or multi-range: answered with 416, as we only serve single ranges
+            return Response(status=416, headers={"Content-Range": f"bytes */{log.size}", **headers})
+        start, stop = byte_range
+        headers.update({"Content-Range": f"bytes {start}-{stop - 1}/{log.size}",
+                        "Content-Length": str(stop - start)})
+        return Response(log.iter_range(start, stop - start), status=206,
+                        mimetype="text/plain", headers=headers)
     
-    return send_file(log_path, as_attachment=True)
+    if request.accept_encodings["gzip"]:
+        def gzipped():
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            for chunk in log.iter_range():
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        headers["Content-Encoding"] = "gzip"
+        return Response(gzipped(), mimetype="text/plain", headers=headers)
+    
+    headers["Content-Length"] = str(log.size)
+    return Response(log.iter_range(), mimetype="text/plain", headers=headers)
 
+@app.route('/api/task/<task_id>')
 def api_task_status(task_id):
     """API endpoint for task status"""
     task = task_manager.get_task(task_id)
@@ -550,33 +1149,43 @@ def api_task_status(task_id):
 
 @app.route('/delete-timeshift', methods=['POST'])
 def delete_timeshift():
-    """Delete Timeshift snapshot"""
+    """Delete Timeshift snapshot in the background"""
     snapshot_name = request.form.get('snapshot_name')
     
     if not snapshot_name:
         flash('No snapshot name provided', 'error')
         return redirect(url_for('timeshift'))
+    if not TIMESHIFT_SNAPSHOT_RE.match(snapshot_name):
+        flash(f'Invalid snapshot name: {snapshot_name}', 'error')
+        return redirect(url_for('timeshift'))
     
-    try:
-        result = subprocess.run(
-            ['sudo', '/host/var/lib/snapd/hostfs/usr/bin/timeshift', '--delete', '--snapshot', snapshot_name, '--yes'],
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
-        
-        if result.returncode == 0:
-            flash(f'Timeshift snapshot "{snapshot_name}" deleted successfully!', 'success')
-        else:
-            flash(f'Failed to delete snapshot: {result.stderr}', 'error')
-            
-    except subprocess.TimeoutExpired:
-        flash('Timeout while deleting snapshot', 'error')
-    except Exception as e:
-        flash(f'Error deleting snapshot: {str(e)}', 'error')
-    
+    task_id = start_timeshift_delete([snapshot_name])
+    flash(f'Deleting Timeshift snapshot "{snapshot_name}". Task ID: {task_id}', 'info')
     return redirect(url_for('timeshift'))
 
+@app.route('/api/timeshift/delete-batch', methods=['POST'])
+def api_timeshift_delete_batch():
+    """Delete several Timeshift snapshots in one background task
+    
+    Takes {"snapshots": [names]} as JSON, or repeated snapshot_name form
+    fields. The snapshots are deleted one at a time and timeshift-info.json
+    is refreshed once at the end.
+    """
+    payload = request.get_json(silent=True)
+    if payload is not None:
+        names = payload.get('snapshots') if isinstance(payload, dict) else None
+    else:
+        names = request.form.getlist('snapshot_name')
+    if not isinstance(names, list) or not names:
+        return jsonify({'success': False, 'error': 'No snapshots given'}), 400
+    invalid = [name for name in names if not isinstance(name, str) or not TIMESHIFT_SNAPSHOT_RE.match(name)]
+    if invalid:
+        return jsonify({'success': False, 'error': f'Invalid snapshot names: {invalid}'}), 400
+    
+    names = list(dict.fromkeys(names))
+    task_id = start_timeshift_delete(names)
+    return jsonify({'success': True, 'task_id': task_id, 'count': len(names)}), 202
+
 @app.route('/api/timeshift-info')
 @app.route("/api/timeshift-snapshots")
 def api_timeshift_snapshots():
@@ -613,6 +1222,7 @@ def api_timeshift_info():
     return jsonify(get_timeshift_snapshots())
 
 
+@metrics.timed(metrics.FUNCTION_DURATION, function='get_system_statistics')
 def get_system_statistics():
     """Get comprehensive system statistics with host system access"""
     try:
@@ -629,12 +1239,12 @@ def get_system_statistics():
                 with open('/etc/hostname', 'r') as f:
                     stats['hostname'] = f.read().strip()
             else:
-                stats['hostname'] = subprocess.run(['hostname'], capture_output=True, text=True).stdout.strip()
+                stats['hostname'] = timed_run(['hostname'], capture_output=True, text=True).stdout.strip()
         except:
             stats['hostname'] = 'Unknown'
             
         try:
-            stats['kernel'] = subprocess.run(['uname', '-r'], capture_output=True, text=True).stdout.strip()
+            stats['kernel'] = timed_run(['uname', '-r'], capture_output=True, text=True).stdout.strip()
         except:
             try:
                 with open(f'{host_proc}/version', 'r') as f:
@@ -650,7 +1260,7 @@ def get_system_statistics():
             
         # Uptime - Use host proc
         try:
-            uptime_output = subprocess.run(['uptime', '-p'], capture_output=True, text=True).stdout.strip()
+            uptime_output = timed_run(['uptime', '-p'], capture_output=True, text=True).stdout.strip()
             stats['uptime'] = uptime_output.replace('up ', '')
         except:
             try:
@@ -698,7 +1308,7 @@ def get_system_statistics():
             else:
                 # Fallback to lsb_release command
                 try:
-                    os_info = subprocess.run(['lsb_release', '-d'], capture_output=True, text=True).stdout.strip()
+                    os_info = timed_run(['lsb_release', '-d'], capture_output=True, text=True).stdout.strip()
                     stats['os'] = os_info.split('\t')[1] if '\t' in os_info else 'Linux'
                 except:
                     stats['os'] = 'Linux'
@@ -707,7 +1317,7 @@ def get_system_statistics():
         
         # CPU Information - Use host proc
         try:
-            cpu_info = subprocess.run(['lscpu'], capture_output=True, text=True).stdout
+            cpu_info = timed_run(['lscpu'], capture_output=True, text=True).stdout
             cpu_name = ''
             cpu_cores = ''
             for line in cpu_info.split('\n'):
@@ -740,7 +1350,7 @@ def get_system_statistics():
         
         # Memory Information - Use host proc
         try:
-            mem_info = subprocess.run(['free', '-h'], capture_output=True, text=True).stdout
+            mem_info = timed_run(['free', '-h'], capture_output=True, text=True).stdout
             mem_lines = mem_info.split('\n')
             for line in mem_lines:
                 if line.startswith('Mem:'):
@@ -805,7 +1415,7 @@ def get_system_statistics():
         
         # Disk Usage
         try:
-            disk_info = subprocess.run(['df', '-h', '/'], capture_output=True, text=True).stdout
+            disk_info = timed_run(['df', '-h', '/'], capture_output=True, text=True).stdout
             disk_lines = disk_info.split('\n')
             for line in disk_lines[1:]:  # Skip header
                 if line.strip():
@@ -822,11 +1432,11 @@ def get_system_statistics():
         # GPU Information - Enhanced with host access
         try:
             # Check if nvidia-smi is available (mounted from host)
-            nvidia_check = subprocess.run(['which', 'nvidia-smi'], capture_output=True, text=True)
+            nvidia_check = timed_run(['which', 'nvidia-smi'], capture_output=True, text=True)
             
             if nvidia_check.returncode == 0:
                 # Get detailed NVIDIA GPU information
-                gpu_detailed_info = subprocess.run([
+                gpu_detailed_info = timed_run([
                     'nvidia-smi', '--query-gpu=name,memory.total,memory.used,memory.free,utilization.gpu,utilization.memory,temperature.gpu,power.draw,power.limit', 
                     '--format=csv,noheader,nounits'
                 ], capture_output=True, text=True, timeout=5)
@@ -854,7 +1464,7 @@ def get_system_statistics():
                     stats['gpu'] = f"{len(gpus)} x {gpus[0]['name']}" if len(gpus) > 1 and all(g['name'] == gpus[0]['name'] for g in gpus) else ', '.join([g['name'] for g in gpus])
                 else:
                     # Fallback to basic nvidia-smi
-                    gpu_basic_info = subprocess.run(['nvidia-smi', '--query-gpu=name', '--format=csv,noheader,nounits'], 
+                    gpu_basic_info = timed_run(['nvidia-smi', '--query-gpu=name', '--format=csv,noheader,nounits'], 
                                                   capture_output=True, text=True, timeout=5)
                     if gpu_basic_info.returncode == 0 and gpu_basic_info.stdout.strip():
                         gpus = gpu_basic_info.stdout.strip().split('\n')
@@ -865,7 +1475,7 @@ def get_system_statistics():
                         stats['gpu'] = 'NVIDIA GPU (details unavailable)'
             else:
                 # Try lspci for other GPUs
-                gpu_info = subprocess.run(['lspci'], capture_output=True, text=True, timeout=5)
+                gpu_info = timed_run(['lspci'], capture_output=True, text=True, timeout=5)
                 gpu_lines = []
                 for line in gpu_info.stdout.split('\n'):
                     if 'VGA' in line or 'Display' in line or '3D' in line:
@@ -883,7 +1493,7 @@ def get_system_statistics():
         
         # Load Average - Use host proc
         try:
-            load_info = subprocess.run(['uptime'], capture_output=True, text=True).stdout
+            load_info = timed_run(['uptime'], capture_output=True, text=True).stdout
             if 'load average:' in load_info:
                 load_part = load_info.split('load average:')[1].strip()
                 stats['load_average'] = load_part
@@ -901,7 +1511,7 @@ def get_system_statistics():
         
         # Temperature - Enhanced with host sensors access
         try:
-            temp_info = subprocess.run(['sensors'], capture_output=True, text=True, timeout=5)
+            temp_info = timed_run(['sensors'], capture_output=True, text=True, timeout=5)
             if temp_info.returncode == 0:
                 temp_lines = []
                 for line in temp_info.stdout.split('\n'):
@@ -943,39 +1553,12 @@ def get_system_statistics():
             'error': str(e),
             'stats': {}
         }
-if __name__ == '__main__':
-    # Check if toolkit exists
-    if not os.path.exists(TOOLKIT_CMD):
-        print(f"Error: Toolkit not found at {TOOLKIT_CMD}")
-        print("WARNING: Toolkit will be checked at runtime")
-    
-    print("🌐 System Restore Toolkit Web Interface (Backups & Timeshift)")
-    print("=============================================================")
-    print("Starting web server...")
-    print(f"Toolkit path: {SCRIPT_DIR}")
-    print("Access the web interface at: http://localhost:5000")
-    print()
-    print("✅ Features:")
-    print("   • 💾 Full System Backups")
-    print("   • 🕐 Timeshift Integration")
-    print("   • 📋 Log Management")
-    print("   • 📊 System Monitoring")
-    print()
-    print("❌ Removed: LVM Snapshots (insufficient volume group space)")
-    
-    # Start Flask app
-    app.run(host='0.0.0.0', port=5000, debug=False)
-
-
-
 @app.route('/api/refresh-timeshift', methods=['POST'])
 def refresh_timeshift():
     """Trigger timeshift data refresh by calling the host script"""
     try:
         # Execute the host update script
-        result = subprocess.run([
-            'python3', '/toolkit/host-scripts/update-timeshift-data.py'
-        ], capture_output=True, text=True, timeout=60)
+        result = timed_run(timeshift_refresh_command(), capture_output=True, text=True, timeout=60)
         
         if result.returncode == 0:
             return jsonify({
@@ -994,3 +1577,44 @@ def refresh_timeshift():
             'success': False,
             'error': f'Error: {str(e)}'
         })
+
+def rotate_web_logs():
+    """Apply the log rotation rules to the web server's own logs, once an hour"""
+    while True:
+        try:
+            logrotate.rotate(WEB_LOG_DIR, ('web-server*.log',), **LOG_ROTATE_SETTINGS)
+        except OSError as e:
+            print(f"Could not rotate logs in {WEB_LOG_DIR}: {e}", file=sys.stderr)
+        time.sleep(LOG_ROTATE_INTERVAL)
+
+# At import rather than under __main__, however the (single) server process is started
+if AUTO_RESUME_BACKUPS:
+    task_manager.resume_interrupted()
+
+if __name__ == '__main__':
+    # Check if toolkit exists
+    if not os.path.exists(TOOLKIT_CMD):
+        print(f"Error: Toolkit not found at {TOOLKIT_CMD}")
+        print("WARNING: Toolkit will be checked at runtime")
+    
+    print("🌐 System Restore Toolkit Web Interface (Backups & Timeshift)")
+    print("=============================================================")
+    print("Starting web server...")
+    print(f"Toolkit path: {SCRIPT_DIR}")
+    print("Access the web interface at: http://localhost:5000")
+    print()
+    print("✅ Features:")
+    print("   • 💾 Full System Backups")
+    print("   • 🕐 Timeshift Integration")
+    print("   • 📋 Log Management")
+    print("   • 📊 System Monitoring")
+    print()
+    print("❌ Removed: LVM Snapshots (insufficient volume group space)")
+    
+    # Aggregator mode: keep the fleet cache warm from the start
+    fleet_poller.start()
+    if logrotate is not None:
+        threading.Thread(target=rotate_web_logs, name='log-rotation', daemon=True).start()
+    
+    # Start Flask app
+    app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,281 @@
+"""
+Fleet aggregator: one overview of many toolkit hosts
+
+The hosts are listed in FLEET_CONFIG (configs/fleet.json by default):
+
+    {"poll_interval_seconds": 60, "timeout_seconds": 5, "stale_after_hours": 26,
+     "hosts": [{"name": "db-01", "url": "http://db-01:5000"}]}
+
+A background thread runs an asyncio loop that fetches /api/summary from
+every host at once, each under its own timeout. The requests go over a
+pool of keep-alive connections, so a poll costs one request per host and
+no new TCP (or TLS) handshakes. Results are cached. The /fleet page and
+/api/fleet read the cache and never wait on a host. A host that stops
+answering keeps its last good summary, marked with the error.
+
+The config file is re-read when its mtime changes. The poller starts on
+the first request that needs it, and only if hosts are configured.
+"""
+
+import asyncio
+import json
+import os
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+import metrics
+
+DEFAULTS = {'poll_interval_seconds': 60, 'timeout_seconds': 5, 'stale_after_hours': 26, 'hosts': []}
+# Summaries are small; anything bigger is not a toolkit answering
+MAX_BODY_BYTES = 1024 * 1024
+USER_AGENT = 'system-restore-toolkit-fleet'
+
+
+class FleetError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Idle HTTP/1.1 keep-alive connections per origin, reused across polls"""
+
+    def __init__(self):
+        self.idle = {}
+
+    async def get(self, url):
+        """GET url; returns (status, body bytes)"""
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if secure else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request = (f'GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\nAccept: application/json\r\n'
+                   f'User-Agent: {USER_AGENT}\r\n\r\n').encode()
+        while True:
+            idle = self.idle.get(origin)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    origin[1], origin[2], ssl=ssl.create_default_context() if secure else None)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, body, keep_alive = await self._response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue  # the server dropped an idle connection; open a fresh one
+                raise
+            except BaseException:
+                # Includes cancellation by a timeout: the response state is unknown
+                writer.close()
+                raise
+            if keep_alive:
+                self.idle.setdefault(origin, []).append((reader, writer))
+            else:
+                writer.close()
+            return status, body
+
+    async def _response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+        fields = status_line.decode('latin-1').split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith('HTTP/'):
+            raise FleetError(f'not an HTTP response: {status_line[:80]!r}')
+        version, status = fields[0], int(fields[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._chunked(reader)
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if length > MAX_BODY_BYTES:
+                raise FleetError(f'response of {length} bytes is too large')
+            body = await reader.readexactly(length)
+        else:
+            # Delimited by the server closing the connection
+            body = await reader.read(MAX_BODY_BYTES + 1)
+            keep_alive = False
+        if len(body) > MAX_BODY_BYTES:
+            raise FleetError('response is too large')
+        return status, body, keep_alive
+
+    async def _chunked(self, reader):
+        chunks = []
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip() or b'0', 16)
+            if not size:
+                # Trailer fields end with a blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            total += size
+            if total > MAX_BODY_BYTES:
+                raise FleetError('response is too large')
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+
+class FleetPoller:
+    """Polls the configured hosts in the background and serves cached results"""
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.lock = threading.Lock()
+        self.results = {}
+        self.thread = None
+        self._config = dict(DEFAULTS)
+        self._config_mtime = None
+
+    def config(self):
+        """The fleet config, re-read when the file changes; an unreadable file means no hosts"""
+        try:
+            mtime = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return dict(DEFAULTS)
+        with self.lock:
+            if mtime != self._config_mtime:
+                try:
+                    with open(self.config_path) as f:
+                        loaded = json.load(f)
+                    config = dict(DEFAULTS, **loaded)
+                    config['hosts'] = [h for h in config['hosts'] if h.get('url')]
+                    for host in config['hosts']:
+                        host.setdefault('name', urlsplit(host['url']).netloc)
+                except (OSError, ValueError, TypeError, AttributeError) as e:
+                    config = dict(DEFAULTS, error=f'Cannot read {self.config_path}: {e}')
+                self._config, self._config_mtime = config, mtime
+            return self._config
+
+    def enabled(self):
+        return bool(self.config()['hosts'])
+
+    def start(self):
+        """Start the poller thread once, if any hosts are configured"""
+        if not self.enabled():
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=lambda: asyncio.run(self._run()),
+                                               name='fleet-poller', daemon=True)
+                self.thread.start()
+
+    async def _run(self):
+        pool = ConnectionPool()
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    config = self.config()
+                    await self.poll(pool, config)
+                    delay = config['poll_interval_seconds'] - (time.monotonic() - started)
+                except Exception:
+                    # One bad round (or a bad poll_interval_seconds) must not end the poller;
+                    # connections it left behind are in an unknown state
+                    pool.close()
+                    delay = DEFAULTS['poll_interval_seconds']
+                await asyncio.sleep(max(1, delay))
+        finally:
+            pool.close()
+
+    async def poll(self, pool, config):
+        """Fetch every host's summary concurrently"""
+        await asyncio.gather(*(self._poll_host(pool, host, config['timeout_seconds'])
+                               for host in config['hosts']))
+
+    async def _poll_host(self, pool, host, timeout):
+        url = host['url'].rstrip('/') + '/api/summary'
+        started = time.monotonic()
+        summary, error = None, None
+        try:
+            status, body = await asyncio.wait_for(pool.get(url), timeout)
+            if status != 200:
+                raise FleetError(f'HTTP {status}')
+            summary = json.loads(body)
+        except asyncio.TimeoutError:
+            error = f'no answer within {timeout}s'
+        except Exception as e:
+            # Anything a misbehaving host can cause (EOFError from a truncated body,
+            # LimitOverrunError from an endless line, ...) only fails this host
+            error = str(e) or type(e).__name__
+        seconds = time.monotonic() - started
+        metrics.FLEET_POLL_DURATION.observe(seconds, host=host['name'])
+        metrics.FLEET_POLLS.inc(host=host['name'], result='error' if error else 'ok')
+
+        with self.lock:
+            result = self.results.setdefault(host['name'], {})
+            result.update(attempted=time.time(), latency_ms=round(seconds * 1000), error=error)
+            if summary is not None:
+                result.update(summary=summary, fetched=result['attempted'])
+
+    def overview(self):
+        """Per-host status from the cache, with alerts for stale backups and unreachable hosts"""
+        config = self.config()
+        now = time.time()
+        stale_seconds = config['stale_after_hours'] * 3600
+        with self.lock:
+            results = {name: dict(result) for name, result in self.results.items()}
+
+        hosts, alerts = [], []
+        counts = {'ok': 0, 'stale': 0, 'unreachable': 0, 'pending': 0}
+        for host in config['hosts']:
+            result = results.get(host['name'], {})
+            summary = result.get('summary')
+            last_backup = (summary or {}).get('last_backup')
+            backup_age = now - last_backup['timestamp'] if last_backup and last_backup.get('timestamp') else None
+
+            if result.get('error'):
+                status = 'unreachable'
+                alerts.append({'host': host['name'], 'level': 'danger',
+                               'message': f"{host['name']} is unreachable: {result['error']}"})
+            elif summary is None:
+                status = 'pending'
+            elif backup_age is None or backup_age > stale_seconds:
+                status = 'stale'
+            else:
+                status = 'ok'
+            # Known from the last good summary even while the host is unreachable
+            if summary is not None and (backup_age is None or backup_age > stale_seconds):
+                alerts.append({'host': host['name'], 'level': 'warning',
+                               'message': f"{host['name']} has no backup" if backup_age is None else
+                                          f"{host['name']}: last backup {backup_age / 3600:.0f}h ago"})
+            counts[status] += 1
+            hosts.append({
+                'name': host['name'],
+                'url': host['url'],
+                'status': status,
+                'error': result.get('error'),
+                'summary': summary,
+                'backup_age_hours': round(backup_age / 3600, 1) if backup_age is not None else None,
+                'polled_seconds_ago': round(now - result['attempted']) if 'attempted' in result else None,
+                'fetched_seconds_ago': round(now - result['fetched']) if 'fetched' in result else None,
+                'latency_ms': result.get('latency_ms'),
+            })
+        return {
+            'hosts': hosts,
+            'alerts': alerts,
+            'counts': counts,
+            'stale_after_hours': config['stale_after_hours'],
+            'poll_interval_seconds': config['poll_interval_seconds'],
+            'config_path': self.config_path,
+            'config_error': config.get('error'),
+            'generated': now,
+        }
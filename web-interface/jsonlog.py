@@ -0,0 +1,84 @@
+"""
+Structured JSON event log shared with lib/common.sh
+
+When LOG_FORMAT=json, the toolkit CLI writes one JSON object per line with
+ts, level, op (operation id), command and msg, plus span_start/span_end
+events carrying phase, start_ns, end_ns, duration_ms and bytes. This module
+writes the same shape from the web interface and parses either format back,
+so log views and metrics can filter on fields instead of substrings.
+"""
+
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+TEXT_LINE_RE = re.compile(r'^\[(?P<level>[A-Z]+)\] (?P<date>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (?P<msg>.*)$')
+
+
+def _timestamp():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class EventLog:
+    """Append-only JSON-lines writer; each event is a single O_APPEND write()"""
+
+    def __init__(self, path, component='web'):
+        self.path = path
+        self.component = component
+
+    def write(self, level, msg, op=None, **fields):
+        event = {'ts': _timestamp(), 'level': level, 'op': op or '', 'command': self.component, 'msg': msg}
+        event.update(fields)
+        data = (json.dumps(event, default=str) + '\n').encode('utf-8')
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except OSError:
+            return
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+def parse_line(line):
+    """Parse a JSON or legacy text log line into an event dict (None if unparseable)"""
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        try:
+            event = json.loads(line)
+            return event if isinstance(event, dict) else None
+        except ValueError:
+            return None
+    match = TEXT_LINE_RE.match(line)
+    if match:
+        return {'level': match.group('level').lower(), 'ts': match.group('date'), 'msg': match.group('msg')}
+    return None
+
+
+def format_event(event):
+    """Render an event as a readable single line for the log viewer"""
+    text = f"[{event.get('level', 'info').upper()}] {event.get('ts', '')} {event.get('msg', '')}"
+    if event.get('event') == 'span_end':
+        text += f" ({event.get('phase')}: {event.get('duration_ms')} ms"
+        if event.get('bytes') is not None:
+            text += f", {event['bytes']} bytes"
+        text += ')'
+    return text
+
+
+def iter_events(path, **filters):
+    """Yield parsed events from a log file whose fields equal every filter value"""
+    try:
+        f = open(path, 'r', encoding='utf-8', errors='replace')
+    except OSError:
+        return
+    with f:
+        for line in f:
+            event = parse_line(line)
+            if event and all(event.get(key) == value for key, value in filters.items()):
+                yield event
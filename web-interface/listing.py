@@ -0,0 +1,321 @@
+"""
+Sorted, filtered and paginated listings of backups and Timeshift snapshots
+
+An index loads every item from its sources (the backup directory and its
+catalog, or shared-data/timeshift-info.json) and keeps them in memory,
+pre-sorted by each sort key. Every lookup compares the mtimes of the
+sources with those seen at the last load and rebuilds only when they moved.
+
+Pages are addressed by a cursor holding the sort value and name of the
+last item returned. The next page starts right after that position, so
+items added or removed in between neither repeat nor skip entries.
+"""
+
+import base64
+import json
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+import metrics
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+# Matches the layouts list-backups shows: archives and send streams are files,
+# snapshots, shard sets and volume images are directories
+BACKUP_FILE_RE = re.compile(r'^full-backup-.+\.(?:tar|btrfs)(?:\.\w+)?$')
+BACKUP_DIR_RE = re.compile(r'^(?:full-backup-.+\.(?:rsync|shards)|image-backup-.+\.image)$')
+BACKUP_TIME_RE = re.compile(r'-backup-(?:.*-)?(\d{8}_\d{6})')
+TIMESHIFT_TAGS = {'O': 'ondemand', 'B': 'boot', 'H': 'hourly', 'D': 'daily', 'W': 'weekly', 'M': 'monthly'}
+
+
+class ListingError(ValueError):
+    pass
+
+
+def human_size(size):
+    if size is None:
+        return 'Unknown'
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+
+
+def parse_day(value, end=False):
+    """Timestamp of the start (or end) of a YYYY-MM-DD day"""
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ListingError(f'dates must be YYYY-MM-DD, not {value!r}')
+    return day.timestamp() + (86400 if end else 0)
+
+
+class ListingIndex:
+    """Items from a set of source paths, sorted once per change of those paths"""
+
+    cache_name = None
+    # sort key -> function(item) returning a str or number, never None
+    sort_keys = {}
+    default_sort = 'date'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.error = None
+        self._fingerprint = None
+        self._sorted = {}
+
+    def sources(self):
+        raise NotImplementedError
+
+    def load(self):
+        raise NotImplementedError
+
+    def fingerprint(self):
+        stamps = []
+        for path in self.sources():
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def sorted_items(self, sort):
+        """(items, keys) in ascending (sort value, name) order, rebuilt if a source changed"""
+        fingerprint = self.fingerprint()
+        with self.lock:
+            hit = fingerprint == self._fingerprint
+            metrics.record_cache(self.cache_name, hit)
+            if not hit:
+                try:
+                    items, self.error = self.load(), None
+                except (OSError, ValueError) as e:
+                    items, self.error = [], str(e)
+                self._sorted = {}
+                for name, key in self.sort_keys.items():
+                    ordered = sorted(items, key=lambda item: (key(item), item['name']))
+                    self._sorted[name] = (ordered, [(key(item), item['name']) for item in ordered])
+                self._fingerprint = fingerprint
+            return self._sorted[sort]
+
+    def normalize_tag(self, tag):
+        return tag.lower()
+
+    def matcher(self, since=None, until=None, tag=None, q=None):
+        """Predicate for the filters that are set, or None if none are"""
+        checks = []
+        if since:
+            start = parse_day(since)
+            checks.append(lambda item: item['timestamp'] is not None and item['timestamp'] >= start)
+        if until:
+            end = parse_day(until, end=True)
+            checks.append(lambda item: item['timestamp'] is not None and item['timestamp'] < end)
+        if tag:
+            wanted = {self.normalize_tag(t.strip()) for t in tag.split(',') if t.strip()}
+            checks.append(lambda item: not wanted.isdisjoint(item['tags']))
+        if q:
+            needle = q.lower()
+            checks.append(lambda item: needle in item['name'].lower() or needle in item['description'].lower())
+        if not checks:
+            return None
+        return lambda item: all(check(item) for check in checks)
+
+    def page(self, sort=None, order='desc', cursor=None, limit=DEFAULT_LIMIT, **filters):
+        sort = sort or self.default_sort
+        if sort not in self.sort_keys:
+            raise ListingError(f"sort must be one of {', '.join(self.sort_keys)}")
+        if order not in ('asc', 'desc'):
+            raise ListingError('order must be asc or desc')
+        try:
+            limit = max(1, min(int(limit), MAX_LIMIT))
+        except (TypeError, ValueError):
+            raise ListingError('limit must be a number')
+        predicate = self.matcher(**filters)
+
+        items, keys = self.sorted_items(sort)
+        if predicate:
+            kept = [i for i, item in enumerate(items) if predicate(item)]
+            items, keys = [items[i] for i in kept], [keys[i] for i in kept]
+
+        try:
+            if order == 'asc':
+                start = bisect_right(keys, self._decode(cursor, sort, order)) if cursor else 0
+                page = items[start:start + limit]
+                more = start + limit < len(items)
+            else:
+                end = bisect_left(keys, self._decode(cursor, sort, order)) if cursor else len(items)
+                page = items[max(0, end - limit):end][::-1]
+                more = end - limit > 0
+        except TypeError:
+            # A hand-made cursor whose value does not compare with this sort key
+            raise ListingError('invalid cursor')
+        return {
+            'success': self.error is None,
+            'error': self.error,
+            'items': page,
+            'total': len(items),
+            'sort': sort,
+            'order': order,
+            'next_cursor': self._encode(page[-1], sort, order) if page and more else None,
+        }
+
+    def _encode(self, item, sort, order):
+        position = {'sort': sort, 'order': order, 'key': [self.sort_keys[sort](item), item['name']]}
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+    def _decode(self, cursor, sort, order):
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            key = tuple(position['key'])
+        except (ValueError, TypeError, KeyError):
+            raise ListingError('invalid cursor')
+        if position.get('sort') != sort or position.get('order') != order or len(key) != 2:
+            raise ListingError('cursor belongs to a different sort order')
+        return key
+
+
+class BackupIndex(ListingIndex):
+    """Local backups in backup_dir plus catalogued backups that only live in a sink"""
+
+    cache_name = 'backup_index'
+    sort_keys = {
+        'date': lambda item: item['timestamp'] or 0,
+        'size': lambda item: item['bytes'] if item['bytes'] is not None else -1,
+        'name': lambda item: item['name'],
+        'tags': lambda item: ','.join(item['tags']),
+    }
+
+    def __init__(self, backup_dir):
+        super().__init__()
+        self.backup_dir = backup_dir
+        self.catalog_dir = os.path.join(backup_dir, '.toolkit', 'catalog')
+
+    def sources(self):
+        # Adding, removing or renaming a backup or a catalog entry changes its directory
+        return (self.backup_dir, self.catalog_dir)
+
+    def load(self):
+        catalog = {}
+        try:
+            names = os.listdir(self.catalog_dir)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.endswith('.json') and not name.startswith('.'):
+                try:
+                    with open(os.path.join(self.catalog_dir, name)) as f:
+                        entry = json.load(f)
+                    catalog[entry['id']] = entry
+                except (OSError, ValueError, KeyError, TypeError):
+                    continue
+
+        items = []
+        seen = set()
+        with os.scandir(self.backup_dir) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not (BACKUP_DIR_RE.match(entry.name) if is_dir else BACKUP_FILE_RE.match(entry.name)):
+                    continue
+                backup_id = entry.name.split('.', 1)[0]
+                seen.add(backup_id)
+                record = catalog.get(backup_id, {})
+                size = record.get('archive_bytes')
+                if size is None and not is_dir:
+                    size = entry.stat(follow_symlinks=False).st_size
+                items.append(self._item(entry.name, backup_id, record, size, 'local',
+                                        entry.stat(follow_symlinks=False).st_mtime))
+        for backup_id, record in catalog.items():
+            if backup_id not in seen and record.get('sink') and record.get('name'):
+                items.append(self._item(record['name'], backup_id, record, record.get('archive_bytes'), 'remote', None))
+        return items
+
+    def _item(self, name, backup_id, record, size, location, mtime):
+        engine = record.get('engine') or self._engine(name)
+        timestamp = None
+        match = BACKUP_TIME_RE.search(name)
+        if match:
+            timestamp = datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').timestamp()
+        elif record.get('created'):
+            timestamp = datetime.strptime(record['created'], '%Y-%m-%d %H:%M:%S').timestamp()
+        else:
+            timestamp = mtime
+        codec = record.get('codec')
+        tags = [engine, location]
+        if codec and codec != 'none':
+            tags.append(codec)
+        if record.get('status') and record['status'] != 'complete':
+            tags.append(record['status'])
+        return {
+            'name': name,
+            'id': backup_id,
+            'engine': engine,
+            'codec': codec,
+            'location': location,
+            'status': record.get('status', 'complete'),
+            'description': record.get('description') or '',
+            'source': record.get('source'),
+            'bytes': size,
+            'size': human_size(size),
+            'timestamp': timestamp,
+            'date': datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else None,
+            'tags': tags,
+        }
+
+    @staticmethod
+    def _engine(name):
+        if name.endswith('.image'):
+            return 'image'
+        for suffix, engine in (('.rsync', 'rsync'), ('.shards', 'sharded'), ('.btrfs', 'btrfs')):
+            if suffix in name:
+                return engine
+        return 'tar'
+
+
+class TimeshiftIndex(ListingIndex):
+    """Snapshots from the timeshift-info.json written by host-scripts/update-timeshift-data.py"""
+
+    cache_name = 'timeshift_index'
+    sort_keys = {
+        'date': lambda item: item['timestamp'] or 0,
+        'name': lambda item: item['name'],
+        'tags': lambda item: ','.join(item['tags']),
+    }
+
+    def __init__(self, info_file):
+        super().__init__()
+        self.info_file = info_file
+
+    def normalize_tag(self, tag):
+        # Accept Timeshift's one-letter codes as well as the names
+        return TIMESHIFT_TAGS.get(tag, tag.lower())
+
+    def sources(self):
+        return (self.info_file,)
+
+    def load(self):
+        with open(self.info_file) as f:
+            info = json.load(f)
+        if not info.get('success', True):
+            raise ValueError(info.get('error') or 'Timeshift data reports a failure')
+        items = []
+        for snapshot in info.get('snapshots', []):
+            name = snapshot.get('name')
+            if not name:
+                continue
+            try:
+                timestamp = datetime.strptime(name, '%Y-%m-%d_%H-%M-%S').timestamp()
+            except ValueError:
+                timestamp = None
+            codes = (snapshot.get('tags') or '').replace(' ', '')
+            items.append({
+                'name': name,
+                'num': snapshot.get('num'),
+                'tag_codes': codes,
+                'tags': [TIMESHIFT_TAGS.get(code, code.lower()) for code in codes],
+                'description': snapshot.get('description') or '',
+                'timestamp': timestamp,
+                'date': datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else None,
+            })
+        return items
@@ -0,0 +1,281 @@
+"""
+Full-text search across toolkit, web server and rotated logs
+
+Plain logs are memory-mapped and scanned in place, in windows that end
+on a line boundary. A literal, case-sensitive query uses bytes.find (a
+memchr-driven scan), a case-insensitive ASCII literal does the same on
+a lowered copy of each window, and anything else runs a compiled bytes
+regex over the buffer. No line is decoded unless it matches. Compressed
+archives are inflated chunk by chunk; zlib releases the GIL, so the
+worker threads inflate in parallel.
+
+Files are searched concurrently, newest first, and matches are handed
+to the caller as they are found. Each search stops at a match limit, a
+byte budget and a deadline, whichever comes first, and says which one
+cut it short.
+"""
+
+import gzip
+import mmap
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+MAX_QUERY_LENGTH = 256
+# Longest line text returned for a match
+MAX_LINE_CHARS = 2000
+# Stop, budget and deadline checks happen between windows of this size
+WINDOW_BYTES = 8 * 1024 * 1024
+# Toolkit text lines ("[INFO] 2025-08-11 10:00:00 ...") and JSON events ("ts": "2025-08-11T10:00:00.123Z")
+LINE_TIME_RE = re.compile(rb'(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})')
+FILE_DATE_RE = re.compile(r'(\d{4})(\d{2})(\d{2})')
+_DONE = object()
+
+
+class SearchError(ValueError):
+    pass
+
+
+def parse_time(value, end=False):
+    """'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (or with T) as a comparable 'YYYY-MM-DD HH:MM:SS' string"""
+    text = value.strip().replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == '%Y-%m-%d' and end:
+            return parsed.strftime('%Y-%m-%d 23:59:59')
+        return parsed.strftime('%Y-%m-%d %H:%M:%S')
+    raise SearchError(f'times must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS, not {value!r}')
+
+
+class Matcher:
+    """A query compiled for bytes: a literal needle for bytes.find, or a regex"""
+
+    def __init__(self, query, regex=False, case_sensitive=False):
+        if not query:
+            raise SearchError('q is required')
+        if len(query) > MAX_QUERY_LENGTH:
+            raise SearchError(f'q is limited to {MAX_QUERY_LENGTH} characters')
+        pattern = query.encode('utf-8')
+        self.needle = None
+        self.pattern = None
+        # Case-insensitive ASCII literals search a lowered copy of each window,
+        # which is several times faster than an IGNORECASE regex
+        self.fold = False
+        if not regex and (case_sensitive or pattern.lower() == pattern.upper()):
+            # Nothing to fold: the literal fast path applies
+            self.needle = pattern
+        elif not regex and pattern.isascii():
+            self.needle = pattern.lower()
+            self.fold = True
+        else:
+            try:
+                self.pattern = re.compile(pattern if regex else re.escape(pattern),
+                                          0 if case_sensitive else re.IGNORECASE)
+            except re.error as e:
+                raise SearchError(f'invalid regex: {e}')
+
+    def haystack(self, buffer, start, end):
+        """(what to search, its offset in buffer) for buffer[start:end]"""
+        if self.fold:
+            return buffer[start:end].lower(), start
+        return buffer, 0
+
+    def find(self, haystack, start, end):
+        """Offset of the first match in haystack[start:end], or -1"""
+        if self.needle is not None:
+            return haystack.find(self.needle, start, end)
+        match = self.pattern.search(haystack, start, end)
+        return match.start() if match else -1
+
+
+class LogSearch:
+    """One search request over a list of (name, path) log files"""
+
+    def __init__(self, files, matcher, since=None, until=None, limit=DEFAULT_LIMIT,
+                 max_bytes=2 * 1024 ** 3, timeout=10.0, workers=None):
+        self.matcher = matcher
+        self.since = since
+        self.until = until
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.deadline = time.monotonic() + timeout
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.files = self._candidates(files)
+
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.results = queue.Queue()
+        self.matches = 0
+        self.bytes_scanned = 0
+        self.files_searched = 0
+        self.truncated = None
+        self.errors = []
+
+    def _candidates(self, files):
+        """Files that can hold lines in [since, until], newest first"""
+        candidates = []
+        for name, path in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # Lines are appended in time order, so the last one is no newer than the mtime
+            if self.since and datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S') < self.since:
+                continue
+            day = FILE_DATE_RE.search(os.path.basename(name))
+            if self.until and day and '-'.join(day.groups()) > self.until[:10]:
+                continue
+            candidates.append((stat.st_mtime, name, path))
+        candidates.sort(reverse=True)
+        return [(name, path) for _, name, path in candidates]
+
+    def __iter__(self):
+        """Yield match dicts as they are found, then a summary dict"""
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='log-search')
+        try:
+            futures = [executor.submit(self._search_file, name, path) for name, path in self.files]
+            pending = len(futures)
+            for future in futures:
+                future.add_done_callback(lambda _: self.results.put(_DONE))
+            while pending:
+                item = self.results.get()
+                if item is _DONE:
+                    pending -= 1
+                else:
+                    yield item
+        finally:
+            # Also reached when the client goes away mid-stream
+            self.stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        yield {
+            'done': True,
+            'matches': self.matches,
+            'files': self.files_searched,
+            'bytes': self.bytes_scanned,
+            'elapsed_ms': round((time.monotonic() - started) * 1000),
+            'truncated': self.truncated,
+            'errors': self.errors,
+        }
+
+    def _halt(self, reason):
+        with self.lock:
+            self.truncated = self.truncated or reason
+        self.stop.set()
+
+    def _reserve(self, size):
+        """Account for scanning size more bytes; False once a budget is spent"""
+        if self.stop.is_set():
+            return False
+        if time.monotonic() > self.deadline:
+            self._halt('time')
+            return False
+        with self.lock:
+            over = self.bytes_scanned + size > self.max_bytes
+            if not over:
+                self.bytes_scanned += size
+        if over:
+            self._halt('bytes')
+        return not over
+
+    def _search_file(self, name, path):
+        if self.stop.is_set():
+            return
+        try:
+            if path.endswith('.gz'):
+                complete = self._search_stream(name, path)
+            else:
+                complete = self._search_mapped(name, path)
+        except (OSError, EOFError, ValueError) as e:
+            with self.lock:
+                self.errors.append({'file': name, 'error': str(e)})
+            return
+        if complete:
+            with self.lock:
+                self.files_searched += 1
+
+    def _search_mapped(self, name, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return True
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                start = 0
+                while start < size:
+                    end = min(start + WINDOW_BYTES, size)
+                    if end < size:
+                        # End the window on a line boundary so no line is split between two of them
+                        newline = mapped.rfind(b'\n', start, end)
+                        end = newline + 1 if newline >= 0 else end
+                    if not self._reserve(end - start):
+                        return False
+                    self._scan(name, mapped, start, end, 0)
+                    start = end
+        return not self.stop.is_set()
+
+    def _search_stream(self, name, path):
+        with gzip.open(path, 'rb') as f:
+            carry = b''
+            offset = 0
+            while True:
+                chunk = f.read(WINDOW_BYTES)
+                if not chunk:
+                    break
+                if not self._reserve(len(chunk)):
+                    return False
+                buffer = carry + chunk
+                newline = buffer.rfind(b'\n')
+                if newline < 0:
+                    carry = buffer
+                    continue
+                self._scan(name, buffer, 0, newline + 1, offset)
+                carry = buffer[newline + 1:]
+                offset += newline + 1
+            if carry:
+                self._scan(name, carry, 0, len(carry), offset)
+        return not self.stop.is_set()
+
+    def _scan(self, name, buffer, start, end, base):
+        """Report each line of buffer[start:end] holding a match; base is buffer's offset in the log"""
+        haystack, shift = self.matcher.haystack(buffer, start, end)
+        position = start
+        while position < end and not self.stop.is_set():
+            found = self.matcher.find(haystack, position - shift, end - shift)
+            if found < 0:
+                return
+            found += shift
+            line_start = buffer.rfind(b'\n', start, found) + 1 or start
+            line_end = buffer.find(b'\n', found, end)
+            line_end = end if line_end < 0 else line_end
+            position = line_end + 1
+            line = buffer[line_start:line_end]
+            if (self.since or self.until) and not self._in_range(line):
+                continue
+            with self.lock:
+                if self.matches >= self.limit:
+                    self.truncated = self.truncated or 'limit'
+                    self.stop.set()
+                    return
+                self.matches += 1
+            self.results.put({
+                'file': name,
+                'offset': base + line_start,
+                'line': line.decode('utf-8', errors='replace').rstrip('\r')[:MAX_LINE_CHARS],
+            })
+
+    def _in_range(self, line):
+        stamp = LINE_TIME_RE.search(line, 0, 64)
+        if not stamp:
+            # Continuation output without a time of its own
+            return True
+        when = (stamp.group(1) + b' ' + stamp.group(2)).decode()
+        return (not self.since or when >= self.since) and (not self.until or when <= self.until)
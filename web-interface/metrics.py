@@ -0,0 +1,213 @@
+"""
+Minimal Prometheus-style metrics for the web interface
+
+Counters, gauges and histograms with labels, kept in process memory and
+rendered in the Prometheus text exposition format by render(). No client
+library is needed; each metric guards its own samples with a lock so the
+Flask worker threads and TaskManager threads can record concurrently.
+"""
+
+import threading
+import time
+from functools import wraps
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class: a named family of samples keyed by label values"""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._samples = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._samples.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """callback, if given, returns {label-values tuple: value} at scrape time"""
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = value
+
+    def render(self):
+        if self.callback:
+            samples = self.callback()
+            with self._lock:
+                self._samples = {tuple(str(v) for v in k): v2 for k, v2 in samples.items()}
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = self._samples[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample['counts'][i] += 1
+                    break
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def _render_sample(self, key, sample):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, sample['counts']):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(round(sample["sum"], 6))}')
+        lines.append(f'{self.name}_count{labels} {sample["count"]}')
+        return lines
+
+
+def timed(histogram, **labels):
+    """Decorator recording the wall time of each call into a histogram"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Render every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by the web interface
+
+SUBPROCESS_DURATION = Histogram(
+    'srt_subprocess_duration_seconds', 'Wall time of commands shelled out by the web interface', ['command'])
+SUBPROCESS_TIMEOUTS = Counter(
+    'srt_subprocess_timeouts_total', 'Shelled-out commands killed by their timeout', ['command'])
+SUBPROCESS_FAILURES = Counter(
+    'srt_subprocess_failures_total', 'Shelled-out commands that exited non-zero or failed to start', ['command'])
+
+FUNCTION_DURATION = Histogram(
+    'srt_function_duration_seconds', 'Wall time of instrumented hot-path functions', ['function'])
+
+HTTP_REQUEST_DURATION = Histogram(
+    'srt_http_request_duration_seconds', 'Latency of HTTP requests by route', ['method', 'route'])
+HTTP_REQUESTS = Counter(
+    'srt_http_requests_total', 'HTTP requests by route and status code', ['method', 'route', 'status'])
+
+CACHE_LOOKUPS = Counter(
+    'srt_cache_lookups_total', 'Cache lookups by cache name and result (hit or miss)', ['cache', 'result'])
+
+BACKUPS = Counter(
+    'srt_backups_total', 'Backup tasks finished, by result', ['status'])
+BACKUP_DURATION = Histogram(
+    'srt_backup_duration_seconds', 'Duration of completed backup tasks', [],
+    buckets=(60, 300, 600, 1800, 3600, 7200, 14400, 28800))
+BACKUP_PHASE_DURATION = Histogram(
+    'srt_backup_phase_duration_seconds', 'Per-phase span durations of completed backups (JSON logs only)', ['phase'],
+    buckets=(0.1, 1, 10, 60, 300, 600, 1800, 3600, 7200, 14400))
+BACKUP_BYTES = Counter(
+    'srt_backup_bytes_total', 'Bytes written by completed backup tasks')
+BACKUP_LAST_BYTES = Gauge(
+    'srt_backup_last_bytes', 'Size of the most recent completed backup')
+BACKUP_LAST_THROUGHPUT = Gauge(
+    'srt_backup_last_throughput_bytes_per_second', 'Archive bytes per second of the most recent completed backup')
+BACKUP_LAST_SUCCESS = Gauge(
+    'srt_backup_last_success_timestamp_seconds', 'Unix time the most recent successful backup finished')
+
+FLEET_POLLS = Counter(
+    'srt_fleet_polls_total', 'Fleet summary polls by host and result (ok or error)', ['host', 'result'])
+FLEET_POLL_DURATION = Histogram(
+    'srt_fleet_poll_duration_seconds', 'Time to fetch a fleet host summary, including timeouts', ['host'])
+
+
+def record_cache(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def command_label(command):
+    """Bounded label for an argv list: the program name, unwrapping sudo, plus toolkit subcommands"""
+    argv = list(command)
+    if argv and argv[0].rsplit('/', 1)[-1] == 'sudo':
+        argv = argv[1:]
+    if not argv:
+        return 'unknown'
+    program = argv[0].rsplit('/', 1)[-1]
+    if program == 'system-restore-toolkit' and len(argv) > 1:
+        return f'{program} {argv[1]}'
+    return program
@@ -0,0 +1,132 @@
+"""
+Sampling profiler for the running web interface
+
+A Sampler wakes up hz times a second, reads the stack of every other
+thread from sys._current_frames() and counts it. No tracing hooks are
+installed, so threads that are not being sampled run at full speed; the
+cost is one stack walk per thread per tick, and it is reported with the
+results.
+
+Stacks are aggregated in the collapsed format used by flamegraph.pl and
+speedscope: one line per distinct stack, frames joined by ';' from the
+thread down to the leaf, followed by its sample count. Per thread the
+sampler also counts the leaf line, which says whether a thread is
+computing, waiting on a subprocess or blocked on a lock.
+"""
+
+import linecache
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_HZ = 100
+MAX_HZ = 1000
+MAX_SECONDS = 60
+# Leaf lines reported per thread
+TOP_LINES = 5
+
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Sampler:
+    """Collect stack samples of all threads but the sampling one"""
+
+    def __init__(self, hz=DEFAULT_HZ, lines=False):
+        self.interval = 1.0 / hz
+        self.hz = hz
+        # With lines, frames are told apart by the line executing rather than the function
+        self.lines = lines
+        self.stacks = Counter()
+        self.leaves = {}
+        self.thread_samples = Counter()
+        self.names = {}
+        self.samples = 0
+        self.sampling_seconds = 0.0
+        self.elapsed = 0.0
+        self._labels = {}
+
+    def run(self, seconds):
+        """Sample for seconds; only one Sampler runs at a time"""
+        if not _running.acquire(blocking=False):
+            raise ProfilerBusy('a profile is already being taken')
+        try:
+            own = threading.get_ident()
+            started = time.perf_counter()
+            deadline = started + seconds
+            next_tick = started
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                self._sample(own)
+                self.sampling_seconds += time.perf_counter() - now
+                next_tick += self.interval
+                # A late tick is not made up for; the next one keeps the schedule
+                time.sleep(max(0.0, next_tick - time.perf_counter()))
+            self.elapsed = time.perf_counter() - started
+        finally:
+            _running.release()
+
+    def _sample(self, own):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            name = names.get(ident, f'thread-{ident}')
+            self.names[ident] = name
+            frames = []
+            leaf = frame
+            while frame is not None:
+                frames.append(self._label(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            frames.append(name)
+            frames.reverse()
+            self.stacks[';'.join(frames)] += 1
+            self.thread_samples[ident] += 1
+            self.leaves.setdefault(ident, Counter())[(leaf.f_code.co_filename, leaf.f_lineno,
+                                                      leaf.f_code.co_name)] += 1
+
+    def _label(self, code, lineno):
+        key = (code, lineno if self.lines else None)
+        label = self._labels.get(key)
+        if label is None:
+            line = lineno if self.lines else code.co_firstlineno
+            label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{line})'
+            self._labels[key] = label
+        return label
+
+    def collapsed(self):
+        """The samples in collapsed-stack format, most frequent stack first"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def threads(self):
+        """Per thread: samples and the lines it was found executing most often"""
+        threads = []
+        for ident, count in self.thread_samples.most_common():
+            top = []
+            for (filename, lineno, function), hits in self.leaves[ident].most_common(TOP_LINES):
+                top.append({
+                    'function': function,
+                    'location': f'{os.path.basename(filename)}:{lineno}',
+                    'source': linecache.getline(filename, lineno).strip(),
+                    'percent': round(100.0 * hits / count, 1),
+                })
+            threads.append({'name': self.names[ident], 'ident': ident, 'samples': count, 'top_lines': top})
+        return threads
+
+    def summary(self):
+        return {
+            'seconds': round(self.elapsed, 3),
+            'hz': self.hz,
+            'samples': self.samples,
+            'sampling_ms': round(self.sampling_seconds * 1000, 1),
+            # Share of the profiling window the sampler itself held the GIL for
+            'overhead_percent': round(100.0 * self.sampling_seconds / self.elapsed, 2) if self.elapsed else 0.0,
+        }
@@ -0,0 +1,115 @@
+// Incremental loading of the paginated listings (/api/backups, /api/timeshift/snapshots)
+
+class ListingPager {
+    // options: url, form (sort and filter fields), body (tbody), moreButton, summary,
+    // columns (for the empty and error rows), renderRow(item, index) -> <tr>,
+    // and optionally onReset() for pages that keep state about the loaded rows
+    constructor(options) {
+        Object.assign(this, {limit: 50}, options);
+        this.cursor = null;
+        this.loaded = 0;
+        this.generation = 0;
+
+        this.form.addEventListener('change', () => this.reset());
+        this.form.addEventListener('submit', event => {
+            event.preventDefault();
+            this.reset();
+        });
+        let typing = null;
+        this.form.querySelectorAll('input[type=search]').forEach(input => {
+            input.addEventListener('input', () => {
+                clearTimeout(typing);
+                typing = setTimeout(() => this.reset(), 300);
+            });
+        });
+        this.moreButton.addEventListener('click', () => this.load());
+        this.reset();
+    }
+
+    query() {
+        const params = new URLSearchParams();
+        new FormData(this.form).forEach((value, key) => {
+            if (value) {
+                params.set(key, value);
+            }
+        });
+        params.set('limit', this.limit);
+        if (this.cursor) {
+            params.set('cursor', this.cursor);
+        }
+        return params;
+    }
+
+    reset() {
+        this.cursor = null;
+        this.loaded = 0;
+        this.body.replaceChildren();
+        if (this.onReset) {
+            this.onReset();
+        }
+        this.load();
+    }
+
+    load() {
+        // A reset while a page is in flight makes that page stale
+        const generation = ++this.generation;
+        this.moreButton.disabled = true;
+        fetch(this.url + '?' + this.query())
+            .then(response => response.json())
+            .then(page => {
+                if (generation !== this.generation) {
+                    return;
+                }
+                if (!page.success) {
+                    this.message(page.error || 'Could not load the list', 'text-danger');
+                    return;
+                }
+                page.items.forEach(item => {
+                    this.loaded += 1;
+                    this.body.appendChild(this.renderRow(item, this.loaded));
+                });
+                if (!this.loaded) {
+                    this.message('Nothing matches these filters', 'text-muted');
+                }
+                this.cursor = page.next_cursor;
+                this.moreButton.classList.toggle('d-none', !page.next_cursor);
+                this.summary.textContent = 'Showing ' + this.loaded + ' of ' + page.total;
+            })
+            .catch(error => {
+                if (generation === this.generation) {
+                    this.message('Could not load the list: ' + error, 'text-danger');
+                }
+            })
+            .finally(() => { this.moreButton.disabled = false; });
+    }
+
+    message(text, className) {
+        const row = document.createElement('tr');
+        const cell = document.createElement('td');
+        cell.colSpan = this.columns;
+        cell.className = className + ' text-center';
+        cell.textContent = text;
+        row.appendChild(cell);
+        this.body.replaceChildren(row);
+        this.moreButton.classList.add('d-none');
+        this.summary.textContent = '';
+    }
+}
+
+// <td> holding text, or the nodes given
+function listingCell(...contents) {
+    const cell = document.createElement('td');
+    contents.forEach(content => cell.append(content));
+    return cell;
+}
+
+function listingElement(tag, className, text) {
+    const element = document.createElement(tag);
+    if (className) {
+        element.className = className;
+    }
+    if (text !== undefined) {
+        element.textContent = text;
+    }
+    return element;
+}